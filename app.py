@@ -1,16 +1,50 @@
 import streamlit as st
-import ollama
+from streamlit.errors import StreamlitAPIException
 import os
-import base64
-from PIL import Image
-import io
-from database import db
-import auth
+import time
 from dotenv import load_dotenv
 
-# Load environment variables
+# Load environment variables before the local modules read their settings
 load_dotenv()
 
+import metrics
+from metrics import span, startup
+
+with startup.phase('imports'):
+    from database import db
+    import auth
+    import context
+    import recall
+    from model_catalog import catalog
+    from images import list_images, get_thumbnail
+    from jobs import job_queue, Overloaded
+    from warmup import warmer
+    from archive import start_archiver
+
+# Stream replies token by token instead of waiting for the full completion
+STREAM_RESPONSES = os.getenv('STREAM_RESPONSES', 'true').lower() == 'true'
+STREAM_RENDER_INTERVAL = float(os.getenv('STREAM_RENDER_INTERVAL', '0.05'))
+
+# Chat history is loaded a page at a time; the visible window is capped
+MESSAGE_PAGE_SIZE = int(os.getenv('MESSAGE_PAGE_SIZE', '50'))
+MESSAGE_WINDOW_MAX = int(os.getenv('MESSAGE_WINDOW_MAX', '200'))
+
+# Largest chat export offered for download from the sidebar; the download is
+# held in memory, so larger histories are exported with backup.py
+CHAT_EXPORT_MAX_BYTES = int(os.getenv('CHAT_EXPORT_MAX_BYTES', str(32 * 1024 * 1024)))
+
+# Search results shown per page in the sidebar
+SEARCH_PAGE_SIZE = int(os.getenv('SEARCH_PAGE_SIZE', '5'))
+
+# How often the model load status refreshes
+MODEL_STATUS_INTERVAL = float(os.getenv('MODEL_STATUS_INTERVAL', '2'))
+
+# Usernames allowed to see the metrics view
+ADMIN_USERS = [name.strip() for name in os.getenv('ADMIN_USERS', '').split(',') if name.strip()]
+
+# How often the chat view checks on a queued or running generation job
+JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', '0.05'))
+
 # Initialize authentication
 auth.init_auth()
 
@@ -143,35 +177,93 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 def get_available_models():
-    """Get all available Ollama models with robust error handling"""
-    try:
-        models_response = ollama.list()
-        
-        if isinstance(models_response, dict) and 'models' in models_response:
-            models = [model['name'] for model in models_response['models']]
-            return models
-        elif isinstance(models_response, list):
-            models = [model['name'] for model in models_response]
-            return models
-        else:
-            return ['goekdenizguelmez/JOSIEFIED-Qwen3:0.6b', 'llama2', 'mistral']
-            
-    except Exception as e:
-        print(f"Error fetching models: {e}")
-        return ['goekdenizguelmez/JOSIEFIED-Qwen3:0.6b', 'llama2', 'mistral']
+    """Names of the installed Ollama models, from the process-wide catalog"""
+    return catalog.get_model_names()
+
+def format_model_details(model):
+    parts = [model['family'], model['parameter_size'], model['quantization']]
+    if model['size']:
+        parts.append(f"{model['size'] / 1024 ** 3:.1f} GB")
+    return " · ".join(part for part in parts if part)
 
 def get_character_images():
-    if not os.path.exists('character_images'):
-        os.makedirs('character_images')
-    images = [f for f in os.listdir('character_images') 
-              if f.lower().endswith(('.png', '.jpg', '.jpeg', '.gif'))]
+    images = list_images('character_images')
     return images if images else ['default.png']
 
 def get_background_images():
-    if not os.path.exists('background_images'):
-        os.makedirs('background_images')
-    return [f for f in os.listdir('background_images') 
-            if f.lower().endswith(('.png', '.jpg', '.jpeg', '.gif'))]
+    return list_images('background_images')
+
+def render_user_html(content):
+    return f"""
+                <div class="message-user">
+                    <strong>👤 YOU:</strong><br>
+                    {content}
+                </div>
+                """
+
+def render_assistant_html(content):
+    return f"""
+                    <div class="message-assistant">
+                        <strong>🤖 CINTESSA:</strong><br>
+                        {content}
+                    </div>
+                    """
+
+def render_message(message):
+    if message['role'] == 'user':
+        st.markdown(render_user_html(message['content']), unsafe_allow_html=True)
+    else:
+        col1, col2 = st.columns([0.9, 0.1])
+        with col1:
+            st.markdown(render_assistant_html(message['content']), unsafe_allow_html=True)
+        with col2:
+            if st.button("📋", key=f"copy_{message['id']}"):
+                st.code(message['content'])
+
+def session_watcher():
+    """Callable that says whether this browser session is still connected, if that can be told"""
+    from streamlit import runtime
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
+    ctx = get_script_run_ctx()
+    if ctx is None or not runtime.exists():
+        return None
+    instance = runtime.get_instance()
+    session_id = ctx.session_id
+    return lambda: instance.is_active_session(session_id)
+
+def follow_job(job_id, placeholder):
+    """Render a generation job into placeholder until it finishes.
+    
+    With STREAM_RESPONSES the reply is shown as chunks arrive, otherwise only
+    once it is complete. Returns the finished job.
+    """
+    last_render = 0.0
+    # Closing the tab stops this loop; the queue then cancels the job once
+    # the session has stayed away for a while
+    job_queue.watch(job_id, session_watcher())
+    
+    while True:
+        job = job_queue.get(job_id)
+        if job is None or job.finished:
+            break
+        
+        now = time.monotonic()
+        if job.status == 'queued':
+            ahead = job_queue.position(job_id)
+            waiting = f"{ahead} request(s) ahead of yours" if ahead is not None else "waiting for a free slot"
+            placeholder.markdown(render_assistant_html(f"⏳ Queued, {waiting}..."), unsafe_allow_html=True)
+        elif STREAM_RESPONSES and job.chunks and now - last_render >= STREAM_RENDER_INTERVAL:
+            # Redrawing the markdown on every token is expensive for fast models
+            ttft = f"<small>⚡ First token in {job.first_token_at - job.created_at:.2f}s</small>" if job.first_token_at else ""
+            placeholder.markdown(render_assistant_html(job.content + " ▌") + ttft, unsafe_allow_html=True)
+            last_render = now
+        elif not job.chunks or not STREAM_RESPONSES:
+            placeholder.markdown(render_assistant_html("💭 Cintessa is thinking..."), unsafe_allow_html=True)
+        time.sleep(JOB_POLL_INTERVAL)
+    
+    if job is not None and job.content:
+        placeholder.markdown(render_assistant_html(job.content), unsafe_allow_html=True)
+    return job
 
 def init_session_state():
     if 'current_session' not in st.session_state:
@@ -181,144 +273,435 @@ def init_session_state():
     if 'model' not in st.session_state:
         default_model = os.getenv('DEFAULT_MODEL', 'goekdenizguelmez/JOSIEFIED-Qwen3:0.6b')
         st.session_state.model = default_model
-    if 'models_loaded' not in st.session_state:
-        st.session_state.models_loaded = False
-    if 'available_models' not in st.session_state:
-        st.session_state.available_models = []
+        warmer.preload(default_model)
     if 'system_prompt' not in st.session_state:
         st.session_state.system_prompt = ""
+    if 'last_ttft' not in st.session_state:
+        st.session_state.last_ttft = None
+    # Model load time included in the last reply, when it had to load
+    if 'last_load_seconds' not in st.session_state:
+        st.session_state.last_load_seconds = 0.0
+    # Number of session messages before the loaded window, and whether older pages exist
+    if 'message_offset' not in st.session_state:
+        st.session_state.message_offset = 0
+    if 'has_older_messages' not in st.session_state:
+        st.session_state.has_older_messages = False
+    # Session list cache, see get_sessions()
+    if 'user_sessions' not in st.session_state:
+        st.session_state.user_sessions = None
+    # Newest message rendered by the last full run, see chat_area()
+    if 'rendered_upto_id' not in st.session_state:
+        st.session_state.rendered_upto_id = 0
+    # Generation job whose reply is still pending for the current session
+    if 'active_job' not in st.session_state:
+        st.session_state.active_job = None
+
+def get_sessions(refresh=False):
+    """The user's chat sessions, queried once and reused until invalidated"""
+    if refresh or st.session_state.user_sessions is None:
+        st.session_state.user_sessions = db.get_user_sessions(st.session_state.user_id)
+    return st.session_state.user_sessions
 
 def create_new_chat():
     user_id = st.session_state.user_id
     session_id = db.create_chat_session(user_id)
+    get_sessions(refresh=True)
     st.session_state.current_session = session_id
     st.session_state.messages = []
+    st.session_state.message_offset = 0
+    st.session_state.has_older_messages = False
+    st.session_state.active_job = None
     st.session_state.system_prompt = ""
     st.rerun()
 
 def load_chat_session(session_id):
     st.session_state.current_session = session_id
-    messages = db.get_session_messages(session_id)
-    st.session_state.messages = [{'role': role, 'content': content} for role, content, _ in messages]
+    # Idle sessions may have been moved to the archive; bring them back first
+    db.restore_session(session_id)
+    # A reply may still be generating from before a browser refresh
+    st.session_state.active_job = db.get_session_active_job(session_id)
+    rows, has_more = db.get_session_messages_page(session_id, limit=MESSAGE_PAGE_SIZE)
+    st.session_state.messages = [{'id': id, 'role': role, 'content': content} for id, role, content, _ in rows]
+    st.session_state.has_older_messages = has_more
+    st.session_state.message_offset = db.count_session_messages(session_id) - len(rows) if has_more else 0
     
     # Load the system prompt for this session
-    sessions = db.get_user_sessions(st.session_state.user_id)
-    for session in sessions:
+    for session in get_sessions():
         if session[0] == session_id:
             st.session_state.system_prompt = session[3] if session[3] else ""
             break
 
+def load_older_messages():
+    messages = st.session_state.messages
+    before_id = messages[0]['id'] if messages else None
+    rows, has_more = db.get_session_messages_page(
+        st.session_state.current_session, before_id=before_id, limit=MESSAGE_PAGE_SIZE
+    )
+    st.session_state.messages = [{'id': id, 'role': role, 'content': content} for id, role, content, _ in rows] + messages
+    st.session_state.has_older_messages = has_more
+    st.session_state.message_offset -= len(rows)
+
+def append_message(role, content, message_id=None):
+    """Add a message to the loaded window, saving it first unless it already has an id"""
+    if message_id is None:
+        message_id = db.add_message(st.session_state.current_session, role, content)
+        recall.index_message(st.session_state.user_id, st.session_state.current_session, message_id, content)
+    elif any(message['id'] == message_id for message in st.session_state.messages):
+        return
+    st.session_state.messages.append({'id': message_id, 'role': role, 'content': content})
+    
+    # Keep the rendered window bounded; older pages can be loaded again on demand
+    overflow = len(st.session_state.messages) - MESSAGE_WINDOW_MAX
+    if overflow > 0:
+        del st.session_state.messages[:overflow]
+        st.session_state.message_offset += overflow
+        st.session_state.has_older_messages = True
+
 def get_current_session_details():
     if st.session_state.current_session:
-        sessions = db.get_user_sessions(st.session_state.user_id)
-        for session in sessions:
+        for session in get_sessions():
             if session[0] == st.session_state.current_session:
                 return session
     return None
 
-def main():
-    auth.require_auth()
+def show_search_results(query):
+    if st.session_state.get('search_for') != query:
+        st.session_state.search_for = query
+        st.session_state.search_page = 0
+    page = st.session_state.search_page
     
-    init_session_state()
+    # Fetch one extra row to know whether there is a next page
+    results = db.search_messages(st.session_state.user_id, query, limit=SEARCH_PAGE_SIZE + 1, offset=page * SEARCH_PAGE_SIZE)
+    if not results:
+        st.caption("No matching messages")
+        return
     
-    # Sidebar
-    with st.sidebar:
-        st.markdown(f"### 👋 Welcome, {st.session_state.username}!")
-        auth.show_logout()
-        
-        st.markdown("---")
-        
-        # New Chat button
-        if st.button("➕ New Chat", use_container_width=True):
-            create_new_chat()
+    for message_id, session_id, title, role, snippet, timestamp in results[:SEARCH_PAGE_SIZE]:
+        speaker = "👤" if role == 'user' else "🤖"
+        if st.button(f"💬 {title} · {timestamp[:10]}", key=f"search_{message_id}", use_container_width=True):
+            load_chat_session(session_id)
+            st.rerun()
+        st.caption(f"{speaker} {snippet}")
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        if page > 0 and st.button("◀ Prev", key="search_prev", use_container_width=True):
+            st.session_state.search_page -= 1
+            rerun_fragment()
+    with col2:
+        if len(results) > SEARCH_PAGE_SIZE and st.button("Next ▶", key="search_next", use_container_width=True):
+            st.session_state.search_page += 1
+            rerun_fragment()
+    st.markdown("---")
+
+def show_metrics():
+    """Admin summary of the in-process timing histograms"""
+    histograms, counters = metrics.registry.snapshot()
+    rows = []
+    for name, labels, histogram in histograms:
+        rows.append({
+            'metric': name.replace('cintessa_', ''),
+            'labels': ", ".join(f"{key}={value}" for key, value in labels.items()),
+            'count': histogram.count,
+            'mean': round(histogram.sum / histogram.count, 4) if histogram.count else 0,
+            'p50': round(histogram.quantile(0.5), 4),
+            'p95': round(histogram.quantile(0.95), 4),
+        })
+    st.dataframe(rows, hide_index=True, use_container_width=True)
+    for name, labels, value in counters:
+        st.caption(f"{name.replace('cintessa_', '')} {labels}: {value}")
+    st.download_button("⬇️ Prometheus text", metrics.registry.render_prometheus(),
+                       file_name="metrics.txt", use_container_width=True)
+    if st.button("🔄 Refresh metrics", use_container_width=True):
+        rerun_fragment()
+
+@st.fragment
+def sidebar():
+    """Sidebar controls; reruns on its own unless a change affects the chat area"""
+    # New Chat button
+    if st.button("➕ New Chat", use_container_width=True):
+        create_new_chat()
+    
+    st.markdown("### Chat History")
+    
+    search_query = st.text_input("🔍 Search chats", key="search_query", placeholder="Search messages...")
+    if search_query:
+        show_search_results(search_query)
+    
+    sessions = get_sessions()
+    
+    for session in sessions:
+        session_id, title, created_at, system_prompt, character_image = session
+        btn_label = f"💬 {title}"
+        if st.button(btn_label, key=f"session_{session_id}", use_container_width=True):
+            load_chat_session(session_id)
+            st.rerun()
+    
+    st.markdown("---")
+    
+    # Model selection
+    st.markdown("### AI Model")
+    
+    if st.button("🔄 Refresh Models", use_container_width=True):
+        catalog.refresh()
+    
+    available_models = get_available_models()
+    if catalog.last_error:
+        st.caption("⚠️ Ollama unreachable, showing the last known models")
+    
+    # Model selection dropdown
+    if available_models:
+        current_model = st.session_state.model
+        if current_model in available_models:
+            default_index = available_models.index(current_model)
+        else:
+            default_index = 0
         
-        st.markdown("### Chat History")
-        sessions = db.get_user_sessions(st.session_state.user_id)
+        selected_model = st.selectbox(
+            "Select Model:",
+            available_models,
+            index=default_index,
+            key="model_selector"
+        )
         
-        for session in sessions:
-            session_id, title, created_at, system_prompt, character_image = session
-            btn_label = f"💬 {title}"
-            if st.button(btn_label, key=f"session_{session_id}", use_container_width=True):
-                load_chat_session(session_id)
+        model_details = catalog.get_model(selected_model)
+        if model_details and format_model_details(model_details):
+            st.caption(format_model_details(model_details))
         
-        st.markdown("---")
+        if selected_model != st.session_state.model:
+            st.session_state.model = selected_model
+            # Start loading it now rather than on the first message
+            warmer.preload(selected_model)
+            st.rerun()
+    
+    # Character image selector
+    st.markdown("### Character Image")
+    character_images = get_character_images()
+    current_session = get_current_session_details()
+    current_character = current_session[4] if current_session else 'default.png'
+    
+    selected_character = st.selectbox(
+        "Choose character",
+        character_images,
+        index=character_images.index(current_character) if current_character in character_images else 0,
+        key="character_selector"
+    )
+    
+    if st.session_state.current_session and selected_character != current_character:
+        db.update_session_character(st.session_state.current_session, selected_character)
+        get_sessions(refresh=True)
+        st.rerun()
+    
+    # System prompt - FIXED: Use session_state to track changes
+    st.markdown("### System Prompt")
+    system_prompt = st.text_area(
+        "Custom system prompt for this chat",
+        value=st.session_state.system_prompt,
+        height=150,
+        key="system_prompt_input"
+    )
+    
+    # Update system prompt in session state when user types
+    if system_prompt != st.session_state.system_prompt:
+        st.session_state.system_prompt = system_prompt
+    
+    # Save system prompt button
+    if st.button("💾 Save System Prompt", use_container_width=True) and st.session_state.current_session:
+        db.update_session_system_prompt(st.session_state.current_session, system_prompt)
+        get_sessions(refresh=True)
+        st.session_state.system_prompt = system_prompt
+        st.rerun()
+    
+    if st.session_state.username in ADMIN_USERS:
+        with st.expander("📊 Metrics"):
+            show_metrics()
+    
+    # Things Cintessa should remember about the user across chats
+    with st.expander("🧠 Memory"):
+        memories = db.get_user_memories(st.session_state.user_id)
+        for key, value in memories.items():
+            col1, col2 = st.columns([0.8, 0.2])
+            with col1:
+                st.caption(f"**{key}:** {value}")
+            with col2:
+                if st.button("✖", key=f"forget_{key}"):
+                    db.delete_user_memory(st.session_state.user_id, key)
+                    rerun_fragment()
         
-        # Model selection
-        st.markdown("### AI Model")
+        with st.form("memory_form", clear_on_submit=True):
+            memory_key = st.text_input("Remember (e.g. name)")
+            memory_value = st.text_input("as")
+            if st.form_submit_button("💾 Remember") and memory_key and memory_value:
+                db.set_user_memory(st.session_state.user_id, memory_key.strip(), memory_value.strip())
+                rerun_fragment()
+    
+    # Download of the user's own chats; backup.py handles whole-database exports
+    with st.expander("💾 Export Chats"):
+        if st.button("Prepare export", use_container_width=True):
+            import backup
+            import io
+            # st.download_button serves its data from memory, so the whole
+            # export is held in memory while it is offered, which is why it is
+            # capped. It is offered in this run only, so no copy stays in
+            # session state.
+            export = io.BytesIO()
+            for line in backup.export_lines(db, st.session_state.user_id):
+                export.write(line.encode('utf-8'))
+                if export.tell() > CHAT_EXPORT_MAX_BYTES:
+                    st.warning(f"📦 Your chats are over {CHAT_EXPORT_MAX_BYTES / 1024 / 1024:.0f} MB, "
+                               "too large to download here. An administrator can export them with backup.py.")
+                    break
+            else:
+                st.download_button(
+                    "⬇️ Download JSONL",
+                    export.getvalue(),
+                    file_name=f"cintessa-{st.session_state.username}.jsonl",
+                    mime="application/jsonl",
+                    use_container_width=True
+                )
+
+@st.fragment(run_every=MODEL_STATUS_INTERVAL)
+def model_status():
+    """Whether the current model is in memory, refreshed while it loads"""
+    model = st.session_state.model
+    status = warmer.status(model)
+    if status == 'loading':
+        st.caption("⏳ Loading the model into memory...")
+    elif status == 'loaded':
+        load_seconds = warmer.load_seconds.get(model)
+        st.caption(f"🔥 Model loaded in {load_seconds:.1f}s" if load_seconds else "🔥 Model loaded")
+    elif status == 'failed':
+        st.caption(f"⚠️ Model failed to load: {warmer.errors.get(model)}")
+    else:
+        st.caption("❄️ Model not loaded yet, the first reply will wait for it")
+
+def rerun_fragment():
+    """Rerun only the calling fragment, or the whole app during a full run"""
+    try:
+        st.rerun(scope="fragment")
+    except StreamlitAPIException:
+        st.rerun()
+
+@st.fragment
+def chat_area():
+    """Messages added since the last full run, plus the chat input.
+    
+    Sending a message only reruns this fragment, so the cost of a turn does
+    not depend on how much history is already on the page.
+    """
+    for message in st.session_state.messages:
+        if message['id'] > st.session_state.rendered_upto_id:
+            render_message(message)
+    
+    if st.session_state.last_ttft is not None:
+        caption = f"⚡ Last reply: first token in {st.session_state.last_ttft:.2f}s"
+        if st.session_state.last_load_seconds > metrics.COLD_LOAD_SECONDS:
+            caption += f", including a {st.session_state.last_load_seconds:.1f}s model load"
+        st.caption(caption)
+    
+    # Auto-scroll
+    if len(st.session_state.messages) > 0:
+        st.markdown("<script>window.scrollTo(0, document.body.scrollHeight);</script>", unsafe_allow_html=True)
+    
+    # Chat input - FIXED: Check if we have a current session
+    st.markdown("---")
+    
+    if not st.session_state.current_session:
+        st.warning("⚠️ Please create a new chat or select an existing one from the sidebar.")
+        return
+    
+    user_input = st.chat_input("Type your message here...")
+    
+    if user_input and st.session_state.active_job is None:
+        # Turn the message away now rather than leave it waiting behind a full queue
+        try:
+            job_queue.check_capacity(st.session_state.user_id)
+        except Overloaded as e:
+            st.warning(f"🚦 {e}")
+            return
         
-        if st.button("🔄 Refresh Models", use_container_width=True):
-            st.session_state.models_loaded = False
-            st.session_state.available_models = []
-            st.rerun()
+        # Add user message
+        append_message('user', user_input)
+        render_message(st.session_state.messages[-1])
         
-        # Load models
-        if not st.session_state.models_loaded or not st.session_state.available_models:
-            available_models = get_available_models()
-            st.session_state.available_models = available_models
-            st.session_state.models_loaded = True
-        else:
-            available_models = st.session_state.available_models
+        # Get the current system prompt
+        system_prompt = st.session_state.system_prompt
         
-        # Model selection dropdown
-        if available_models:
-            current_model = st.session_state.model
-            if current_model in available_models:
-                default_index = available_models.index(current_model)
-            else:
-                default_index = 0
-            
-            selected_model = st.selectbox(
-                "Select Model:",
-                available_models,
-                index=default_index,
-                key="model_selector"
+        # Prepare messages for Ollama within the model's token budget
+        with span('cintessa_chat_stage_seconds', stage='build_context'):
+            messages = context.build_context(
+                db,
+                st.session_state.current_session,
+                st.session_state.model,
+                system_prompt,
+                st.session_state.messages,
+                offset=st.session_state.message_offset,
+                user_id=st.session_state.user_id
             )
-            
-            if selected_model != st.session_state.model:
-                st.session_state.model = selected_model
-                st.success(f"✅ Model changed to: {selected_model}")
         
-        # Character image selector
-        st.markdown("### Character Image")
-        character_images = get_character_images()
-        current_session = get_current_session_details()
-        current_character = current_session[4] if current_session else 'default.png'
-        
-        selected_character = st.selectbox(
-            "Choose character",
-            character_images,
-            index=character_images.index(current_character) if current_character in character_images else 0,
-            key="character_selector"
-        )
+        # Queue the reply; a worker generates it and saves it to the session
+        with span('cintessa_chat_stage_seconds', stage='submit'):
+            try:
+                st.session_state.active_job = job_queue.submit(
+                    st.session_state.user_id,
+                    st.session_state.current_session,
+                    st.session_state.model,
+                    messages
+                )
+            except Overloaded as e:
+                st.warning(f"🚦 {e}")
+                return
+    
+    # Get AI response
+    if st.session_state.active_job is not None:
+        # Clicking reruns this fragment, which interrupts follow_job below
+        stop = st.empty()
+        if stop.button("⏹️ Stop generating", key="stop_generating"):
+            job_queue.cancel(st.session_state.active_job)
+        with span('cintessa_chat_stage_seconds', stage='render_reply'):
+            job = follow_job(st.session_state.active_job, st.empty())
+        stop.empty()
+        st.session_state.active_job = None
+        if job is None:
+            return
         
-        if st.session_state.current_session and selected_character != current_character:
-            db.update_session_character(st.session_state.current_session, selected_character)
-            st.rerun()
+        # The worker saved whatever arrived, even if the stream broke part way
+        if job.message_id:
+            append_message('assistant', job.content, message_id=job.message_id)
         
-        # System prompt - FIXED: Use session_state to track changes
-        st.markdown("### System Prompt")
-        system_prompt = st.text_area(
-            "Custom system prompt for this chat",
-            value=st.session_state.system_prompt,
-            height=150,
-            key="system_prompt_input"
-        )
+        if job.status == 'cancelled':
+            st.caption("⏹️ Stopped" + (", partial reply saved" if job.content else ""))
+        elif job.error:
+            if job.content:
+                st.error(f"❌ Response interrupted, partial reply saved: {job.error}")
+            else:
+                st.error(f"❌ Error getting response: {job.error}")
+        else:
+            if job.first_token_at:
+                st.session_state.last_ttft = job.first_token_at - job.created_at
+                st.session_state.last_load_seconds = job.load_seconds
+            rerun_fragment()
+
+def main():
+    auth.require_auth()
+    
+    init_session_state()
+    
+    # Sidebar
+    with st.sidebar:
+        st.markdown(f"### 👋 Welcome, {st.session_state.username}!")
+        auth.show_logout()
         
-        # Update system prompt in session state when user types
-        if system_prompt != st.session_state.system_prompt:
-            st.session_state.system_prompt = system_prompt
+        st.markdown("---")
         
-        # Save system prompt button
-        if st.button("💾 Save System Prompt", use_container_width=True) and st.session_state.current_session:
-            db.update_session_system_prompt(st.session_state.current_session, system_prompt)
-            st.success("✅ System prompt updated!")
-            st.session_state.system_prompt = system_prompt
+        sidebar()
     
     # Main chat area
     st.markdown('<div class="main-header">🤖 AGENT 1 CINTESSA</div>', unsafe_allow_html=True)
     
     # Display current model info
     st.markdown(f"**Current Model:** `{st.session_state.model}`")
+    model_status()
     
     # Display current system prompt preview
     if st.session_state.system_prompt:
@@ -326,80 +709,38 @@ def main():
             st.text(st.session_state.system_prompt[:200] + "..." if len(st.session_state.system_prompt) > 200 else st.session_state.system_prompt)
     
     # Display character image if available
+    current_session = get_current_session_details()
     if current_session:
         character_image = current_session[4]
         character_path = os.path.join('character_images', character_image)
         if os.path.exists(character_path):
-            st.image(character_path, width=100, caption="Current Character", use_column_width=False)
+            st.image(get_thumbnail(character_path), width=100, caption="Current Character")
     
-    # Chat messages display
+    # Chat messages display; a full run renders everything loaded so far and
+    # chat_area() only renders what is appended after this point
     chat_container = st.container()
     
     with chat_container:
-        for i, message in enumerate(st.session_state.messages):
-            if message['role'] == 'user':
-                st.markdown(f"""
-                <div class="message-user">
-                    <strong>👤 YOU:</strong><br>
-                    {message['content']}
-                </div>
-                """, unsafe_allow_html=True)
-            else:
-                col1, col2 = st.columns([0.9, 0.1])
-                with col1:
-                    st.markdown(f"""
-                    <div class="message-assistant">
-                        <strong>🤖 CINTESSA:</strong><br>
-                        {message['content']}
-                    </div>
-                    """, unsafe_allow_html=True)
-                with col2:
-                    if st.button("📋", key=f"copy_{i}"):
-                        st.code(message['content'])
-    
-    # Auto-scroll
-    if len(st.session_state.messages) > 0:
-        st.markdown("<script>window.scrollTo(0, document.body.scrollHeight);</script>", unsafe_allow_html=True)
+        if st.session_state.has_older_messages:
+            if st.button("⬆️ Load older messages", key="load_older"):
+                load_older_messages()
+                st.rerun()
+        
+        for message in st.session_state.messages:
+            render_message(message)
     
-    # Chat input - FIXED: Check if we have a current session
-    st.markdown("---")
+    st.session_state.rendered_upto_id = st.session_state.messages[-1]['id'] if st.session_state.messages else 0
     
-    if not st.session_state.current_session:
-        st.warning("⚠️ Please create a new chat or select an existing one from the sidebar.")
-    else:
-        user_input = st.chat_input("Type your message here...")
-        
-        if user_input:
-            # Add user message
-            st.session_state.messages.append({'role': 'user', 'content': user_input})
-            db.add_message(st.session_state.current_session, 'user', user_input)
-            
-            # Get the current system prompt
-            system_prompt = st.session_state.system_prompt
-            
-            # Prepare messages for Ollama
-            messages = []
-            if system_prompt:
-                messages.append({'role': 'system', 'content': system_prompt})
-            messages.extend(st.session_state.messages)
-            
-            # Get AI response
-            with st.spinner("Cintessa is thinking..."):
-                try:
-                    response = ollama.chat(
-                        model=st.session_state.model,
-                        messages=messages,
-                        stream=False
-                    )
-                    ai_response = response['message']['content']
-                    
-                    # Add AI response
-                    st.session_state.messages.append({'role': 'assistant', 'content': ai_response})
-                    db.add_message(st.session_state.current_session, 'assistant', ai_response)
-                    st.rerun()
-                    
-                except Exception as e:
-                    st.error(f"❌ Error getting response: {str(e)}")
+    chat_area()
 
 if __name__ == "__main__":
-    main()
+    metrics.start_http_server()
+    metrics.start_persisting(db)
+    start_archiver(db)
+    # Take over jobs left by a stopped process without waiting for a new message
+    job_queue.start()
+    try:
+        with span('cintessa_render_seconds'), startup.phase('first render'):
+            main()
+    finally:
+        startup.print_once()
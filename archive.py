@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""Move idle chat sessions out of the hot messages table.
+
+Sessions with no messages for ARCHIVE_AFTER_DAYS are compressed into
+session_archive, one row per session, and the freed pages are returned with
+an incremental vacuum. Opening an archived session restores it.
+
+A SQLite database created before incremental vacuuming was enabled is only
+converted (with a full VACUUM that blocks writes) when this script runs; the
+background archiver leaves such databases as they are.
+
+    python archive.py --days 30
+"""
+import argparse
+import os
+import threading
+import time
+
+if __name__ == "__main__":
+    # Run as a script, so read .env before the settings below
+    from dotenv import load_dotenv
+    load_dotenv()
+
+# Archive sessions idle for this many days; 0 disables the background archiver
+ARCHIVE_AFTER_DAYS = float(os.getenv('ARCHIVE_AFTER_DAYS', '0'))
+ARCHIVE_INTERVAL = float(os.getenv('ARCHIVE_INTERVAL', '3600'))
+# Sessions archived per pass before yielding, so chat writes aren't held up
+ARCHIVE_BATCH = int(os.getenv('ARCHIVE_BATCH', '50'))
+
+def archive_idle_sessions(db, idle_days=ARCHIVE_AFTER_DAYS, batch=ARCHIVE_BATCH, convert=False):
+    """Archive every session idle for idle_days, then reclaim the space.
+    
+    convert allows the one-off full VACUUM reclaiming needs on older databases.
+    
+    Returns (sessions, messages, raw_bytes, compressed_bytes, pages_freed).
+    """
+    cutoff = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(time.time() - idle_days * 86400))
+    sessions = messages = raw_bytes = compressed_bytes = 0
+    while True:
+        session_ids = db.get_idle_sessions(cutoff, limit=batch)
+        if not session_ids:
+            break
+        for session_id in session_ids:
+            count, raw, compressed = db.archive_session(session_id)
+            sessions += 1
+            messages += count
+            raw_bytes += raw
+            compressed_bytes += compressed
+    pages_freed = db.reclaim_space(convert=convert) if sessions or convert else 0
+    return sessions, messages, raw_bytes, compressed_bytes, pages_freed
+
+_started = False
+_start_lock = threading.Lock()
+
+def start_archiver(db, idle_days=ARCHIVE_AFTER_DAYS, interval=ARCHIVE_INTERVAL):
+    """Archive idle sessions every interval seconds in a daemon thread, once per process"""
+    global _started
+    if idle_days <= 0 or interval <= 0:
+        return
+    with _start_lock:
+        if _started:
+            return
+        _started = True
+    
+    def run():
+        while True:
+            try:
+                sessions, messages, raw_bytes, compressed_bytes, _ = archive_idle_sessions(db, idle_days)
+                if sessions:
+                    print(f"🗄️ Archived {sessions} idle sessions ({messages} messages, "
+                          f"{raw_bytes / 1024:.0f} KB -> {compressed_bytes / 1024:.0f} KB)")
+            except Exception as e:
+                print(f"Error archiving sessions: {e}")
+            time.sleep(interval)
+    
+    threading.Thread(target=run, name="archiver", daemon=True).start()
+
+def main():
+    parser = argparse.ArgumentParser(description="Archive idle Agent 1 Cintessa chat sessions")
+    parser.add_argument('--days', type=float, default=ARCHIVE_AFTER_DAYS or 30,
+                        help="archive sessions with no messages for this many days")
+    parser.add_argument('--batch', type=int, default=ARCHIVE_BATCH)
+    args = parser.parse_args()
+    
+    from database import db
+    
+    start = time.perf_counter()
+    sessions, messages, raw_bytes, compressed_bytes, pages_freed = archive_idle_sessions(db, args.days, args.batch, convert=True)
+    print(f"🗄️ Archived {sessions} sessions ({messages} messages), "
+          f"{raw_bytes / 1024:.0f} KB compressed to {compressed_bytes / 1024:.0f} KB, "
+          f"{pages_freed} pages freed in {time.perf_counter() - start:.1f}s")
+
+if __name__ == "__main__":
+    main()
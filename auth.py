@@ -1,13 +1,36 @@
+import json
 import streamlit as st
-from database import db
+import streamlit.components.v1 as components
+from database import db, AUTH_TOKEN_TTL
+
+# Cookie carrying the signed login token
+TOKEN_COOKIE = "cintessa_token"
+# Query parameter older versions kept the token in; URLs leak through history,
+# shared links and Referer headers, so tokens found there are revoked
+TOKEN_PARAM = "token"
 
 def init_auth():
     if 'user_id' not in st.session_state:
         st.session_state.user_id = None
     if 'username' not in st.session_state:
         st.session_state.username = None
+    if 'auth_token' not in st.session_state:
+        st.session_state.auth_token = None
+
+def write_token_cookie(token, max_age):
+    """Set (or with max_age 0, clear) the login cookie in the browser"""
+    # Streamlit can read cookies but not set them. The component's iframe is
+    # same-origin with the app, so its script sets the cookie on the page.
+    components.html(f"""<script>
+        const page = window.parent;
+        page.document.cookie = {json.dumps(TOKEN_COOKIE)} + "=" + {json.dumps(token)}
+            + "; Max-Age={int(max_age)}; Path=/; SameSite=Strict"
+            + (page.location.protocol === "https:" ? "; Secure" : "");
+    </script>""", height=0)
 
 def show_login():
+    if st.session_state.get('clear_token_cookie'):
+        write_token_cookie("", 0)
     st.title("🔐 Agent 1 Cintessa - Login")
     
     tab1, tab2 = st.tabs(["Login", "Sign Up"])
@@ -23,6 +46,9 @@ def show_login():
                 if user_id:
                     st.session_state.user_id = user_id
                     st.session_state.username = username
+                    # Lets a refresh or restart restore the login without bcrypt
+                    st.session_state.auth_token = db.create_auth_token(user_id)
+                    st.session_state.clear_token_cookie = False
                     st.success(f"Welcome back, {username}!")
                     st.rerun()
                 else:
@@ -51,12 +77,41 @@ def show_login():
 
 def show_logout():
     if st.sidebar.button("Logout"):
+        if st.session_state.auth_token:
+            db.revoke_auth_token(st.session_state.auth_token)
         st.session_state.user_id = None
         st.session_state.username = None
+        st.session_state.auth_token = None
+        st.session_state.clear_token_cookie = True
         st.session_state.current_session = None
         st.rerun()
 
+def restore_login():
+    """Log in from the login cookie, if its token is still valid"""
+    leaked = st.query_params.get(TOKEN_PARAM)
+    if leaked:
+        db.revoke_auth_token(leaked)
+        del st.query_params[TOKEN_PARAM]
+    
+    # Cookies are those sent when the browser connected
+    token = st.context.cookies.get(TOKEN_COOKIE)
+    if not token:
+        return
+    user = db.verify_auth_token(token)
+    if user:
+        st.session_state.user_id, st.session_state.username = user
+        st.session_state.auth_token = token
+    else:
+        st.session_state.clear_token_cookie = True
+
 def require_auth():
+    if st.session_state.user_id is None:
+        restore_login()
     if st.session_state.user_id is None:
         show_login()
         st.stop()
+    # Rendered on every run until the browser reconnects with the cookie; an
+    # unchanged component is not reloaded, so the script runs once
+    token = st.session_state.auth_token
+    if token and st.context.cookies.get(TOKEN_COOKIE) != token:
+        write_token_cookie(token, AUTH_TOKEN_TTL)
@@ -0,0 +1,305 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+import httpx
+
+# Comma-separated Ollama hosts, e.g. "http://gpu1:11434,http://gpu2:11434".
+# Falls back to OLLAMA_HOST for single-host setups.
+OLLAMA_HOSTS = os.getenv('OLLAMA_HOSTS') or os.getenv('OLLAMA_HOST', 'http://localhost:11434')
+HEALTH_CHECK_INTERVAL = float(os.getenv('HEALTH_CHECK_INTERVAL', '10'))
+BACKEND_TIMEOUT = float(os.getenv('BACKEND_TIMEOUT', '300'))
+# A host that doesn't accept a connection this quickly is treated as down, and
+# health checks and model listings give up after HEALTH_CHECK_TIMEOUT
+BACKEND_CONNECT_TIMEOUT = float(os.getenv('BACKEND_CONNECT_TIMEOUT', '5'))
+HEALTH_CHECK_TIMEOUT = float(os.getenv('HEALTH_CHECK_TIMEOUT', '5'))
+
+# A session sticks to the host holding its prompt cache unless that host has
+# this many more requests in flight than the least busy one
+AFFINITY_MAX_EXTRA_LOAD = int(os.getenv('AFFINITY_MAX_EXTRA_LOAD', '2'))
+AFFINITY_MAX_ENTRIES = 4096
+
+# Errors meaning the host itself is unreachable, as opposed to a bad request
+CONNECTION_ERRORS = (ConnectionError, httpx.TransportError)
+
+class NoBackendAvailable(ConnectionError):
+    pass
+
+class DeadlineExceeded(TimeoutError):
+    """Raised when a host sends nothing before the caller's deadline"""
+
+# Monotonic time by which the request this thread is sending must be answered
+_deadline = threading.local()
+
+def _apply_deadline(request):
+    # httpx takes its timeouts from the request's extensions, so a hook can cut
+    # the read timeout down to whatever is left of the caller's deadline
+    deadline = getattr(_deadline, 'at', None)
+    if deadline is None:
+        return
+    timeout = dict(request.extensions.get('timeout') or {})
+    remaining = max(deadline - time.monotonic(), 0.001)
+    timeout['read'] = min(timeout.get('read') or remaining, remaining)
+    request.extensions['timeout'] = timeout
+
+def _names(response):
+    entries = response['models'] if 'models' in response else response
+    return {entry['model'] if 'model' in entry else entry['name'] for entry in entries}
+
+class Backend:
+    def __init__(self, host, timeout=BACKEND_TIMEOUT):
+        self.host = host
+        self.timeout = timeout
+        self._client = None
+        self._probe_client = None
+        # Optimistic until the first health check says otherwise
+        self.healthy = True
+        self.outstanding = 0
+        # model -> requests for it in flight on this host
+        self.active = {}
+        # Installed models, and those currently loaded in memory (per /api/ps)
+        self.models = set()
+        self.loaded_models = set()
+        self.last_error = None
+        self.checked_at = 0.0
+    
+    @property
+    def client(self):
+        # The ollama package is slow to import, so wait until a request needs it
+        if self._client is None:
+            import ollama
+            # Replies may be slow to start, but connecting should never be
+            timeout = httpx.Timeout(self.timeout, connect=min(BACKEND_CONNECT_TIMEOUT, self.timeout))
+            self._client = ollama.Client(host=self.host, timeout=timeout,
+                                         event_hooks={'request': [_apply_deadline]})
+        return self._client
+    
+    @property
+    def probe_client(self):
+        """Client for health checks and model listings, which a live host answers at once"""
+        if self._probe_client is None:
+            import ollama
+            self._probe_client = ollama.Client(host=self.host, timeout=min(HEALTH_CHECK_TIMEOUT, self.timeout))
+        return self._probe_client
+
+class BackendPool:
+    """Routes Ollama requests across several hosts.
+    
+    Requests go to a healthy host that has the model, preferring hosts that
+    already have it loaded and then the fewest outstanding requests. A host
+    that fails to connect is marked down and the request fails over to the
+    next candidate; the periodic health check brings it back.
+    """
+    
+    def __init__(self, hosts, health_check_interval=HEALTH_CHECK_INTERVAL, timeout=BACKEND_TIMEOUT):
+        self.backends = [Backend(host, timeout) for host in hosts]
+        self.health_check_interval = health_check_interval
+        self._lock = threading.Lock()
+        self._checker = None
+        # (affinity key, model) -> backend that last served it
+        self._affinity = OrderedDict()
+    
+    def check(self, backend):
+        try:
+            models = _names(backend.probe_client.list())
+            loaded = _names(backend.probe_client.ps())
+        except Exception as e:
+            backend.healthy = False
+            backend.last_error = str(e)
+        else:
+            backend.models = models
+            backend.loaded_models = loaded
+            backend.healthy = True
+            backend.last_error = None
+        backend.checked_at = time.monotonic()
+    
+    def check_all(self):
+        for backend in self.backends:
+            self.check(backend)
+    
+    def start(self):
+        """Start the periodic health checker"""
+        if self._checker is not None or self.health_check_interval <= 0:
+            return
+        with self._lock:
+            if self._checker is None:
+                self._checker = threading.Thread(target=self._check_loop, daemon=True)
+                self._checker.start()
+    
+    def _check_loop(self):
+        while True:
+            self.check_all()
+            time.sleep(self.health_check_interval)
+    
+    def candidates(self, model, affinity=None):
+        """Backends to try for model, best first.
+        
+        With an affinity key (such as a session id), the backend that served
+        it last comes first while it is healthy and not much busier than the rest.
+        """
+        self.start()
+        healthy = [b for b in self.backends if b.healthy]
+        # With every host marked down, try them all rather than fail without asking
+        pool = healthy or list(self.backends)
+        with self._lock:
+            ordered = sorted(pool, key=lambda b: (
+                model not in b.loaded_models,
+                bool(b.models) and model not in b.models,
+                b.outstanding
+            ))
+            pinned = self._affinity.get((affinity, model)) if affinity is not None else None
+            least_busy = min((b.outstanding for b in ordered), default=0)
+            if pinned in ordered and pinned.outstanding - least_busy <= AFFINITY_MAX_EXTRA_LOAD:
+                ordered.remove(pinned)
+                ordered.insert(0, pinned)
+            return ordered
+    
+    def _pin(self, affinity, model, backend):
+        if affinity is None:
+            return
+        with self._lock:
+            self._affinity[(affinity, model)] = backend
+            self._affinity.move_to_end((affinity, model))
+            while len(self._affinity) > AFFINITY_MAX_ENTRIES:
+                self._affinity.popitem(last=False)
+    
+    @contextmanager
+    def _track(self, backend, model):
+        with self._lock:
+            backend.outstanding += 1
+            backend.active[model] = backend.active.get(model, 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                backend.outstanding -= 1
+                backend.active[model] -= 1
+                if not backend.active[model]:
+                    del backend.active[model]
+    
+    def _mark_down(self, backend, error):
+        print(f"❌ Ollama backend {backend.host} unreachable: {error}")
+        backend.healthy = False
+        backend.last_error = str(error)
+    
+    def chat(self, model, messages, stream=False, affinity=None, **kwargs):
+        if stream:
+            return self._stream_chat(model, messages, affinity, **kwargs)
+        
+        for backend in self.candidates(model, affinity):
+            with self._track(backend, model):
+                try:
+                    response = backend.client.chat(model=model, messages=messages, stream=False, **kwargs)
+                except CONNECTION_ERRORS as e:
+                    self._mark_down(backend, e)
+                    continue
+            backend.loaded_models.add(model)
+            self._pin(affinity, model, backend)
+            return response
+        raise NoBackendAvailable(f"No Ollama backend reachable for {model}")
+    
+    def _stream_chat(self, model, messages, affinity=None, deadline=None, **kwargs):
+        # Failover is only possible until the first chunk has been handed out.
+        # With a deadline, the read timeout is cut to the time left, so a hung
+        # host cannot hold the stream open until BACKEND_TIMEOUT.
+        for backend in self.candidates(model, affinity):
+            with self._track(backend, model):
+                stream = backend.client.chat(model=model, messages=messages, stream=True, **kwargs)
+                # The request is only sent once the first chunk is asked for
+                _deadline.at = deadline
+                try:
+                    first = next(stream)
+                except StopIteration:
+                    return
+                except httpx.ReadTimeout as e:
+                    if deadline is not None and time.monotonic() >= deadline:
+                        # Slow, not down: a long load or prompt is no reason to fail over
+                        raise DeadlineExceeded(f"{backend.host} sent nothing for {model} before the deadline") from e
+                    self._mark_down(backend, e)
+                    continue
+                except CONNECTION_ERRORS as e:
+                    self._mark_down(backend, e)
+                    continue
+                finally:
+                    _deadline.at = None
+                backend.loaded_models.add(model)
+                self._pin(affinity, model, backend)
+                yield first
+                yield from stream
+                return
+        raise NoBackendAvailable(f"No Ollama backend reachable for {model}")
+    
+    def preload(self, model, keep_alive=None):
+        """Load model into memory on the best backend without generating anything"""
+        for backend in self.candidates(model):
+            with self._track(backend, model):
+                try:
+                    # An empty prompt makes Ollama load the model and return
+                    response = backend.client.generate(model=model, prompt='', keep_alive=keep_alive)
+                except CONNECTION_ERRORS as e:
+                    self._mark_down(backend, e)
+                    continue
+            backend.loaded_models.add(model)
+            return response
+        raise NoBackendAvailable(f"No Ollama backend reachable for {model}")
+    
+    def embed(self, model, inputs):
+        """Embedding vectors for each of inputs, from the best backend"""
+        for backend in self.candidates(model):
+            with self._track(backend, model):
+                try:
+                    response = backend.client.embed(model=model, input=inputs)
+                except CONNECTION_ERRORS as e:
+                    self._mark_down(backend, e)
+                    continue
+            backend.loaded_models.add(model)
+            return response['embeddings']
+        raise NoBackendAvailable(f"No Ollama backend reachable for {model}")
+    
+    def unload(self, model):
+        """Ask every backend holding model in memory, and not serving it right now, to release it.
+        
+        Returns the number of backends that released it.
+        """
+        released = 0
+        for backend in self.backends:
+            with self._lock:
+                busy = model in backend.active
+            if busy or model not in backend.loaded_models:
+                continue
+            try:
+                backend.client.generate(model=model, prompt='', keep_alive=0)
+            except CONNECTION_ERRORS as e:
+                self._mark_down(backend, e)
+                continue
+            backend.loaded_models.discard(model)
+            released += 1
+        return released
+    
+    def list_models(self):
+        """ollama.list()-style response with the models of every reachable backend"""
+        self.start()
+        models = {}
+        errors = []
+        for backend in self.backends:
+            try:
+                response = backend.probe_client.list()
+            except CONNECTION_ERRORS as e:
+                self._mark_down(backend, e)
+                errors.append(e)
+                continue
+            backend.healthy = True
+            entries = response['models'] if 'models' in response else response
+            backend.models = set()
+            for entry in entries:
+                name = entry['model'] if 'model' in entry else entry['name']
+                backend.models.add(name)
+                models.setdefault(name, entry)
+        
+        if errors and len(errors) == len(self.backends):
+            raise NoBackendAvailable(f"No Ollama backend reachable: {errors[0]}")
+        return {'models': list(models.values())}
+
+# Global backend pool
+pool = BackendPool([host.strip() for host in OLLAMA_HOSTS.split(',') if host.strip()])
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""Stream users, chat sessions and messages to JSONL and back.
+
+    python backup.py export backup.jsonl [--user NAME] [--resume]
+    python backup.py import backup.jsonl [--resume]
+
+Each line is one record: users first, then every session followed by its
+messages, in id order. Both directions read through cursors and write in
+chunks, so memory stays flat however large the history is. An interrupted
+export resumes after the last complete line; an interrupted import resumes
+from the last committed chunk. Imported sessions and messages get new ids,
+so an import adds to whatever chats the database already has; importing the
+same file twice imports it twice.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+if __name__ == "__main__":
+    # Run as a script, so read .env before the settings below
+    from dotenv import load_dotenv
+    load_dotenv()
+
+# Rows per import transaction
+IMPORT_BATCH = int(os.getenv('IMPORT_BATCH', '5000'))
+WRITE_BUFFER_BYTES = 1024 * 1024
+
+def iter_records(db, user_id=None, after=None, credentials=True):
+    """Yield export records as dicts.
+    
+    after is (session_id, message_id) of the last record already exported;
+    the users and everything up to that point are skipped. Without
+    credentials, user records leave out the password hash and importing
+    them only matches existing accounts.
+    """
+    if after is None:
+        for _, username, password_hash, created_at in db.iter_users(user_id):
+            record = {'type': 'user', 'username': username, 'created_at': created_at}
+            if credentials:
+                record['password_hash'] = password_hash.decode('ascii') if isinstance(password_hash, bytes) else password_hash
+            yield record
+        after_session = 0
+    else:
+        # Finish the session the previous run stopped in
+        after_session, after_message = after
+        for record in _message_records(db, after_session, after_message):
+            yield record
+    
+    for session_id, username, title, created_at, system_prompt, character_image in db.iter_sessions(user_id, after_session):
+        yield {
+            'type': 'session', 'id': session_id, 'user': username, 'title': title,
+            'created_at': created_at, 'system_prompt': system_prompt, 'character_image': character_image,
+        }
+        yield from _message_records(db, session_id)
+
+def _message_records(db, session_id, after_id=0):
+    for message_id, role, content, timestamp in db.iter_session_messages(session_id, after_id):
+        yield {
+            'type': 'message', 'id': message_id, 'session_id': session_id,
+            'role': role, 'content': content, 'timestamp': timestamp,
+        }
+
+def _resume_point(path):
+    """Drop a partial last line and return the (session_id, message_id) to continue after, if any"""
+    with open(path, 'r+b') as f:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        # Step back to the start of the last complete line
+        position = end
+        tail = b''
+        while position > 0:
+            step = min(65536, position)
+            position -= step
+            f.seek(position)
+            tail = f.read(step) + tail
+            if tail.count(b'\n') >= 2 or position == 0:
+                break
+        complete = tail[:tail.rfind(b'\n') + 1]
+        f.truncate(position + len(complete))
+        lines = complete.splitlines()
+    if not lines:
+        return None
+    last = json.loads(lines[-1])
+    if last['type'] == 'session':
+        return last['id'], 0
+    if last['type'] == 'message':
+        return last['session_id'], last['id']
+    # Stopped among the users, which are cheap to write again
+    return None
+
+def export_jsonl(db, path, user_id=None, resume=False):
+    """Write records to path; returns the number of lines written"""
+    after = _resume_point(path) if resume and os.path.exists(path) else None
+    mode = 'a' if after else 'w'
+    
+    db.flush()
+    count = 0
+    with open(path, mode, encoding='utf-8', buffering=WRITE_BUFFER_BYTES) as out:
+        for record in iter_records(db, user_id, after):
+            out.write(json.dumps(record, ensure_ascii=False))
+            out.write('\n')
+            count += 1
+    return count
+
+def _import_resume_point(value):
+    """(offset, session id map) from a saved import checkpoint"""
+    state = json.loads(value)
+    if isinstance(state, int):
+        # Saved before imports remapped ids
+        return state, {}
+    session_ids = {state['session'][0]: state['session'][1]} if 'session' in state else {}
+    return state['offset'], session_ids
+
+def import_jsonl(db, path, resume=False, batch=IMPORT_BATCH):
+    """Load a JSONL export into db; returns (sessions, messages) imported"""
+    checkpoint = f"import_offset:{os.path.abspath(path)}"
+    offset, session_ids = 0, {}
+    if resume:
+        offset, session_ids = _import_resume_point(db.get_setting(checkpoint, '0'))
+    user_ids = {}
+    sessions, messages = [], []
+    session_count = message_count = 0
+    last_session = next(iter(session_ids), None)
+    
+    def user_id_for(username):
+        if username not in user_ids:
+            user_ids[username] = db.get_user_id(username)
+        return user_ids[username]
+    
+    def progress(ids):
+        # Messages follow their session, so a resumed run only needs the last one
+        state = {'offset': offset}
+        if last_session in ids:
+            state['session'] = [last_session, ids[last_session]]
+        return checkpoint, json.dumps(state)
+    
+    def flush():
+        nonlocal session_ids, session_count, message_count
+        session_total, message_total = db.import_batch(sessions, messages, session_ids, progress)
+        session_count += session_total
+        message_count += message_total
+        # Keep the map small: earlier sessions will not be referenced again
+        session_ids = {last_session: session_ids[last_session]} if last_session in session_ids else {}
+    
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b'\n'):
+                # A partial line from an export still being written
+                break
+            offset += len(line)
+            record = json.loads(line)
+            kind = record['type']
+            if kind == 'user':
+                if 'password_hash' in record:
+                    user_ids[record['username']] = db.import_user(
+                        record['username'], record['password_hash'].encode('ascii'), record['created_at']
+                    )
+                continue
+            if kind == 'session':
+                sessions.append((
+                    record['id'], user_id_for(record['user']), record['title'], record['created_at'],
+                    record['system_prompt'], record['character_image']
+                ))
+                last_session = record['id']
+            elif kind == 'message':
+                messages.append((record['session_id'], record['role'], record['content'], record['timestamp']))
+            
+            if len(sessions) + len(messages) >= batch:
+                flush()
+                sessions, messages = [], []
+    
+    flush()
+    return session_count, message_count
+
+def export_lines(db, user_id):
+    """One user's sessions as JSONL text lines, without credentials, for the in-app download"""
+    for record in iter_records(db, user_id, credentials=False):
+        yield json.dumps(record, ensure_ascii=False) + '\n'
+
+def main():
+    parser = argparse.ArgumentParser(description="Export or import Agent 1 Cintessa chat history as JSONL")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    export_parser = subparsers.add_parser('export', help="write users, sessions and messages to a JSONL file")
+    export_parser.add_argument('path')
+    export_parser.add_argument('--user', help="only export this username")
+    export_parser.add_argument('--resume', action='store_true', help="continue an interrupted export")
+    import_parser = subparsers.add_parser('import', help="load a JSONL export into the database")
+    import_parser.add_argument('path')
+    import_parser.add_argument('--resume', action='store_true', help="continue an interrupted import")
+    import_parser.add_argument('--batch', type=int, default=IMPORT_BATCH, help="rows per transaction")
+    args = parser.parse_args()
+    
+    from database import db
+    
+    start = time.perf_counter()
+    if args.command == 'export':
+        user_id = None
+        if args.user:
+            user_id = db.get_user_id(args.user)
+            if user_id is None:
+                print(f"❌ No such user: {args.user}")
+                sys.exit(1)
+        count = export_jsonl(db, args.path, user_id, args.resume)
+        print(f"💾 Exported {count} records to {args.path} in {time.perf_counter() - start:.1f}s")
+    else:
+        sessions, messages = import_jsonl(db, args.path, args.resume, args.batch)
+        print(f"📥 Imported {sessions} sessions and {messages} messages from {args.path} "
+              f"in {time.perf_counter() - start:.1f}s")
+
+if __name__ == "__main__":
+    main()
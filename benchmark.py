@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+"""End-to-end load test against a stand-in Ollama server.
+
+Seeds a throwaway database with synthetic users and sessions, then drives
+concurrent simulated users through login, opening a session, sending a
+message and paging through history using the real Database, context and
+job queue code. Reports latency percentiles and throughput per stage.
+
+    python benchmark.py --users 20 --iterations 5 --latency 0.2 --tokens-per-second 50
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    
+    def log_message(self, format, *args):
+        pass
+    
+    def _send_json(self, body, status=200):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+    
+    def do_GET(self):
+        server = self.server
+        if self.path.startswith('/api/tags'):
+            self._send_json({'models': [
+                {'name': model, 'model': model, 'size': 500_000_000,
+                 'details': {'family': 'fake', 'parameter_size': '0.6B', 'quantization_level': 'Q4_0'}}
+                for model in server.models
+            ]})
+        elif self.path.startswith('/api/ps'):
+            self._send_json({'models': [{'name': model, 'model': model} for model in server.loaded]})
+        elif self.path.startswith('/api/version'):
+            self._send_json({'version': 'fake'})
+        else:
+            data = b"Ollama is running"
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+    
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b'{}')
+        model = request.get('model', '')
+        
+        if self.path.startswith('/api/embed'):
+            inputs = request.get('input', [])
+            inputs = [inputs] if isinstance(inputs, str) else inputs
+            self._send_json({'model': model, 'embeddings': [server.embedding(text) for text in inputs]})
+            return
+        if not self.path.startswith('/api/chat') and not self.path.startswith('/api/generate'):
+            self._send_json({'error': 'not found'}, 404)
+            return
+        
+        with server.lock:
+            server.requests += 1
+        load_duration = 0
+        if model not in server.loaded:
+            time.sleep(server.load_latency)
+            load_duration = int(server.load_latency * 1e9)
+            server.loaded.add(model)
+        time.sleep(server.latency)
+        
+        tokens = [f"token{i} " for i in range(server.reply_tokens)]
+        delay = 1 / server.tokens_per_second if server.tokens_per_second else 0
+        prompt_tokens = sum(len(m.get('content', '')) // 4 + 1 for m in request.get('messages', []))
+        final = {
+            'model': model, 'done': True, 'done_reason': 'stop',
+            'prompt_eval_count': prompt_tokens, 'prompt_eval_duration': int(server.latency * 1e9),
+            'eval_count': len(tokens), 'eval_duration': int(delay * len(tokens) * 1e9),
+            'load_duration': load_duration,
+        }
+        
+        if not request.get('stream', True):
+            time.sleep(delay * len(tokens))
+            final['message'] = {'role': 'assistant', 'content': ''.join(tokens)}
+            self._send_json(final)
+            return
+        
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for token in tokens:
+            time.sleep(delay)
+            self._write_chunk({'model': model, 'message': {'role': 'assistant', 'content': token}, 'done': False})
+        final['message'] = {'role': 'assistant', 'content': ''}
+        self._write_chunk(final)
+        self.wfile.write(b"0\r\n\r\n")
+    
+    def _write_chunk(self, body):
+        data = (json.dumps(body) + "\n").encode('utf-8')
+        self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+        self.wfile.flush()
+
+class FakeOllamaServer(ThreadingHTTPServer):
+    """Stand-in for the Ollama HTTP API with configurable speed"""
+    daemon_threads = True
+    
+    def __init__(self, port=0, models=('fake:0.6b',), latency=0.05, load_latency=0.5,
+                 tokens_per_second=100, reply_tokens=40):
+        super().__init__(('127.0.0.1', port), FakeOllamaHandler)
+        self.models = list(models)
+        self.loaded = set()
+        self.latency = latency
+        self.load_latency = load_latency
+        self.tokens_per_second = tokens_per_second
+        self.reply_tokens = reply_tokens
+        self.requests = 0
+        self.lock = threading.Lock()
+    
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+    
+    def embedding(self, text, dimensions=64):
+        rng = random.Random(text)
+        return [rng.uniform(-1, 1) for _ in range(dimensions)]
+    
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+def seed_database(db, users, sessions_per_user, messages_per_session, password):
+    """Bulk-insert synthetic users, sessions and messages; returns the usernames"""
+    import bcrypt
+    from database import BCRYPT_ROUNDS
+    # Every synthetic user shares one password, so hash it once
+    password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(BCRYPT_ROUNDS))
+    usernames = [f"bench_user_{i}" for i in range(users)]
+    
+    with db.transaction() as conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO users (username, password_hash) VALUES (?, ?)",
+            [(username, password_hash) for username in usernames]
+        )
+        user_ids = [row[0] for row in conn.execute(
+            f"SELECT id FROM users WHERE username IN ({','.join('?' * len(usernames))})", usernames
+        )]
+        for user_id in user_ids:
+            for s in range(sessions_per_user):
+                session_id = conn.execute(
+                    "INSERT INTO chat_sessions (user_id, title) VALUES (?, ?)", (user_id, f"Session {s}")
+                ).lastrowid
+                conn.executemany(
+                    "INSERT INTO messages (session_id, role, content) VALUES (?, ?, ?)",
+                    [(session_id, 'user' if m % 2 == 0 else 'assistant', f"Synthetic message {m} " * 8)
+                     for m in range(messages_per_session)]
+                )
+    return usernames
+
+def simulate_user(db, job_queue, username, password, model, iterations, page_size, timings, lock):
+    import context
+    
+    def record(stage, start):
+        with lock:
+            timings.setdefault(stage, []).append(time.perf_counter() - start)
+    
+    start = time.perf_counter()
+    user_id = db.verify_user(username, password)
+    db.create_auth_token(user_id)
+    record('login', start)
+    
+    for _ in range(iterations):
+        start = time.perf_counter()
+        sessions = db.get_user_sessions(user_id)
+        session_id = random.choice(sessions)[0]
+        rows, has_more = db.get_session_messages_page(session_id, limit=page_size)
+        offset = db.count_session_messages(session_id) - len(rows) if has_more else 0
+        history = [{'id': id, 'role': role, 'content': content} for id, role, content, _ in rows]
+        record('open_session', start)
+        
+        start = time.perf_counter()
+        text = f"Benchmark question {random.random()}"
+        history.append({'id': db.add_message(session_id, 'user', text), 'role': 'user', 'content': text})
+        messages = context.build_context(db, session_id, model, "You are a benchmark.", history,
+                                         offset=offset, user_id=user_id)
+        job_id = job_queue.submit(user_id, session_id, model, messages)
+        first_token = None
+        while True:
+            job = job_queue.get(job_id)
+            if first_token is None and job.chunks:
+                first_token = time.perf_counter() - start
+            if job.finished:
+                break
+            time.sleep(0.005)
+        if first_token is not None:
+            with lock:
+                timings.setdefault('first_token', []).append(first_token)
+        record('send_message', start)
+        
+        start = time.perf_counter()
+        before_id = history[0]['id'] if history else None
+        while before_id is not None:
+            rows, has_more = db.get_session_messages_page(session_id, before_id=before_id, limit=page_size)
+            before_id = rows[0][0] if has_more and rows else None
+        record('load_history', start)
+
+def report(timings, elapsed):
+    print(f"\n{'stage':<14}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}{'ops/s':>10}")
+    for stage in ('login', 'open_session', 'send_message', 'first_token', 'load_history'):
+        values = timings.get(stage)
+        if not values:
+            continue
+        print(f"{stage:<14}{len(values):>7}"
+              f"{percentile(values, 0.50) * 1000:>10.1f}"
+              f"{percentile(values, 0.95) * 1000:>10.1f}"
+              f"{percentile(values, 0.99) * 1000:>10.1f}"
+              f"{max(values) * 1000:>10.1f}"
+              f"{len(values) / elapsed:>10.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test Agent 1 Cintessa against a fake Ollama server")
+    parser.add_argument('--users', type=int, default=10, help="concurrent simulated users")
+    parser.add_argument('--iterations', type=int, default=5, help="messages sent per simulated user")
+    parser.add_argument('--seed-users', type=int, default=100)
+    parser.add_argument('--seed-sessions', type=int, default=5, help="sessions per seeded user")
+    parser.add_argument('--seed-messages', type=int, default=200, help="messages per seeded session")
+    parser.add_argument('--page-size', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.05, help="fake prompt evaluation time (s)")
+    parser.add_argument('--load-latency', type=float, default=0.5, help="fake model load time (s)")
+    parser.add_argument('--tokens-per-second', type=float, default=200)
+    parser.add_argument('--reply-tokens', type=int, default=40)
+    parser.add_argument('--db', default=None, help="database file (default: a temporary file)")
+    args = parser.parse_args()
+    
+    server = FakeOllamaServer(latency=args.latency, load_latency=args.load_latency,
+                              tokens_per_second=args.tokens_per_second, reply_tokens=args.reply_tokens).start()
+    print(f"🧪 Fake Ollama listening on {server.url}")
+    
+    # Point the app at the fake server and a scratch database before importing it
+    workdir = tempfile.mkdtemp(prefix="cintessa-bench-")
+    db_path = os.path.abspath(args.db) if args.db else os.path.join(workdir, "bench.db")
+    os.environ['OLLAMA_HOSTS'] = server.url
+    os.environ.setdefault('BCRYPT_ROUNDS', '10')
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(workdir)
+    
+    from database import Database
+    from jobs import JobQueue
+    
+    db = Database(db_path)
+    job_queue = JobQueue(db)
+    password = "benchmark-password"
+    
+    start = time.perf_counter()
+    usernames = seed_database(db, args.seed_users, args.seed_sessions, args.seed_messages, password)
+    print(f"🌱 Seeded {args.seed_users} users x {args.seed_sessions} sessions x {args.seed_messages} messages "
+          f"in {time.perf_counter() - start:.1f}s")
+    
+    timings = {}
+    lock = threading.Lock()
+    threads = [
+        threading.Thread(target=simulate_user, args=(
+            db, job_queue, usernames[i % len(usernames)], password, server.models[0],
+            args.iterations, args.page_size, timings, lock
+        ))
+        for i in range(args.users)
+    ]
+    
+    print(f"🚀 Running {args.users} simulated users x {args.iterations} messages...")
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    
+    report(timings, elapsed)
+    print(f"\n⏱️ {elapsed:.1f}s wall time, {server.requests} requests to the fake Ollama server")
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+"""Conformance checks every storage backend must pass.
+
+Runs the same checks against SQLite and PostgreSQL:
+
+    python check_storage.py                     # SQLite, and a throwaway local PostgreSQL if available
+    python check_storage.py --postgres URL      # PostgreSQL at URL; needs CREATEDB for a scratch database
+
+Settings come from the environment as usual, so WRITE_BEHIND_ENABLED=true
+runs the same checks with buffered writes.
+
+The throwaway server is started with initdb/pg_ctl from PATH, or with the
+pgserver package if it is installed.
+"""
+import argparse
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# Hashing at the production work factor would dominate the run
+os.environ.setdefault('BCRYPT_ROUNDS', '4')
+
+from database import Database
+
+CHECKS = []
+
+def check(function):
+    CHECKS.append(function)
+    return function
+
+@check
+def users(db):
+    user_id = db.create_user('alice', 'secret')
+    assert user_id, "create_user returned no id"
+    assert db.create_user('alice', 'other') is None, "duplicate username was accepted"
+    assert db.verify_user('alice', 'secret') == user_id
+    assert db.verify_user('alice', 'wrong') is None
+    assert db.get_user_id('alice') == user_id
+
+@check
+def auth_tokens(db):
+    user_id = db.create_user('token-user', 'secret')
+    token = db.create_auth_token(user_id)
+    assert tuple(db.verify_auth_token(token)) == (user_id, 'token-user')
+    assert db.verify_auth_token(token + 'x') is None, "tampered token was accepted"
+    db.revoke_auth_token(token)
+    assert db.verify_auth_token(token) is None, "revoked token still works"
+
+@check
+def sessions_and_messages(db):
+    user_id = db.create_user('chatter', 'secret')
+    session_id = db.create_chat_session(user_id, "Chat", "Be brief.", "robot.png")
+    ids = [db.add_message(session_id, 'user' if i % 2 == 0 else 'assistant', f"message {i}") for i in range(7)]
+    assert ids == sorted(ids) and len(set(ids)) == 7, f"message ids not increasing: {ids}"
+    db.update_session_system_prompt(session_id, "Be thorough.")
+    db.update_session_character(session_id, "cat.png")
+    
+    messages = db.get_session_messages(session_id)
+    assert [content for _, content, _ in messages] == [f"message {i}" for i in range(7)]
+    assert len(messages[0][2]) == 19, f"timestamp not 'YYYY-MM-DD HH:MM:SS': {messages[0][2]!r}"
+    assert db.count_session_messages(session_id) == 7
+    assert [tuple(row) for row in db.get_session_messages_range(session_id, 2, 2)] == [('user', 'message 2'), ('assistant', 'message 3')]
+    
+    page, has_more = db.get_session_messages_page(session_id, limit=3)
+    assert [row[0] for row in page] == ids[4:] and has_more
+    page, has_more = db.get_session_messages_page(session_id, before_id=ids[4], limit=10)
+    assert [row[0] for row in page] == ids[:4] and not has_more
+    by_id = db.get_messages_by_id([ids[0], ids[3], -1])
+    assert {k: v[:3] for k, v in by_id.items()} == {ids[0]: (session_id, 'user', "message 0"), ids[3]: (session_id, 'assistant', "message 3")}
+    
+    sessions = db.get_user_sessions(user_id)
+    assert [(row[0], row[1], row[3], row[4]) for row in sessions] == [(session_id, "Chat", "Be thorough.", "cat.png")]
+
+@check
+def summaries(db):
+    user_id = db.create_user('summarised', 'secret')
+    session_id = db.create_chat_session(user_id)
+    assert db.get_session_summary(session_id) == ("", 0)
+    db.set_session_summary(session_id, "first", 4)
+    db.set_session_summary(session_id, "second", 8)
+    assert db.get_session_summary(session_id) == ("second", 8)
+
+@check
+def memories(db):
+    import database
+    user_id = db.create_user('rememberer', 'secret')
+    db.set_user_memory(user_id, 'name', 'Al')
+    db.set_user_memory(user_id, 'name', 'Alice')
+    db.set_user_memory(user_id, 'city', 'Oslo')
+    assert db.get_user_memory(user_id, 'name') == 'Alice'
+    db.delete_user_memory(user_id, 'city')
+    assert db.get_user_memories(user_id) == {'name': 'Alice'}
+    for i in range(database.MEMORY_MAX_PER_USER + 5):
+        db.set_user_memory(user_id, f"fact {i}", str(i))
+    assert len(db.get_user_memories(user_id)) == database.MEMORY_MAX_PER_USER
+
+@check
+def search(db):
+    owner = db.create_user('searcher', 'secret')
+    other = db.create_user('bystander', 'secret')
+    session_id = db.create_chat_session(owner, "Trip")
+    db.add_message(session_id, 'user', "We should visit the lighthouse tomorrow")
+    db.add_message(session_id, 'assistant', "The weather looks fine for it")
+    db.add_message(db.create_chat_session(other), 'user', "lighthouse keepers")
+    
+    results = db.search_messages(owner, "lighthouse")
+    assert len(results) == 1 and results[0][2] == "Trip", f"unexpected results: {results}"
+    assert '**' in results[0][4], f"snippet without highlight: {results[0][4]!r}"
+    assert len(db.search_messages(owner, "light")) == 1, "prefix search failed"
+    assert db.search_messages(owner, "lighthouse weather") == []
+    assert db.search_messages(owner, "   ") == []
+
+@check
+def jobs(db):
+    user_id = db.create_user('queuer', 'secret')
+    session_id = db.create_chat_session(user_id)
+    job_id = db.create_job(user_id, session_id, 'model', [{'role': 'user', 'content': 'hi'}], owner='a')
+    assert db.get_session_active_job(session_id) == job_id
+    assert db.claim_stale_jobs('b', 60) == [], "claimed a job with a live lease"
+    
+    claimed = db.claim_stale_jobs('b', -1)
+    assert [row[0] for row in claimed] == [job_id] and claimed[0][4] == [{'role': 'user', 'content': 'hi'}]
+    assert db.claim_stale_jobs('c', 60) == [], "job claimed twice"
+    db.renew_job_leases('b')
+    
+    db.update_job(job_id, 'running', 'partial')
+    message_id = db.add_message(session_id, 'assistant', 'done now')
+    db.update_job(job_id, 'done', 'done now', None, message_id)
+    assert tuple(db.get_job(job_id)) == (job_id, user_id, session_id, 'model', 'done', 'done now', None, message_id)
+    assert db.get_session_active_job(session_id) is None
+    assert db.claim_stale_jobs('c', -1) == [], "finished job was claimed"
+    assert not db.update_job(job_id, 'running', 'again'), "finished job was reopened"
+    
+    # A job cancelled from elsewhere refuses progress but takes the final cancelled update
+    job_id = db.create_job(user_id, session_id, 'model', [], owner='a')
+    assert db.update_job(job_id, 'cancelled', '', "Stopped")
+    assert not db.update_job(job_id, 'running', 'more')
+    assert db.update_job(job_id, 'cancelled', 'partial', "Stopped")
+    assert db.get_job(job_id)[4:6] == ('cancelled', 'partial')
+
+@check
+def response_cache(db):
+    assert db.get_cached_response('missing') is None
+    db.put_cached_response('key', 'model', 'first')
+    db.put_cached_response('key', 'model', 'second')
+    assert db.get_cached_response('key') == 'second'
+    db.put_cached_response('expired', 'model', 'old', ttl=-1)
+    assert db.get_cached_response('expired') is None
+
+@check
+def archive(db):
+    user_id = db.create_user('archivist', 'secret')
+    session_id = db.create_chat_session(user_id)
+    ids = [db.add_message(session_id, 'user', f"old message {i}") for i in range(20)]
+    before = [tuple(row) for row in db.iter_session_messages(session_id)]
+    
+    count, raw_size, compressed = db.archive_session(session_id)
+    assert count == 20 and compressed < raw_size
+    assert db.is_session_archived(session_id) and db.count_session_messages(session_id) == 0
+    assert [tuple(row) for row in db.iter_session_messages(session_id)] == before
+    assert db.reclaim_space() >= 0 and db.reclaim_space(convert=True) >= 0
+    
+    assert db.restore_session(session_id) == 20
+    assert not db.is_session_archived(session_id)
+    assert [tuple(row) for row in db.iter_session_messages(session_id, batch=7)] == before
+    assert db.add_message(session_id, 'user', "new") > ids[-1]
+
+@check
+def reserved_ids(db):
+    user_id = db.create_user('reserver', 'secret')
+    session_id = db.create_chat_session(user_id)
+    first = db.add_message(session_id, 'user', "before")
+    reserved = list(db.reserve_message_ids(10))
+    assert len(set(reserved)) == 10 and min(reserved) > first
+    assert db.add_message(session_id, 'user', "after") not in reserved, "reserved id handed out again"
+
+@check
+def import_batch(db):
+    user_id = db.import_user('imported', b'$2b$04$' + b'x' * 53, '2024-01-01 00:00:00')
+    assert db.import_user('imported', b'ignored', '2024-01-01 00:00:00') == user_id
+    # Exported ids that collide with rows already here
+    existing = db.create_chat_session(user_id, "Existing")
+    db.add_message(existing, 'user', "already here")
+    session_ids = {}
+    sessions = [(existing, user_id, "Imported", '2024-01-01 00:00:00', "", 'default.png'),
+                (existing + 1, None, "No such user", '2024-01-01 00:00:00', "", 'default.png')]
+    messages = [(existing, 'user', f"imported {i}", '2024-01-01 00:00:00') for i in range(2)]
+    assert db.import_batch(sessions, messages, session_ids, lambda ids: ('import_offset', str(len(ids)))) == (1, 2)
+    imported = session_ids[existing]
+    assert imported != existing and list(session_ids) == [existing]
+    # A later batch continues the session through the map
+    more = [(existing, 'assistant', "imported 2", '2024-01-01 00:00:00'), (existing + 1, 'user', "orphan", '2024-01-01 00:00:00')]
+    assert db.import_batch([], more, session_ids) == (0, 1)
+    assert [content for _, content, _ in db.get_session_messages(imported)] == ["imported 0", "imported 1", "imported 2"]
+    assert [content for _, content, _ in db.get_session_messages(existing)] == ["already here"]
+    assert db.get_setting('import_offset') == '1'
+    assert db.get_setting('missing', 'fallback') == 'fallback'
+    # New rows must not collide with imported ids
+    assert db.create_chat_session(user_id) > imported
+    db.add_message(imported, 'user', "after import")
+    assert db.count_session_messages(imported) == 4
+
+@check
+def metrics_rows(db):
+    db.save_metrics([('cintessa_check_seconds', '{}', 3, 0.5)])
+
+@check
+def concurrent_writers(db):
+    user_id = db.create_user('crowd', 'secret')
+    session_id = db.create_chat_session(user_id)
+    errors = []
+    
+    def write(n):
+        try:
+            for i in range(25):
+                db.add_message(session_id, 'user', f"thread {n} message {i}")
+        except Exception as e:
+            errors.append(e)
+    
+    threads = [threading.Thread(target=write, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors, f"writers failed: {errors[0]!r}"
+    assert db.count_session_messages(session_id) == 200
+
+def run_checks(name, db):
+    """Run every check against db; returns the number that failed"""
+    print(f"\n🗄️  {name}")
+    failed = 0
+    for function in CHECKS:
+        start = time.perf_counter()
+        try:
+            function(db)
+            print(f"   ✅ {function.__name__} ({(time.perf_counter() - start) * 1000:.0f} ms)")
+        except Exception as e:
+            failed += 1
+            print(f"   ❌ {function.__name__}: {type(e).__name__}: {e}")
+    db.close()
+    return failed
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+@contextmanager
+def local_postgres():
+    """Yield the URL of a throwaway PostgreSQL server, or None if none can be started"""
+    directory = tempfile.mkdtemp(prefix='cintessa-pg-')
+    try:
+        if shutil.which('initdb') and shutil.which('pg_ctl'):
+            data, port = os.path.join(directory, 'data'), _free_port()
+            subprocess.run(['initdb', '-D', data, '-U', 'postgres', '--auth=trust'], check=True, capture_output=True)
+            subprocess.run(['pg_ctl', '-D', data, '-w', '-l', os.path.join(directory, 'log'),
+                            '-o', f"-k {directory} -p {port} -c listen_addresses=''", 'start'], check=True, capture_output=True)
+            try:
+                yield f"postgresql://postgres@/postgres?host={directory}&port={port}"
+            finally:
+                subprocess.run(['pg_ctl', '-D', data, '-m', 'fast', 'stop'], capture_output=True)
+            return
+        
+        try:
+            import pgserver
+        except ImportError:
+            yield None
+            return
+        server = pgserver.get_server(directory, cleanup_mode='stop')
+        try:
+            yield server.get_uri()
+        finally:
+            server.cleanup()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+@contextmanager
+def scratch_database(url):
+    """Create an empty database on the server at url and yield its URL"""
+    import psycopg
+    from psycopg import conninfo
+    name = f"cintessa_check_{uuid.uuid4().hex[:8]}"
+    with psycopg.connect(url, autocommit=True) as conn:
+        conn.execute(f"CREATE DATABASE {name}")
+    try:
+        yield conninfo.make_conninfo(url, dbname=name)
+    finally:
+        with psycopg.connect(url, autocommit=True) as conn:
+            conn.execute(f"DROP DATABASE IF EXISTS {name} WITH (FORCE)")
+
+def run_postgres(url):
+    from database_postgres import PostgresDatabase
+    with scratch_database(url) as scratch:
+        return run_checks("PostgreSQL", PostgresDatabase(scratch, min_size=1, max_size=10))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--postgres', metavar='URL', help="check against this PostgreSQL server instead of starting one")
+    args = parser.parse_args()
+    
+    print("🔍 Checking storage backends...")
+    failed = 0
+    with tempfile.TemporaryDirectory() as directory:
+        failed += run_checks("SQLite", Database(os.path.join(directory, 'check.db')))
+    
+    if args.postgres:
+        failed += run_postgres(args.postgres)
+    else:
+        with local_postgres() as url:
+            if url is None:
+                print("\n⚠️ PostgreSQL skipped: no initdb/pg_ctl on PATH and pgserver is not installed")
+            else:
+                failed += run_postgres(url)
+    
+    if failed:
+        print(f"\n❌ {failed} check(s) failed")
+        sys.exit(1)
+    print("\n🎉 All storage checks passed!")
+
+if __name__ == "__main__":
+    main()
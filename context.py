@@ -0,0 +1,235 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from backends import pool
+from metrics import record_ollama_response
+from warmup import warmer
+import recall
+
+# Token budget for the history sent with each request. CONTEXT_TOKEN_BUDGETS
+# overrides it per model, e.g. "llama2=3000,mistral=6000".
+DEFAULT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', '3000'))
+# Share of the budget the user's memories may take
+MEMORY_TOKEN_BUDGET = int(os.getenv('MEMORY_TOKEN_BUDGET', '300'))
+# Don't re-summarize until at least this many messages have fallen out of the window
+SUMMARY_MIN_BATCH = int(os.getenv('SUMMARY_MIN_BATCH', '6'))
+SUMMARY_MODEL = os.getenv('SUMMARY_MODEL', '')
+
+# Rough per-message cost of role markers and template tokens
+MESSAGE_OVERHEAD_TOKENS = 4
+# When the history window has to move, it is refilled to this share of the
+# budget, so the prompt prefix then stays the same for the next several turns
+PREFIX_REFILL_RATIO = float(os.getenv('PREFIX_REFILL_RATIO', '0.6'))
+PINNED_WINDOWS_MAX = 4096
+
+SUMMARY_PROMPT = (
+    "Summarize the conversation below so it can stand in for the original messages. "
+    "Keep names, facts, decisions and open questions. Be concise."
+)
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="summarizer")
+_pending = set()
+_pending_lock = threading.Lock()
+# session_id -> (number of the first message in the window, summary sent with
+# it, number of messages that summary covers)
+_windows = OrderedDict()
+_windows_lock = threading.Lock()
+
+def _parse_budgets(value):
+    budgets = {}
+    for item in value.split(','):
+        if '=' in item:
+            model, budget = item.rsplit('=', 1)
+            budgets[model.strip()] = int(budget)
+    return budgets
+
+MODEL_TOKEN_BUDGETS = _parse_budgets(os.getenv('CONTEXT_TOKEN_BUDGETS', ''))
+
+def get_token_budget(model):
+    return MODEL_TOKEN_BUDGETS.get(model, DEFAULT_TOKEN_BUDGET)
+
+def estimate_tokens(text):
+    """Cheap token estimate (~4 characters per token), good enough for budgeting"""
+    return len(text) // 4 + 1
+
+def message_tokens(message):
+    return estimate_tokens(message['content']) + MESSAGE_OVERHEAD_TOKENS
+
+def prompt_tokens(messages):
+    return sum(message_tokens(message) for message in messages)
+
+def select_window(messages, budget):
+    """Return the index of the oldest message that still fits in budget.
+    
+    The newest message is always kept, even if it alone exceeds the budget.
+    """
+    used = 0
+    start = len(messages)
+    for i in range(len(messages) - 1, -1, -1):
+        used += message_tokens(messages[i])
+        if used > budget and start < len(messages):
+            break
+        start = i
+    return start
+
+def format_memories(memories, budget):
+    """Render memories as a system message body, newest first, within budget tokens"""
+    lines = []
+    used = estimate_tokens("What you know about the user:")
+    for key, value in memories.items():
+        line = f"- {key}: {value}"
+        used += estimate_tokens(line)
+        if used > budget:
+            break
+        lines.append(line)
+    if not lines:
+        return ""
+    # Sorted, so touching a memory without changing it keeps the prompt identical
+    return "What you know about the user:\n" + "\n".join(sorted(lines))
+
+def format_recalled(hits, budget):
+    """Render recalled (timestamp, role, content, score) messages as a system message body within budget tokens"""
+    header = "Possibly relevant excerpts from earlier conversations with the user:"
+    lines = []
+    used = estimate_tokens(header)
+    for timestamp, role, content, _ in hits:
+        snippet = ' '.join(content.split())
+        if len(snippet) > recall.SNIPPET_MAX_CHARS:
+            snippet = snippet[:recall.SNIPPET_MAX_CHARS] + "…"
+        line = f"- [{str(timestamp)[:10]}] {role}: {snippet}"
+        used += estimate_tokens(line)
+        if used > budget:
+            break
+        lines.append(line)
+    if not lines:
+        return ""
+    return header + "\n" + "\n".join(lines)
+
+def recalled_context(db, user_id, session_id, query):
+    """Excerpts of the user's other sessions related to query, or "" if there are none"""
+    if not recall.RECALL_ENABLED or user_id is None or len(query.strip()) < recall.RECALL_MIN_CHARS:
+        return ""
+    try:
+        hits = recall.recall(db, user_id, query, exclude_session=session_id)
+    except Exception as e:
+        print(f"Error recalling past messages: {e}")
+        return ""
+    return format_recalled(hits, recall.RECALL_TOKEN_BUDGET)
+
+def build_context(db, session_id, model, system_prompt, history, offset=0, user_id=None):
+    """Assemble the messages to send for the next turn.
+    
+    history holds the session's loaded messages, the first of which is
+    message number offset of the session. The newest turns are kept within
+    the model's token budget and older turns are represented by the
+    session's stored rolling summary. The user's memories are included up to
+    MEMORY_TOKEN_BUDGET, and with recall enabled, excerpts of the user's
+    other sessions related to the newest message up to RECALL_TOKEN_BUDGET.
+    If enough turns have fallen out of the
+    window since the last summary, a new one is generated in the background
+    for later turns.
+    
+    Messages always come in the same order (system prompt, memories,
+    summary, history) and the window start and summary are pinned until
+    the history no longer fits. Consecutive turns then share a byte-identical
+    prefix, which Ollama serves from its prompt cache instead of evaluating
+    the whole conversation again. A window is only pinned once the summary
+    reaches its start; until then it starts where the summary ends, as far
+    as the budget allows, so no message is left out of both.
+    """
+    stored_summary, covered = db.get_session_summary(session_id)
+    summary = stored_summary
+    
+    budget = get_token_budget(model)
+    if system_prompt:
+        budget -= estimate_tokens(system_prompt) + MESSAGE_OVERHEAD_TOKENS
+    memories = format_memories(db.get_user_memories(user_id), MEMORY_TOKEN_BUDGET) if user_id else ""
+    if memories:
+        budget -= estimate_tokens(memories) + MESSAGE_OVERHEAD_TOKENS
+    # A fixed reservation, so the varying excerpts never move the window
+    if recall.RECALL_ENABLED and user_id:
+        budget -= recall.RECALL_TOKEN_BUDGET + MESSAGE_OVERHEAD_TOKENS
+    
+    def history_budget(summary):
+        if summary:
+            return max(budget - estimate_tokens(summary) - MESSAGE_OVERHEAD_TOKENS, 0)
+        return max(budget, 0)
+    
+    # Keep the previous turn's window while everything since still fits
+    with _windows_lock:
+        pinned = _windows.get(session_id)
+    start = None
+    if pinned is not None:
+        pinned_start, pinned_summary, pinned_covered = pinned
+        index = pinned_start - offset
+        if 0 <= index < len(history) and prompt_tokens(history[index:]) <= history_budget(pinned_summary):
+            start, summary = index, pinned_summary
+    # Where the window moves to, leaving room for the next several turns
+    refill = select_window(history, int(history_budget(summary) * PREFIX_REFILL_RATIO))
+    if start is None:
+        if covered >= offset + refill:
+            start = refill
+            with _windows_lock:
+                _windows[session_id] = (offset + start, summary, covered)
+                _windows.move_to_end(session_id)
+                while len(_windows) > PINNED_WINDOWS_MAX:
+                    _windows.popitem(last=False)
+        else:
+            # The summary lags behind: start where it ends, unless even that no
+            # longer fits, and pin nothing until a newer summary catches up
+            start = max(covered - offset, select_window(history, history_budget(summary)))
+            with _windows_lock:
+                _windows.pop(session_id, None)
+    
+    messages = []
+    if system_prompt:
+        messages.append({'role': 'system', 'content': system_prompt})
+    if memories:
+        messages.append({'role': 'system', 'content': memories})
+    if summary and offset + start > 0:
+        messages.append({'role': 'system', 'content': f"Summary of the earlier conversation:\n{summary}"})
+    messages.extend({'role': m['role'], 'content': m['content']} for m in history[start:])
+    
+    # Right before the newest message, so the cached prefix before it is unaffected
+    if history and history[-1]['role'] == 'user':
+        recalled = recalled_context(db, user_id, session_id, history[-1]['content'])
+        if recalled:
+            messages.insert(len(messages) - 1, {'role': 'system', 'content': recalled})
+    
+    if offset + refill - covered >= SUMMARY_MIN_BATCH:
+        schedule_summary(db, session_id, SUMMARY_MODEL or model, stored_summary, covered, offset + refill)
+    
+    return messages
+
+def schedule_summary(db, session_id, model, previous_summary, covered, upto):
+    """Fold session messages [covered, upto) into the summary on the background worker"""
+    with _pending_lock:
+        if session_id in _pending:
+            return
+        _pending.add(session_id)
+    _executor.submit(_summarize, db, session_id, model, previous_summary, covered, upto)
+
+def _summarize(db, session_id, model, previous_summary, covered, upto):
+    try:
+        new_messages = db.get_session_messages_range(session_id, covered, upto - covered)
+        transcript = '\n'.join(f"{role}: {content}" for role, content in new_messages)
+        if previous_summary:
+            transcript = f"Earlier summary:\n{previous_summary}\n\nNew messages:\n{transcript}"
+        warmer.touch(model)
+        response = pool.chat(
+            model=model,
+            messages=[
+                {'role': 'system', 'content': SUMMARY_PROMPT},
+                {'role': 'user', 'content': transcript}
+            ],
+            stream=False,
+            keep_alive=warmer.keep_alive(model)
+        )
+        record_ollama_response(model, response)
+        db.set_session_summary(session_id, response['message']['content'], upto)
+    except Exception as e:
+        print(f"Error summarizing session {session_id}: {e}")
+    finally:
+        with _pending_lock:
+            _pending.discard(session_id)
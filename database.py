@@ -3,189 +3,1441 @@ import bcrypt
 import json
 from datetime import datetime
 import os
+import threading
+import time
+import hashlib
+import hmac
+import secrets
+import atexit
+import zlib
+from collections import ChainMap
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from metrics import instrument_methods, registry, startup
+
+# Where shared state lives: a SQLite file path, or a postgresql:// URL so
+# several app processes or hosts can share one database
+DATABASE_URL = os.getenv('DATABASE_URL', 'agent1.db')
+
+# Connection tuning, overridable from .env
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+SQLITE_CACHE_SIZE_KB = int(os.getenv('SQLITE_CACHE_SIZE_KB', '16384'))
+SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')
+# Idle SQLite connections kept open between calls, so reruns reuse them
+SQLITE_POOL_SIZE = int(os.getenv('SQLITE_POOL_SIZE', '8'))
+
+# Password hashing runs on a small bounded pool so a burst of logins can't
+# occupy every core; changing BCRYPT_ROUNDS rehashes passwords on next login
+BCRYPT_ROUNDS = int(os.getenv('BCRYPT_ROUNDS', '12'))
+PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', '2'))
+AUTH_TOKEN_TTL = float(os.getenv('AUTH_TOKEN_TTL_DAYS', '30')) * 86400
+
+_password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt")
+
+# Memories kept per user; the least recently updated are dropped beyond this
+MEMORY_MAX_PER_USER = int(os.getenv('MEMORY_MAX_PER_USER', '50'))
+
+# Opt-in cache of model replies for repeated prompts
+RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE_ENABLED', 'false').lower() == 'true'
+RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', '86400'))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', '10000'))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+
+# Opt-in write-behind buffering of messages and session settings: writes are
+# group-committed at most WRITE_FLUSH_INTERVAL seconds after they are made
+WRITE_BEHIND_ENABLED = os.getenv('WRITE_BEHIND_ENABLED', 'false').lower() == 'true'
+WRITE_FLUSH_INTERVAL = float(os.getenv('WRITE_FLUSH_INTERVAL', '0.1'))
+WRITE_BATCH_MAX = int(os.getenv('WRITE_BATCH_MAX', '500'))
+# A buffered write that fails this many times on its own is logged and dropped
+WRITE_MAX_ATTEMPTS = int(os.getenv('WRITE_MAX_ATTEMPTS', '5'))
+# Message ids reserved per transaction while write-behind is on
+MESSAGE_ID_BLOCK = 256
+
+# zlib level used for archived sessions
+ARCHIVE_COMPRESSION_LEVEL = int(os.getenv('ARCHIVE_COMPRESSION_LEVEL', '6'))
+
+# Schema migrations, applied in order on startup. Each entry is
+# (version, description, statements); never edit an applied entry,
+# append a new one instead.
+MIGRATIONS = [
+    (1, "Index hot chat history lookups", [
+        # get_session_messages: WHERE session_id = ? ORDER BY timestamp
+        "CREATE INDEX IF NOT EXISTS idx_messages_session_timestamp ON messages (session_id, timestamp)",
+        # get_user_sessions: WHERE user_id = ? ORDER BY created_at DESC
+        "CREATE INDEX IF NOT EXISTS idx_chat_sessions_user_created ON chat_sessions (user_id, created_at DESC)",
+    ]),
+    (2, "Rolling conversation summaries", [
+        '''
+        CREATE TABLE IF NOT EXISTS session_summaries (
+            session_id INTEGER PRIMARY KEY,
+            summary TEXT NOT NULL,
+            covered_messages INTEGER NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (session_id) REFERENCES chat_sessions (id)
+        )
+        ''',
+    ]),
+    (3, "Index keyset pagination of session messages", [
+        "CREATE INDEX IF NOT EXISTS idx_messages_session_id ON messages (session_id, id)",
+    ]),
+    (4, "Background generation jobs", [
+        '''
+        CREATE TABLE IF NOT EXISTS generation_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            session_id INTEGER NOT NULL,
+            model TEXT NOT NULL,
+            messages TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            content TEXT NOT NULL DEFAULT '',
+            error TEXT,
+            message_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (session_id) REFERENCES chat_sessions (id)
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_generation_jobs_status ON generation_jobs (status, id)",
+        "CREATE INDEX IF NOT EXISTS idx_generation_jobs_session ON generation_jobs (session_id, status)",
+    ]),
+    (5, "Response cache", [
+        '''
+        CREATE TABLE IF NOT EXISTS response_cache (
+            key TEXT PRIMARY KEY,
+            model TEXT NOT NULL,
+            response TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            expires_at REAL NOT NULL,
+            last_used_at REAL NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_response_cache_last_used ON response_cache (last_used_at)",
+    ]),
+    (6, "Resumable login tokens", [
+        '''
+        CREATE TABLE IF NOT EXISTS auth_tokens (
+            token_hash TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            expires_at REAL NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS app_settings (
+            name TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+        ''',
+        "INSERT OR IGNORE INTO app_settings (name, value) VALUES ('auth_secret', lower(hex(randomblob(32))))",
+    ]),
+    (7, "Full-text search over messages", [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(content, content='messages', content_rowid='id')",
+        '''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+            INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+        END
+        ''',
+        # Backfill messages written before the index existed
+        "INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')",
+    ]),
+    (8, "One user_memory row per user and key", [
+        # INSERT OR REPLACE never replaced anything without a unique key; keep the newest duplicate
+        "DELETE FROM user_memory WHERE id NOT IN (SELECT MAX(id) FROM user_memory GROUP BY user_id, key)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_user_memory_user_key ON user_memory (user_id, key)",
+    ]),
+    (9, "Persisted metrics", [
+        '''
+        CREATE TABLE IF NOT EXISTS metrics (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            recorded_at REAL NOT NULL,
+            name TEXT NOT NULL,
+            labels TEXT NOT NULL,
+            count REAL NOT NULL,
+            sum REAL NOT NULL
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_metrics_name_recorded ON metrics (name, recorded_at)",
+    ]),
+    (10, "Compressed archive of idle sessions", [
+        '''
+        CREATE TABLE IF NOT EXISTS session_archive (
+            session_id INTEGER PRIMARY KEY,
+            message_count INTEGER NOT NULL,
+            raw_size INTEGER NOT NULL,
+            data BLOB NOT NULL,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (session_id) REFERENCES chat_sessions (id)
+        )
+        ''',
+        # Set when an archived session is restored, so it isn't archived again straight away
+        "ALTER TABLE chat_sessions ADD COLUMN restored_at TIMESTAMP",
+    ]),
+    (11, "Generation job leases", [
+        # The process working on a job, and when it last said it still was
+        "ALTER TABLE generation_jobs ADD COLUMN owner TEXT",
+        "ALTER TABLE generation_jobs ADD COLUMN heartbeat_at REAL",
+    ]),
+]
+
+# Queries that must be served by an index, checked with EXPLAIN QUERY PLAN
+HOT_QUERIES = {
+    'get_session_messages': (
+        "SELECT role, content, timestamp FROM messages WHERE session_id = ? ORDER BY timestamp ASC",
+        (0,)
+    ),
+    'get_user_sessions': (
+        "SELECT id, title, created_at, system_prompt, character_image FROM chat_sessions WHERE user_id = ? ORDER BY created_at DESC",
+        (0,)
+    ),
+    'get_session_messages_page': (
+        "SELECT id, role, content, timestamp FROM messages WHERE session_id = ? AND id < ? ORDER BY id DESC LIMIT ?",
+        (0, 0, 1)
+    ),
+}
+
+def _hash_password(password):
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(BCRYPT_ROUNDS))
+
+def _check_password(password, password_hash):
+    return bcrypt.checkpw(password.encode('utf-8'), password_hash)
+
+def _bcrypt_rounds(password_hash):
+    # Hashes look like $2b$12$<salt+digest>
+    return int(password_hash.split(b'$')[2])
+
+def fts_query(text):
+    """Turn free text into an FTS5 query: every word must match, the last as a prefix"""
+    terms = ['"' + term.replace('"', '""') + '"' for term in text.split()]
+    if terms:
+        terms[-1] += '*'
+    return ' '.join(terms)
+
+def response_cache_key(model, messages, options=None):
+    """Hash of everything that determines a reply.
+    
+    Message content is whitespace-normalised so trivially different copies
+    of the same canned prompt share an entry.
+    """
+    normalized = [
+        {'role': message['role'], 'content': ' '.join(message['content'].split())}
+        for message in messages
+    ]
+    payload = json.dumps([model, normalized, options or {}], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def is_cacheable(options=None):
+    """Whether a reply generated with these sampling options may be cached.
+    
+    Only greedy decoding (temperature 0) or a fixed seed gives the same reply
+    twice. Without an explicit temperature Ollama samples at the model's
+    default, usually 0.8, so such requests are skipped.
+    """
+    options = options or {}
+    return options.get('temperature') == 0 or 'seed' in options
+
+class WriteBuffer:
+    """Coalesces message inserts and session setting updates into group commits.
+    
+    Writes are queued in memory and committed by a background thread, one
+    transaction per batch, at most flush_interval seconds after the oldest
+    arrived or as soon as batch_max are waiting. flush() is a durability
+    barrier: it returns once everything queued before it is committed.
+    Message ids are reserved in blocks so add_message can still return one.
+    
+    If a batch fails, its rows are retried one at a time so a single bad row
+    cannot hold back the rest; a row still failing after max_attempts tries
+    is logged and dropped.
+    """
+    
+    # Session columns that may be buffered
+    SESSION_COLUMNS = ('character_image', 'system_prompt')
+    
+    def __init__(self, db, flush_interval=WRITE_FLUSH_INTERVAL, batch_max=WRITE_BATCH_MAX,
+                 max_attempts=WRITE_MAX_ATTEMPTS):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.batch_max = batch_max
+        self.max_attempts = max_attempts
+        self._condition = threading.Condition()
+        # (id, session_id, role, content, timestamp) rows, and
+        # (column, session_id) -> value with the latest update winning
+        self._messages = []
+        self._settings = {}
+        self._oldest = None
+        self._urgent = False
+        # Writes are numbered; a barrier waits for its number to be committed
+        self._queued = 0
+        self._committed = 0
+        # session_id -> number of its latest buffered write
+        self._dirty = {}
+        self._failures = 0
+        self._error = None
+        # Failed attempts per message id or (column, session_id)
+        self._attempts = {}
+        self._ids = iter(())
+        self._id_lock = threading.Lock()
+        self._writer = None
+    
+    def start(self):
+        with self._condition:
+            if self._writer is not None:
+                return
+            self._writer = threading.Thread(target=self._run, name="write-behind", daemon=True)
+            self._writer.start()
+        atexit.register(self.flush)
+    
+    def add_message(self, session_id, role, content):
+        message_id = self._next_message_id()
+        # Stamp the row now, in the same format as CURRENT_TIMESTAMP
+        timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+        self._queue(session_id, lambda: self._messages.append((message_id, session_id, role, content, timestamp)))
+        return message_id
+    
+    def update_session(self, session_id, column, value):
+        if column not in self.SESSION_COLUMNS:
+            raise ValueError(f"Unbuffered session column: {column}")
+        self._queue(session_id, lambda: self._settings.__setitem__((column, session_id), value))
+    
+    def _queue(self, session_id, write):
+        self.start()
+        with self._condition:
+            write()
+            self._queued += 1
+            self._dirty[session_id] = self._queued
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            self._condition.notify()
+    
+    def _next_message_id(self):
+        with self._id_lock:
+            message_id = next(self._ids, None)
+            if message_id is None:
+                self._ids = iter(self.db.reserve_message_ids(MESSAGE_ID_BLOCK))
+                message_id = next(self._ids)
+            return message_id
+    
+    def flush(self):
+        """Block until every write queued so far is committed"""
+        with self._condition:
+            self._wait_for(self._queued)
+    
+    def sync(self, session_id=None):
+        """Commit pending writes before a read, so readers see their own writes.
+        
+        With a session_id only that session's writes are waited for.
+        """
+        with self._condition:
+            target = self._queued if session_id is None else self._dirty.get(session_id, 0)
+            self._wait_for(target)
+    
+    def _wait_for(self, target):
+        # Caller holds the condition
+        if target <= self._committed:
+            return
+        failures = self._failures
+        self._urgent = True
+        self._condition.notify_all()
+        while self._committed < target:
+            if self._failures > failures:
+                raise self._error
+            self._condition.wait()
+    
+    def _due(self):
+        if self._oldest is None:
+            return False
+        return (self._urgent or len(self._messages) + len(self._settings) >= self.batch_max
+                or time.monotonic() - self._oldest >= self.flush_interval)
+    
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._due():
+                    timeout = None if self._oldest is None else self._oldest + self.flush_interval - time.monotonic()
+                    self._condition.wait(timeout)
+                messages, settings, upto = self._messages, self._settings, self._queued
+                self._messages, self._settings = [], {}
+                self._oldest = None
+                self._urgent = False
+            
+            try:
+                self._commit(messages, settings)
+            except Exception as e:
+                print(f"Error flushing buffered writes: {e}")
+                messages, settings, error, dropped = self._commit_rows(messages, settings)
+                with self._condition:
+                    if error is not None or dropped:
+                        self._failures += 1
+                        self._error = error or dropped
+                        self._condition.notify_all()
+                    if messages or settings:
+                        # Put the failed rows back ahead of newer writes and retry later
+                        self._messages[:0] = messages
+                        for key, value in settings.items():
+                            self._settings.setdefault(key, value)
+                        self._oldest = time.monotonic()
+                if messages or settings:
+                    time.sleep(self.flush_interval)
+                    continue
+            
+            with self._condition:
+                self._committed = upto
+                for session_id, number in list(self._dirty.items()):
+                    if number <= upto:
+                        del self._dirty[session_id]
+                self._condition.notify_all()
+    
+    def _commit_rows(self, messages, settings):
+        """Commit rows one at a time; returns the rows to retry, the last error and any drop error"""
+        rows = [(message[0], [message], {}) for message in messages]
+        rows += [(key, [], {key: value}) for key, value in settings.items()]
+        failed = []
+        for key, row_messages, row_settings in rows:
+            try:
+                self._commit(row_messages, row_settings)
+                self._attempts.pop(key, None)
+            except Exception as e:
+                failed.append((key, row_messages, row_settings, e))
+        
+        # When nothing at all commits the database itself is likely down, so
+        # only constraint violations count against the rows
+        blame_rows = len(failed) < len(rows)
+        retry_messages, retry_settings = [], {}
+        error = dropped = None
+        for key, row_messages, row_settings, e in failed:
+            attempts = self._attempts.get(key, 0)
+            if blame_rows or isinstance(e, self.db.IntegrityError):
+                attempts += 1
+            if attempts >= self.max_attempts:
+                print(f"Dropped buffered write {key} after {attempts} attempts: {e}")
+                self._attempts.pop(key, None)
+                dropped = e
+                continue
+            self._attempts[key] = attempts
+            retry_messages += row_messages
+            retry_settings.update(row_settings)
+            error = e
+        return retry_messages, retry_settings, error, dropped
+    
+    def _commit(self, messages, settings):
+        with self.db.transaction() as conn:
+            if messages:
+                conn.executemany(
+                    "INSERT INTO messages (id, session_id, role, content, timestamp) VALUES (?, ?, ?, ?, ?)",
+                    messages
+                )
+            for column in self.SESSION_COLUMNS:
+                updates = [(value, session_id) for (name, session_id), value in settings.items() if name == column]
+                if updates:
+                    conn.executemany(f"UPDATE chat_sessions SET {column} = ? WHERE id = ?", updates)
+
+class _Result:
+    """The rows and row count of a statement, read before its connection went back to the pool"""
+    
+    def __init__(self, cursor):
+        self.rowcount = cursor.rowcount
+        self.lastrowid = getattr(cursor, 'lastrowid', None)
+        self._rows = cursor.fetchall() if cursor.description else []
+        self._position = 0
+    
+    def fetchone(self):
+        if self._position >= len(self._rows):
+            return None
+        self._position += 1
+        return self._rows[self._position - 1]
+    
+    def fetchall(self):
+        rows = self._rows[self._position:]
+        self._position = len(self._rows)
+        return rows
+    
+    def __iter__(self):
+        while (row := self.fetchone()) is not None:
+            yield row
+
+class _Connection:
+    """A thread's handle on the pool, with the sqlite3 calls Database makes on it.
+    
+    Each statement borrows a pooled connection only while it runs, so an idle
+    thread holds none. pinned() keeps one for a block, as transactions and
+    session-level locks need.
+    """
+    
+    def __init__(self, pool):
+        self._pool = pool
+        self._pinned = None
+    
+    def _sql(self, sql):
+        return sql
+    
+    @contextmanager
+    def pinned(self):
+        if self._pinned is not None:
+            yield self
+            return
+        with self._pool.connection() as conn:
+            self._pinned = conn
+            try:
+                yield self
+            finally:
+                self._pinned = None
+    
+    def execute(self, sql, params=()):
+        with self.pinned():
+            return _Result(self._pinned.execute(self._sql(sql), params))
+    
+    def executemany(self, sql, rows):
+        with self.pinned():
+            cursor = self._pinned.cursor()
+            cursor.executemany(self._sql(sql), rows)
+            return _Result(cursor)
+    
+    def executescript(self, script):
+        with self.pinned():
+            self._pinned.executescript(script)
+
+class _SqlitePool:
+    """SQLite connections handed out one caller at a time.
+    
+    A connection is opened whenever none is idle, so callers never wait, and
+    up to max_idle are kept open once returned.
+    """
+    
+    def __init__(self, connect, max_idle=SQLITE_POOL_SIZE):
+        self._connect = connect
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+    
+    @contextmanager
+    def connection(self):
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is None:
+            conn = self._connect()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            with self._lock:
+                if len(self._idle) < self.max_idle:
+                    self._idle.append(conn)
+                    conn = None
+            if conn is not None:
+                conn.close()
+    
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+# Databases whose schema is initialised in this process
+_schema_ready = set()
+_schema_lock = threading.Lock()
 
 class Database:
+    """Storage for users, chats and jobs, backed by a local SQLite file.
+    
+    This class is also the storage interface: other backends subclass it and
+    override the SQLite-specific parts (connections, transaction start, id
+    generation, schema setup, search and maintenance). Everything else is
+    written in SQL both dialects accept.
+    """
+    
+    # Raised by the driver when a unique constraint is violated
+    IntegrityError = sqlite3.IntegrityError
+    # Statement that opens a write transaction
+    BEGIN = "BEGIN IMMEDIATE"
+    # Whether user memories may be cached in this process; only safe while
+    # no other process writes to the same database
+    CACHE_MEMORIES = True
+    # Schema migrations applied by migrate()
+    MIGRATIONS = MIGRATIONS
+    # Each thread's handle on the pool
+    CONNECTION = _Connection
+    
     def __init__(self, db_path="agent1.db"):
         self.db_path = db_path
-        self.init_db()
+        self._schema_key = os.path.abspath(db_path)
+        self._local = threading.local()
+        # Streamlit runs each rerun on a new thread, so connections are
+        # pooled per process rather than kept per thread
+        self.pool = _SqlitePool(self._connect)
+        self.response_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        self._auth_secret = None
+        # user_id -> {key: value}, dropped whenever that user's memory is written
+        self._memory_cache = {}
+        self._memory_lock = threading.Lock()
+        self._writes = WriteBuffer(self) if WRITE_BEHIND_ENABLED else None
+    
+    def _connect(self):
+        # Autocommit mode: plain reads take no lock, writes go through transaction()
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=SQLITE_BUSY_TIMEOUT_MS / 1000,
+            isolation_level=None,
+            check_same_thread=False
+        )
+        # Only takes effect on a new database; reclaim_space(convert=True) converts older ones
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+        conn.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        conn.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+    
+    def get_connection(self):
+        """Return this thread's handle on the connection pool"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            return conn
+        
+        conn = self._local.conn = self.CONNECTION(self.pool)
+        self._local.depth = 0
+        self._ensure_schema()
+        return conn
+    
+    def _ensure_schema(self):
+        # Schema setup runs on first use, once per process and database
+        key = self._schema_key
+        if key in _schema_ready:
+            return
+        with _schema_lock:
+            if key in _schema_ready:
+                return
+            with startup.phase('schema'):
+                self.init_db()
+            _schema_ready.add(key)
+    
+    @contextmanager
+    def transaction(self):
+        """Run a block of statements as one write transaction.
+        
+        Nested use joins the outermost transaction.
+        """
+        conn = self.get_connection()
+        if self._local.depth:
+            self._local.depth += 1
+            try:
+                yield conn
+            finally:
+                self._local.depth -= 1
+            return
+        
+        # Every statement of the transaction has to run on the same connection
+        with conn.pinned():
+            # SQLite's IMMEDIATE takes the write lock up front, avoiding lock upgrade deadlocks
+            conn.execute(self.BEGIN)
+            self._local.depth = 1
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            else:
+                conn.execute("COMMIT")
+            finally:
+                self._local.depth = 0
+    
+    def close(self):
+        """Close every pooled connection"""
+        self.flush()
+        self.pool.close()
+        self._local = threading.local()
     
     def init_db(self):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Users table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                password_hash TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Chat sessions table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS chat_sessions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                title TEXT DEFAULT 'New Chat',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                system_prompt TEXT,
-                character_image TEXT DEFAULT 'default.png',
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-        ''')
-        
-        # Messages table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                session_id INTEGER,
-                role TEXT NOT NULL,
-                content TEXT NOT NULL,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (session_id) REFERENCES chat_sessions (id)
-            )
-        ''')
-        
-        # User memory table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_memory (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                key TEXT NOT NULL,
-                value TEXT NOT NULL,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-        ''')
-        
-        conn.commit()
-        conn.close()
+        # A restart against an up-to-date database needs no DDL at all
+        conn = self.get_connection()
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'schema_version'").fetchone():
+            if self.get_schema_version() >= self.MIGRATIONS[-1][0]:
+                return
+        
+        with self.transaction() as conn:
+            # Users table
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS users (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    username TEXT UNIQUE NOT NULL,
+                    password_hash TEXT NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            # Chat sessions table
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS chat_sessions (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER,
+                    title TEXT DEFAULT 'New Chat',
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    system_prompt TEXT,
+                    character_image TEXT DEFAULT 'default.png',
+                    FOREIGN KEY (user_id) REFERENCES users (id)
+                )
+            ''')
+            
+            # Messages table
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    session_id INTEGER,
+                    role TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (session_id) REFERENCES chat_sessions (id)
+                )
+            ''')
+            
+            # User memory table
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS user_memory (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (user_id) REFERENCES users (id)
+                )
+            ''')
+            
+            # Applied migrations
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT NOT NULL,
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+        
+        self.migrate()
+        
+        for name, plan in self.check_query_plans().items():
+            if not plan['uses_index']:
+                print(f"⚠️ Query {name} is not using an index: {plan['detail']}")
     
-    def create_user(self, username, password):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    def get_schema_version(self):
+        conn = self.get_connection()
+        result = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+        return result[0] or 0
+    
+    def migrate(self):
+        """Upgrade the schema in place by applying pending MIGRATIONS"""
+        for version, description, statements in self.MIGRATIONS:
+            with self.transaction() as conn:
+                # Re-checked under the write lock so concurrent processes apply each once
+                applied = conn.execute(
+                    "SELECT 1 FROM schema_version WHERE version = ?", (version,)
+                ).fetchone()
+                if applied:
+                    continue
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute(
+                    "INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                    (version, description)
+                )
+    
+    def check_query_plans(self):
+        """Run EXPLAIN QUERY PLAN on HOT_QUERIES.
         
-        password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+        A query counts as indexed when it searches an index and needs no
+        temporary B-tree for its ORDER BY.
+        """
+        conn = self.get_connection()
+        plans = {}
+        for name, (query, params) in HOT_QUERIES.items():
+            rows = conn.execute(f"EXPLAIN QUERY PLAN {query}", params).fetchall()
+            detail = '; '.join(row[3] for row in rows)
+            plans[name] = {
+                'detail': detail,
+                'uses_index': 'USING INDEX' in detail and 'TEMP B-TREE' not in detail
+            }
+        return plans
+    
+    def _insert(self, conn, sql, params):
+        """Run an INSERT and return the new row's id"""
+        return conn.execute(sql, params).lastrowid
+    
+    def reserve_message_ids(self, count):
+        """Claim count message ids that no other writer will use; returns them in order"""
+        # AUTOINCREMENT never reuses ids at or below sqlite_sequence, so
+        # advancing it claims a block that other writers will skip
+        with self.transaction() as conn:
+            row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'messages'").fetchone()
+            highest = conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+            start = max(row[0] if row else 0, highest)
+            if row:
+                conn.execute("UPDATE sqlite_sequence SET seq = ? WHERE name = 'messages'", (start + count,))
+            else:
+                conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('messages', ?)", (start + count,))
+        return range(start + 1, start + count + 1)
+    
+    def create_user(self, username, password):
+        password_hash = _password_executor.submit(_hash_password, password).result()
         
         try:
-            cursor.execute(
-                "INSERT INTO users (username, password_hash) VALUES (?, ?)",
-                (username, password_hash)
-            )
-            user_id = cursor.lastrowid
-            conn.commit()
-            return user_id
-        except sqlite3.IntegrityError:
+            with self.transaction() as conn:
+                return self._insert(
+                    conn,
+                    "INSERT INTO users (username, password_hash) VALUES (?, ?)",
+                    (username, password_hash)
+                )
+        except self.IntegrityError:
             return None
-        finally:
-            conn.close()
     
     def verify_user(self, username, password):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        conn = self.get_connection()
+        result = conn.execute(
+            "SELECT id, password_hash FROM users WHERE username = ?", (username,)
+        ).fetchone()
+        if not result:
+            return None
         
-        cursor.execute("SELECT id, password_hash FROM users WHERE username = ?", (username,))
-        result = cursor.fetchone()
-        conn.close()
+        user_id, password_hash = result
+        if isinstance(password_hash, str):
+            password_hash = password_hash.encode('utf-8')
+        if not _password_executor.submit(_check_password, password, password_hash).result():
+            return None
         
-        if result and bcrypt.checkpw(password.encode('utf-8'), result[1]):
-            return result[0]
-        return None
+        # Upgrade hashes made with an old work factor while we have the password
+        if _bcrypt_rounds(password_hash) != BCRYPT_ROUNDS:
+            new_hash = _password_executor.submit(_hash_password, password).result()
+            with self.transaction() as conn:
+                conn.execute("UPDATE users SET password_hash = ? WHERE id = ?", (new_hash, user_id))
+        return user_id
     
-    def create_chat_session(self, user_id, title="New Chat", system_prompt="", character_image="default.png"):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    def _get_auth_secret(self):
+        if self._auth_secret is None:
+            secret = os.getenv('AUTH_SECRET')
+            if not secret:
+                # Generated once per database by migration 6
+                conn = self.get_connection()
+                secret = conn.execute("SELECT value FROM app_settings WHERE name = 'auth_secret'").fetchone()[0]
+            self._auth_secret = secret.encode('utf-8')
+        return self._auth_secret
+    
+    def _sign(self, payload):
+        return hmac.new(self._get_auth_secret(), payload.encode('utf-8'), hashlib.sha256).hexdigest()
+    
+    def create_auth_token(self, user_id, ttl=AUTH_TOKEN_TTL):
+        """Issue a signed login token that restores the user without a password check.
         
-        cursor.execute(
-            "INSERT INTO chat_sessions (user_id, title, system_prompt, character_image) VALUES (?, ?, ?, ?)",
-            (user_id, title, system_prompt, character_image)
-        )
-        session_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-        return session_id
+        Only a hash of the token is stored, so it can be revoked but not read back.
+        """
+        payload = f"{user_id}.{secrets.token_urlsafe(24)}"
+        token = f"{payload}.{self._sign(payload)}"
+        now = time.time()
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM auth_tokens WHERE expires_at < ?", (now,))
+            conn.execute(
+                "INSERT INTO auth_tokens (token_hash, user_id, expires_at) VALUES (?, ?, ?)",
+                (hashlib.sha256(token.encode('utf-8')).hexdigest(), user_id, now + ttl)
+            )
+        return token
     
-    def get_user_sessions(self, user_id):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    def verify_auth_token(self, token):
+        """Return (user_id, username) for a valid, unexpired token, or None"""
+        payload, _, signature = token.rpartition('.')
+        if not payload or not hmac.compare_digest(self._sign(payload), signature):
+            return None
         
-        cursor.execute(
+        conn = self.get_connection()
+        return conn.execute(
+            """SELECT users.id, users.username FROM auth_tokens
+               JOIN users ON users.id = auth_tokens.user_id
+               WHERE auth_tokens.token_hash = ? AND auth_tokens.expires_at > ?""",
+            (hashlib.sha256(token.encode('utf-8')).hexdigest(), time.time())
+        ).fetchone()
+    
+    def revoke_auth_token(self, token):
+        with self.transaction() as conn:
+            conn.execute(
+                "DELETE FROM auth_tokens WHERE token_hash = ?",
+                (hashlib.sha256(token.encode('utf-8')).hexdigest(),)
+            )
+    
+    def create_chat_session(self, user_id, title="New Chat", system_prompt="", character_image="default.png"):
+        with self.transaction() as conn:
+            return self._insert(
+                conn,
+                "INSERT INTO chat_sessions (user_id, title, system_prompt, character_image) VALUES (?, ?, ?, ?)",
+                (user_id, title, system_prompt, character_image)
+            )
+    
+    def get_user_sessions(self, user_id):
+        self._sync()
+        conn = self.get_connection()
+        return conn.execute(
             "SELECT id, title, created_at, system_prompt, character_image FROM chat_sessions WHERE user_id = ? ORDER BY created_at DESC",
             (user_id,)
-        )
-        sessions = cursor.fetchall()
-        conn.close()
-        return sessions
+        ).fetchall()
+    
+    def flush(self):
+        """Durability barrier: return once every buffered write is committed"""
+        if self._writes is not None:
+            self._writes.flush()
+    
+    def _sync(self, session_id=None):
+        # Read-your-writes: commit buffered writes for the session before reading it
+        if self._writes is not None:
+            self._writes.sync(session_id)
     
     def add_message(self, session_id, role, content):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            "INSERT INTO messages (session_id, role, content) VALUES (?, ?, ?)",
-            (session_id, role, content)
-        )
-        conn.commit()
-        conn.close()
+        if self._writes is not None:
+            return self._writes.add_message(session_id, role, content)
+        with self.transaction() as conn:
+            return self._insert(
+                conn,
+                "INSERT INTO messages (session_id, role, content) VALUES (?, ?, ?)",
+                (session_id, role, content)
+            )
     
     def get_session_messages(self, session_id):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute(
+        self._sync(session_id)
+        conn = self.get_connection()
+        return conn.execute(
             "SELECT role, content, timestamp FROM messages WHERE session_id = ? ORDER BY timestamp ASC",
             (session_id,)
-        )
-        messages = cursor.fetchall()
-        conn.close()
-        return messages
+        ).fetchall()
     
-    def update_session_character(self, session_id, character_image):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    def get_session_messages_page(self, session_id, before_id=None, limit=50):
+        """Keyset-paginate a session's messages by id, newest page first.
         
-        cursor.execute(
-            "UPDATE chat_sessions SET character_image = ? WHERE id = ?",
-            (character_image, session_id)
-        )
-        conn.commit()
-        conn.close()
+        Returns (rows, has_more) where rows are (id, role, content, timestamp)
+        in chronological order. Pass the id of the oldest row as before_id to
+        fetch the previous page.
+        """
+        self._sync(session_id)
+        conn = self.get_connection()
+        if before_id is None:
+            rows = conn.execute(
+                "SELECT id, role, content, timestamp FROM messages WHERE session_id = ? ORDER BY id DESC LIMIT ?",
+                (session_id, limit + 1)
+            ).fetchall()
+        else:
+            rows = conn.execute(
+                "SELECT id, role, content, timestamp FROM messages WHERE session_id = ? AND id < ? ORDER BY id DESC LIMIT ?",
+                (session_id, before_id, limit + 1)
+            ).fetchall()
+        
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        rows.reverse()
+        return rows, has_more
+    
+    def get_messages_by_id(self, message_ids):
+        """Return {id: (session_id, role, content, timestamp)} for those of message_ids still in messages"""
+        if not message_ids:
+            return {}
+        self._sync()
+        conn = self.get_connection()
+        placeholders = ', '.join('?' * len(message_ids))
+        rows = conn.execute(
+            f"SELECT id, session_id, role, content, timestamp FROM messages WHERE id IN ({placeholders})",
+            list(message_ids)
+        ).fetchall()
+        return {row[0]: tuple(row[1:]) for row in rows}
+    
+    def count_session_messages(self, session_id):
+        self._sync(session_id)
+        conn = self.get_connection()
+        return conn.execute(
+            "SELECT COUNT(*) FROM messages WHERE session_id = ?", (session_id,)
+        ).fetchone()[0]
+    
+    def get_session_messages_range(self, session_id, offset, limit):
+        """Return (role, content) for messages [offset, offset + limit) of a session"""
+        self._sync(session_id)
+        conn = self.get_connection()
+        return conn.execute(
+            "SELECT role, content FROM messages WHERE session_id = ? ORDER BY id LIMIT ? OFFSET ?",
+            (session_id, limit, offset)
+        ).fetchall()
+    
+    def search_messages(self, user_id, query, limit=10, offset=0):
+        """Full-text search over a user's messages, best matches first.
+        
+        Returns (message_id, session_id, session_title, role, snippet, timestamp)
+        rows; the snippet marks matches in bold.
+        """
+        match = fts_query(query)
+        if not match:
+            return []
+        
+        self._sync()
+        conn = self.get_connection()
+        return conn.execute(
+            """SELECT messages.id, messages.session_id, chat_sessions.title, messages.role,
+                      snippet(messages_fts, 0, '**', '**', '…', 12), messages.timestamp
+               FROM messages_fts
+               JOIN messages ON messages.id = messages_fts.rowid
+               JOIN chat_sessions ON chat_sessions.id = messages.session_id
+               WHERE messages_fts MATCH ? AND chat_sessions.user_id = ?
+               ORDER BY bm25(messages_fts)
+               LIMIT ? OFFSET ?""",
+            (match, user_id, limit, offset)
+        ).fetchall()
+    
+    def update_session_character(self, session_id, character_image):
+        if self._writes is not None:
+            return self._writes.update_session(session_id, 'character_image', character_image)
+        with self.transaction() as conn:
+            conn.execute(
+                "UPDATE chat_sessions SET character_image = ? WHERE id = ?",
+                (character_image, session_id)
+            )
     
     def update_session_system_prompt(self, session_id, system_prompt):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        if self._writes is not None:
+            return self._writes.update_session(session_id, 'system_prompt', system_prompt)
+        with self.transaction() as conn:
+            conn.execute(
+                "UPDATE chat_sessions SET system_prompt = ? WHERE id = ?",
+                (system_prompt, session_id)
+            )
+    
+    def get_session_summary(self, session_id):
+        """Return (summary, covered_messages) for a session, or ("", 0)"""
+        conn = self.get_connection()
+        result = conn.execute(
+            "SELECT summary, covered_messages FROM session_summaries WHERE session_id = ?",
+            (session_id,)
+        ).fetchone()
+        return (result[0], result[1]) if result else ("", 0)
+    
+    def set_session_summary(self, session_id, summary, covered_messages):
+        with self.transaction() as conn:
+            conn.execute(
+                """INSERT INTO session_summaries (session_id, summary, covered_messages, updated_at) VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                   ON CONFLICT (session_id) DO UPDATE SET summary = excluded.summary,
+                       covered_messages = excluded.covered_messages, updated_at = excluded.updated_at""",
+                (session_id, summary, covered_messages)
+            )
+    
+    def create_job(self, user_id, session_id, model, messages, owner=None):
+        with self.transaction() as conn:
+            return self._insert(
+                conn,
+                "INSERT INTO generation_jobs (user_id, session_id, model, messages, owner, heartbeat_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (user_id, session_id, model, json.dumps(messages), owner, time.time())
+            )
+    
+    def update_job(self, job_id, status, content, error=None, message_id=None):
+        """Record a job's progress; returns False if the job was already finished.
         
-        cursor.execute(
-            "UPDATE chat_sessions SET system_prompt = ? WHERE id = ?",
-            (system_prompt, session_id)
-        )
-        conn.commit()
-        conn.close()
+        Finished jobs are left alone, except that a cancelled one still takes
+        a final 'cancelled' update recording what was saved before it stopped.
+        """
+        with self.transaction() as conn:
+            cursor = conn.execute(
+                """UPDATE generation_jobs
+                   SET status = ?, content = ?, error = ?, message_id = ?,
+                       started_at = CASE WHEN ? = 'running' AND started_at IS NULL THEN CURRENT_TIMESTAMP ELSE started_at END,
+                       finished_at = CASE WHEN ? IN ('done', 'failed', 'cancelled') THEN CURRENT_TIMESTAMP ELSE finished_at END
+                   WHERE id = ? AND (status IN ('queued', 'running') OR (status = 'cancelled' AND ? = 'cancelled'))""",
+                (status, content, error, message_id, status, status, job_id, status)
+            )
+            return cursor.rowcount > 0
+    
+    def get_job(self, job_id):
+        """Return (id, user_id, session_id, model, status, content, error, message_id) or None"""
+        conn = self.get_connection()
+        return conn.execute(
+            "SELECT id, user_id, session_id, model, status, content, error, message_id FROM generation_jobs WHERE id = ?",
+            (job_id,)
+        ).fetchone()
+    
+    def get_unfinished_jobs(self):
+        """Return (id, user_id, session_id, model, messages) for queued and running jobs, oldest first"""
+        conn = self.get_connection()
+        rows = conn.execute(
+            "SELECT id, user_id, session_id, model, messages FROM generation_jobs WHERE status IN ('queued', 'running') ORDER BY id"
+        ).fetchall()
+        return [(id, user_id, session_id, model, json.loads(messages)) for id, user_id, session_id, model, messages in rows]
+    
+    def renew_job_leases(self, owner):
+        """Mark every unfinished job owned by owner as still being worked on"""
+        with self.transaction() as conn:
+            conn.execute(
+                "UPDATE generation_jobs SET heartbeat_at = ? WHERE owner = ? AND status IN ('queued', 'running')",
+                (time.time(), owner)
+            )
+    
+    def claim_stale_jobs(self, owner, lease):
+        """Take over unfinished jobs whose owner has not renewed them for lease seconds.
+        
+        Returns (id, user_id, session_id, model, messages) for each job claimed,
+        oldest first. Each job is claimed by exactly one caller, however many
+        processes share the database.
+        """
+        now = time.time()
+        conn = self.get_connection()
+        rows = conn.execute(
+            """SELECT id, user_id, session_id, model, messages FROM generation_jobs
+               WHERE status IN ('queued', 'running') AND (heartbeat_at IS NULL OR heartbeat_at < ?)
+               ORDER BY id""",
+            (now - lease,)
+        ).fetchall()
+        
+        claimed = []
+        for id, user_id, session_id, model, messages in rows:
+            with self.transaction() as conn:
+                # Re-checked in the UPDATE, so a job another process just claimed is left alone
+                cursor = conn.execute(
+                    """UPDATE generation_jobs SET owner = ?, heartbeat_at = ?
+                       WHERE id = ? AND status IN ('queued', 'running') AND (heartbeat_at IS NULL OR heartbeat_at < ?)""",
+                    (owner, now, id, now - lease)
+                )
+            if cursor.rowcount == 1:
+                claimed.append((id, user_id, session_id, model, json.loads(messages)))
+        return claimed
+    
+    def get_session_active_job(self, session_id):
+        conn = self.get_connection()
+        result = conn.execute(
+            "SELECT id FROM generation_jobs WHERE session_id = ? AND status IN ('queued', 'running') ORDER BY id DESC LIMIT 1",
+            (session_id,)
+        ).fetchone()
+        return result[0] if result else None
+    
+    def get_cached_response(self, key):
+        """Return the cached reply for key, or None if missing or expired"""
+        now = time.time()
+        conn = self.get_connection()
+        result = conn.execute(
+            "SELECT response, expires_at FROM response_cache WHERE key = ?", (key,)
+        ).fetchone()
+        
+        if result is None or result[1] < now:
+            self.response_cache_stats['misses'] += 1
+            registry.increment('cintessa_response_cache_lookups_total', result='miss')
+            return None
+        
+        with self.transaction() as conn:
+            conn.execute(
+                "UPDATE response_cache SET last_used_at = ?, hits = hits + 1 WHERE key = ?",
+                (now, key)
+            )
+        self.response_cache_stats['hits'] += 1
+        registry.increment('cintessa_response_cache_lookups_total', result='hit')
+        return result[0]
+    
+    def put_cached_response(self, key, model, response, ttl=RESPONSE_CACHE_TTL):
+        now = time.time()
+        with self.transaction() as conn:
+            conn.execute(
+                """INSERT INTO response_cache (key, model, response, size, expires_at, last_used_at) VALUES (?, ?, ?, ?, ?, ?)
+                   ON CONFLICT (key) DO UPDATE SET model = excluded.model, response = excluded.response, size = excluded.size,
+                       expires_at = excluded.expires_at, last_used_at = excluded.last_used_at, hits = 0""",
+                (key, model, response, len(response.encode('utf-8')), now + ttl, now)
+            )
+            self._evict_cached_responses(conn, now)
+    
+    def _evict_cached_responses(self, conn, now):
+        conn.execute("DELETE FROM response_cache WHERE expires_at < ?", (now,))
+        count, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM response_cache").fetchone()
+        
+        # Drop least recently used entries until both limits hold
+        evicted = 0
+        while count > RESPONSE_CACHE_MAX_ENTRIES or size > RESPONSE_CACHE_MAX_BYTES:
+            result = conn.execute(
+                "SELECT key, size FROM response_cache ORDER BY last_used_at LIMIT 1"
+            ).fetchone()
+            if result is None:
+                break
+            conn.execute("DELETE FROM response_cache WHERE key = ?", (result[0],))
+            count -= 1
+            size -= result[1]
+            evicted += 1
+        self.response_cache_stats['evictions'] += evicted
+        if evicted:
+            registry.increment('cintessa_response_cache_evictions_total', evicted)
     
     def set_user_memory(self, user_id, key, value):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        with self.transaction() as conn:
+            conn.execute(
+                """INSERT INTO user_memory (user_id, key, value) VALUES (?, ?, ?)
+                   ON CONFLICT (user_id, key) DO UPDATE SET value = excluded.value, updated_at = CURRENT_TIMESTAMP""",
+                (user_id, key, value)
+            )
+            conn.execute(
+                """DELETE FROM user_memory WHERE user_id = ? AND id NOT IN (
+                       SELECT id FROM user_memory WHERE user_id = ? ORDER BY updated_at DESC, id DESC LIMIT ?
+                   )""",
+                (user_id, user_id, MEMORY_MAX_PER_USER)
+            )
+        self._invalidate_memories(user_id)
+    
+    def delete_user_memory(self, user_id, key):
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM user_memory WHERE user_id = ? AND key = ?", (user_id, key))
+        self._invalidate_memories(user_id)
+    
+    def get_user_memories(self, user_id):
+        """All of a user's memories as {key: value}, most recently updated first"""
+        if self.CACHE_MEMORIES:
+            with self._memory_lock:
+                cached = self._memory_cache.get(user_id)
+            if cached is not None:
+                return cached
         
-        cursor.execute(
-            "INSERT OR REPLACE INTO user_memory (user_id, key, value) VALUES (?, ?, ?)",
-            (user_id, key, value)
-        )
-        conn.commit()
-        conn.close()
+        conn = self.get_connection()
+        rows = conn.execute(
+            "SELECT key, value FROM user_memory WHERE user_id = ? ORDER BY updated_at DESC, id DESC",
+            (user_id,)
+        ).fetchall()
+        memories = dict(rows)
+        if self.CACHE_MEMORIES:
+            with self._memory_lock:
+                self._memory_cache[user_id] = memories
+        return memories
     
     def get_user_memory(self, user_id, key):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        return self.get_user_memories(user_id).get(key)
+    
+    def _invalidate_memories(self, user_id):
+        with self._memory_lock:
+            self._memory_cache.pop(user_id, None)
+    
+    def get_idle_sessions(self, cutoff, limit=100):
+        """Ids of sessions with messages, none of them newer than cutoff.
         
-        cursor.execute(
-            "SELECT value FROM user_memory WHERE user_id = ? AND key = ?",
-            (user_id, key)
-        )
-        result = cursor.fetchone()
-        conn.close()
-        return result[0] if result else None
+        cutoff is a 'YYYY-MM-DD HH:MM:SS' UTC string, like message timestamps.
+        Sessions restored from the archive since cutoff are skipped.
+        """
+        conn = self.get_connection()
+        return [row[0] for row in conn.execute(
+            """SELECT id FROM chat_sessions
+               WHERE created_at < ? AND (restored_at IS NULL OR restored_at < ?)
+                 AND EXISTS (SELECT 1 FROM messages WHERE session_id = chat_sessions.id)
+                 AND NOT EXISTS (SELECT 1 FROM messages WHERE session_id = chat_sessions.id AND timestamp >= ?)
+               LIMIT ?""",
+            (cutoff, cutoff, cutoff, limit)
+        )]
+    
+    def archive_session(self, session_id):
+        """Move a session's messages into one compressed session_archive row.
+        
+        Returns (message_count, raw_size, compressed_size). Archived messages
+        drop out of search until the session is restored.
+        """
+        self._sync(session_id)
+        with self.transaction() as conn:
+            rows = conn.execute(
+                "SELECT id, role, content, timestamp FROM messages WHERE session_id = ? ORDER BY id",
+                (session_id,)
+            ).fetchall()
+            if not rows:
+                return 0, 0, 0
+            # A session archived before and written to since gets one combined blob
+            previous = conn.execute(
+                "SELECT data FROM session_archive WHERE session_id = ?", (session_id,)
+            ).fetchone()
+            if previous:
+                rows = json.loads(zlib.decompress(previous[0])) + rows
+            raw = json.dumps(rows, ensure_ascii=False).encode('utf-8')
+            data = zlib.compress(raw, ARCHIVE_COMPRESSION_LEVEL)
+            conn.execute(
+                """INSERT INTO session_archive (session_id, message_count, raw_size, data) VALUES (?, ?, ?, ?)
+                   ON CONFLICT (session_id) DO UPDATE SET message_count = excluded.message_count,
+                       raw_size = excluded.raw_size, data = excluded.data, archived_at = CURRENT_TIMESTAMP""",
+                (session_id, len(rows), len(raw), data)
+            )
+            conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+        return len(rows), len(raw), len(data)
+    
+    def restore_session(self, session_id):
+        """Move an archived session's messages back, keeping their ids and timestamps.
+        
+        Returns the number of messages restored, 0 if the session wasn't archived.
+        """
+        conn = self.get_connection()
+        if conn.execute("SELECT 1 FROM session_archive WHERE session_id = ?", (session_id,)).fetchone() is None:
+            return 0
+        with self.transaction() as conn:
+            row = conn.execute("SELECT data FROM session_archive WHERE session_id = ?", (session_id,)).fetchone()
+            if row is None:
+                return 0
+            rows = json.loads(zlib.decompress(row[0]))
+            conn.executemany(
+                "INSERT INTO messages (id, session_id, role, content, timestamp) VALUES (?, ?, ?, ?, ?) ON CONFLICT DO NOTHING",
+                [(id, session_id, role, content, timestamp) for id, role, content, timestamp in rows]
+            )
+            conn.execute("DELETE FROM session_archive WHERE session_id = ?", (session_id,))
+            conn.execute("UPDATE chat_sessions SET restored_at = CURRENT_TIMESTAMP WHERE id = ?", (session_id,))
+        return len(rows)
+    
+    def is_session_archived(self, session_id):
+        conn = self.get_connection()
+        return conn.execute(
+            "SELECT 1 FROM session_archive WHERE session_id = ?", (session_id,)
+        ).fetchone() is not None
+    
+    def reclaim_space(self, max_pages=None, convert=False):
+        """Return free pages to the filesystem with an incremental vacuum.
+        
+        A database created before incremental auto-vacuum was enabled has to
+        be converted with a one-off full VACUUM, which locks out writers for
+        as long as it takes; that only happens with convert, otherwise nothing
+        is reclaimed. Returns the pages freed.
+        """
+        # The pragmas apply to the connection that runs them
+        with self.get_connection().pinned() as conn:
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                if not convert:
+                    return 0
+                conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                conn.execute("VACUUM")
+            free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            # execute() stops after the first page; executescript() steps to the end
+            conn.executescript(f"PRAGMA incremental_vacuum({int(max_pages or 0)})")
+            return free - conn.execute("PRAGMA freelist_count").fetchone()[0]
+    
+    def _stream(self, sql, params=()):
+        """Yield a query's rows as they are read, on a connection of its own"""
+        # Sets up the schema on first use
+        self.get_connection()
+        with self.pool.connection() as conn:
+            yield from conn.execute(sql, params)
+    
+    def iter_users(self, user_id=None):
+        """Stream (id, username, password_hash, created_at) rows, optionally for one user"""
+        if user_id is None:
+            return self._stream("SELECT id, username, password_hash, created_at FROM users ORDER BY id")
+        return self._stream("SELECT id, username, password_hash, created_at FROM users WHERE id = ?", (user_id,))
+    
+    def iter_sessions(self, user_id=None, after_id=0):
+        """Stream (id, username, title, created_at, system_prompt, character_image) rows in id order"""
+        self._sync()
+        query = """SELECT chat_sessions.id, users.username, chat_sessions.title, chat_sessions.created_at,
+                          chat_sessions.system_prompt, chat_sessions.character_image
+                   FROM chat_sessions JOIN users ON users.id = chat_sessions.user_id
+                   WHERE chat_sessions.id > ?"""
+        if user_id is None:
+            return self._stream(query + " ORDER BY chat_sessions.id", (after_id,))
+        return self._stream(query + " AND chat_sessions.user_id = ? ORDER BY chat_sessions.id", (after_id, user_id))
+    
+    def iter_session_messages(self, session_id, after_id=0, batch=1000):
+        """Stream a session's (id, role, content, timestamp) rows in id order.
+        
+        Reads in keyset pages of batch rows instead of loading the session
+        the way get_session_messages does. Archived sessions are read from
+        their archive blob.
+        """
+        self._sync(session_id)
+        conn = self.get_connection()
+        archived = conn.execute("SELECT data FROM session_archive WHERE session_id = ?", (session_id,)).fetchone()
+        if archived:
+            for row in json.loads(zlib.decompress(archived[0])):
+                if row[0] > after_id:
+                    yield tuple(row)
+        while True:
+            rows = conn.execute(
+                "SELECT id, role, content, timestamp FROM messages WHERE session_id = ? AND id > ? ORDER BY id LIMIT ?",
+                (session_id, after_id, batch)
+            ).fetchall()
+            yield from rows
+            if len(rows) < batch:
+                return
+            after_id = rows[-1][0]
+    
+    def import_user(self, username, password_hash, created_at):
+        """Insert a user unless the username exists; returns its id either way"""
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO users (username, password_hash, created_at) VALUES (?, ?, ?) ON CONFLICT DO NOTHING",
+                (username, password_hash, created_at)
+            )
+            return conn.execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone()[0]
+    
+    def get_user_id(self, username):
+        conn = self.get_connection()
+        row = conn.execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone()
+        return row[0] if row else None
+    
+    def import_batch(self, sessions, messages, session_ids, checkpoint=None):
+        """Insert sessions and messages under new ids in one transaction.
+        
+        sessions are (id, user_id, title, created_at, system_prompt, character_image)
+        and messages (session_id, role, content, timestamp), with the ids they
+        had where they were exported. session_ids maps exported session ids to
+        new ones: it attaches messages to sessions inserted by earlier batches
+        and is updated with this batch's once it commits. Sessions without a
+        user and messages of unknown sessions are skipped. checkpoint is an
+        optional function of the id map returning a (name, value) to save to
+        app_settings in the same transaction. Returns (sessions, messages) inserted.
+        """
+        inserted = {}
+        ids = ChainMap(inserted, session_ids)
+        with self.transaction() as conn:
+            for old_id, user_id, title, created_at, system_prompt, character_image in sessions:
+                if user_id is None:
+                    continue
+                inserted[old_id] = self._insert(
+                    conn,
+                    """INSERT INTO chat_sessions (user_id, title, created_at, system_prompt, character_image)
+                       VALUES (?, ?, ?, ?, ?)""",
+                    (user_id, title, created_at, system_prompt, character_image)
+                )
+            rows = [(ids[session_id], role, content, timestamp)
+                    for session_id, role, content, timestamp in messages if session_id in ids]
+            conn.executemany(
+                "INSERT INTO messages (session_id, role, content, timestamp) VALUES (?, ?, ?, ?)",
+                rows
+            )
+            if checkpoint:
+                conn.execute(
+                    "INSERT INTO app_settings (name, value) VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET value = excluded.value",
+                    checkpoint(ids)
+                )
+        session_ids.update(inserted)
+        return len(inserted), len(rows)
+    
+    def get_setting(self, name, default=None):
+        conn = self.get_connection()
+        row = conn.execute("SELECT value FROM app_settings WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else default
+    
+    def save_metrics(self, rows):
+        """Store (name, labels_json, count, sum) snapshots of the in-process metrics"""
+        now = time.time()
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT INTO metrics (recorded_at, name, labels, count, sum) VALUES (?, ?, ?, ?, ?)",
+                [(now, name, labels, count, total) for name, labels, count, total in rows]
+            )
+
+# Time every query method; connection plumbing and startup are left out
+UNTIMED_METHODS = (
+    'get_connection', 'transaction', 'close', 'init_db', 'migrate', 'check_query_plans', 'save_metrics',
+    'iter_users', 'iter_sessions', 'iter_session_messages'
+)
+instrument_methods(Database, 'cintessa_db_call_seconds', exclude=UNTIMED_METHODS)
+
+def open_database(url=DATABASE_URL):
+    """Open the storage backend for url: a postgresql:// URL or a SQLite file path"""
+    if url.startswith(('postgres://', 'postgresql://')):
+        # psycopg is only needed, and imported, when PostgreSQL is configured
+        from database_postgres import PostgresDatabase
+        return PostgresDatabase(url)
+    return Database(url)
 
 # Global database instance
-db = Database()
+db = open_database()
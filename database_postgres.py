@@ -0,0 +1,284 @@
+import os
+import re
+import functools
+import psycopg
+from psycopg.types.string import TextLoader
+from psycopg_pool import ConnectionPool
+from database import Database, UNTIMED_METHODS, _Connection
+from metrics import instrument_methods
+
+# Connections kept open to the server by each app process
+POSTGRES_POOL_MIN = int(os.getenv('POSTGRES_POOL_MIN', '2'))
+POSTGRES_POOL_MAX = int(os.getenv('POSTGRES_POOL_MAX', '20'))
+# Seconds a thread waits for a free pooled connection before giving up
+POSTGRES_POOL_TIMEOUT = float(os.getenv('POSTGRES_POOL_TIMEOUT', '30'))
+# Rows fetched per round trip while streaming exports and backfills
+STREAM_BATCH = 1000
+
+# Any constant will do, as long as every app process uses the same one
+SCHEMA_LOCK_ID = 0x636e7473
+
+# Timestamps are stored as UTC without a time zone, like SQLite's CURRENT_TIMESTAMP
+NOW_UTC = "(now() AT TIME ZONE 'UTC')"
+
+# The schema as of SQLite migration 11, created in one step. Versions share
+# a numbering with database.MIGRATIONS; append changes to both lists.
+POSTGRES_MIGRATIONS = [
+    (11, "Initial schema", [
+        f'''
+        CREATE TABLE IF NOT EXISTS users (
+            id BIGSERIAL PRIMARY KEY,
+            username TEXT UNIQUE NOT NULL,
+            password_hash BYTEA NOT NULL,
+            created_at TIMESTAMP(0) DEFAULT {NOW_UTC}
+        )
+        ''',
+        f'''
+        CREATE TABLE IF NOT EXISTS chat_sessions (
+            id BIGSERIAL PRIMARY KEY,
+            user_id BIGINT REFERENCES users (id),
+            title TEXT DEFAULT 'New Chat',
+            created_at TIMESTAMP(0) DEFAULT {NOW_UTC},
+            system_prompt TEXT,
+            character_image TEXT DEFAULT 'default.png',
+            restored_at TIMESTAMP(0)
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_chat_sessions_user_created ON chat_sessions (user_id, created_at DESC)",
+        f'''
+        CREATE TABLE IF NOT EXISTS messages (
+            id BIGSERIAL PRIMARY KEY,
+            session_id BIGINT REFERENCES chat_sessions (id),
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            timestamp TIMESTAMP(0) DEFAULT {NOW_UTC}
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_messages_session_timestamp ON messages (session_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_session_id ON messages (session_id, id)",
+        # Serves search_messages, which must use the same expression
+        "CREATE INDEX IF NOT EXISTS idx_messages_search ON messages USING GIN (to_tsvector('simple', content))",
+        f'''
+        CREATE TABLE IF NOT EXISTS user_memory (
+            id BIGSERIAL PRIMARY KEY,
+            user_id BIGINT REFERENCES users (id),
+            key TEXT NOT NULL,
+            value TEXT NOT NULL,
+            updated_at TIMESTAMP(0) DEFAULT {NOW_UTC}
+        )
+        ''',
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_user_memory_user_key ON user_memory (user_id, key)",
+        f'''
+        CREATE TABLE IF NOT EXISTS session_summaries (
+            session_id BIGINT PRIMARY KEY REFERENCES chat_sessions (id),
+            summary TEXT NOT NULL,
+            covered_messages INTEGER NOT NULL,
+            updated_at TIMESTAMP(0) DEFAULT {NOW_UTC}
+        )
+        ''',
+        f'''
+        CREATE TABLE IF NOT EXISTS generation_jobs (
+            id BIGSERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL REFERENCES users (id),
+            session_id BIGINT NOT NULL REFERENCES chat_sessions (id),
+            model TEXT NOT NULL,
+            messages TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            content TEXT NOT NULL DEFAULT '',
+            error TEXT,
+            message_id BIGINT,
+            created_at TIMESTAMP(0) DEFAULT {NOW_UTC},
+            started_at TIMESTAMP(0),
+            finished_at TIMESTAMP(0),
+            owner TEXT,
+            heartbeat_at DOUBLE PRECISION
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_generation_jobs_status ON generation_jobs (status, id)",
+        "CREATE INDEX IF NOT EXISTS idx_generation_jobs_session ON generation_jobs (session_id, status)",
+        '''
+        CREATE TABLE IF NOT EXISTS response_cache (
+            key TEXT PRIMARY KEY,
+            model TEXT NOT NULL,
+            response TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            expires_at DOUBLE PRECISION NOT NULL,
+            last_used_at DOUBLE PRECISION NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_response_cache_last_used ON response_cache (last_used_at)",
+        f'''
+        CREATE TABLE IF NOT EXISTS auth_tokens (
+            token_hash TEXT PRIMARY KEY,
+            user_id BIGINT NOT NULL REFERENCES users (id),
+            expires_at DOUBLE PRECISION NOT NULL,
+            created_at TIMESTAMP(0) DEFAULT {NOW_UTC}
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS app_settings (
+            name TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+        ''',
+        # 64 hex digits from the server's strong random source
+        '''
+        INSERT INTO app_settings (name, value)
+        VALUES ('auth_secret', replace(gen_random_uuid()::text || gen_random_uuid()::text, '-', ''))
+        ON CONFLICT DO NOTHING
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS metrics (
+            id BIGSERIAL PRIMARY KEY,
+            recorded_at DOUBLE PRECISION NOT NULL,
+            name TEXT NOT NULL,
+            labels TEXT NOT NULL,
+            count DOUBLE PRECISION NOT NULL,
+            sum DOUBLE PRECISION NOT NULL
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_metrics_name_recorded ON metrics (name, recorded_at)",
+        f'''
+        CREATE TABLE IF NOT EXISTS session_archive (
+            session_id BIGINT PRIMARY KEY REFERENCES chat_sessions (id),
+            message_count INTEGER NOT NULL,
+            raw_size INTEGER NOT NULL,
+            data BYTEA NOT NULL,
+            archived_at TIMESTAMP(0) DEFAULT {NOW_UTC}
+        )
+        ''',
+    ]),
+]
+
+@functools.lru_cache(maxsize=512)
+def _placeholders(sql):
+    # The shared queries use SQLite's ? placeholders; psycopg wants %s
+    return sql.replace('%', '%%').replace('?', '%s')
+
+def search_query(text):
+    """Turn free text into a tsquery: every word must match, the last as a prefix"""
+    terms = re.findall(r'\w+', text)
+    if terms:
+        terms[-1] += ':*'
+    return ' & '.join(terms)
+
+class _PostgresConnection(_Connection):
+    def _sql(self, sql):
+        return _placeholders(sql)
+
+def _configure(conn):
+    # Hand timestamps back as 'YYYY-MM-DD HH:MM:SS' text, as sqlite3 does
+    conn.adapters.register_loader('timestamp', TextLoader)
+    conn.adapters.register_loader('timestamptz', TextLoader)
+
+class PostgresDatabase(Database):
+    """Storage on a PostgreSQL server, shared by any number of app processes.
+    
+    Connections come from a bounded pool and are only borrowed for a
+    statement or transaction at a time, so threads that wait, such as those
+    following a reply, don't tie one up.
+    """
+    
+    IntegrityError = psycopg.IntegrityError
+    # The server serialises conflicting writes itself
+    BEGIN = "BEGIN"
+    # Another process may change a user's memories at any time
+    CACHE_MEMORIES = False
+    MIGRATIONS = POSTGRES_MIGRATIONS
+    CONNECTION = _PostgresConnection
+    
+    def __init__(self, url, min_size=POSTGRES_POOL_MIN, max_size=POSTGRES_POOL_MAX):
+        super().__init__(url)
+        self._schema_key = url
+        # Autocommit like the SQLite connections; transaction() issues BEGIN itself
+        self.pool = ConnectionPool(
+            url,
+            min_size=min_size,
+            max_size=max_size,
+            timeout=POSTGRES_POOL_TIMEOUT,
+            kwargs={'autocommit': True, 'options': '-c TimeZone=UTC'},
+            configure=_configure,
+            name='cintessa',
+            open=True
+        )
+    
+    def _stream(self, sql, params=()):
+        # Sets up the schema on first use
+        self.get_connection()
+        # A named cursor lives on the server, which hands rows over a batch at a
+        # time rather than all at once; it needs a transaction to live in
+        with self.pool.connection() as conn, conn.transaction():
+            with conn.cursor(name='cintessa_stream') as cursor:
+                cursor.itersize = STREAM_BATCH
+                cursor.execute(_placeholders(sql), params)
+                yield from cursor
+    
+    def init_db(self):
+        conn = self.get_connection()
+        if conn.execute("SELECT to_regclass('schema_version')").fetchone()[0]:
+            if self.get_schema_version() >= self.MIGRATIONS[-1][0]:
+                return
+        
+        # Processes starting together take turns; the others find it done.
+        # The lock belongs to the server session, so one connection is held.
+        with conn.pinned():
+            conn.execute("SELECT pg_advisory_lock(?)", (SCHEMA_LOCK_ID,))
+            try:
+                conn.execute(f'''
+                    CREATE TABLE IF NOT EXISTS schema_version (
+                        version INTEGER PRIMARY KEY,
+                        description TEXT NOT NULL,
+                        applied_at TIMESTAMP(0) DEFAULT {NOW_UTC}
+                    )
+                ''')
+                self.migrate()
+            finally:
+                conn.execute("SELECT pg_advisory_unlock(?)", (SCHEMA_LOCK_ID,))
+    
+    def check_query_plans(self):
+        # The planner rightly prefers sequential scans on small tables, so
+        # plans taken at startup say nothing about the indexes
+        return {}
+    
+    def _insert(self, conn, sql, params):
+        return conn.execute(sql + " RETURNING id", params).fetchone()[0]
+    
+    def reserve_message_ids(self, count):
+        conn = self.get_connection()
+        rows = conn.execute(
+            "SELECT nextval(pg_get_serial_sequence('messages', 'id')) FROM generate_series(1, ?)", (count,)
+        ).fetchall()
+        # Sequence values are never handed out twice, though other writers may interleave
+        return sorted(row[0] for row in rows)
+    
+    def search_messages(self, user_id, query, limit=10, offset=0):
+        match = search_query(query)
+        if not match:
+            return []
+        
+        self._sync()
+        conn = self.get_connection()
+        return conn.execute(
+            """SELECT messages.id, messages.session_id, chat_sessions.title, messages.role,
+                      ts_headline('simple', messages.content, query, 'StartSel=**, StopSel=**, MaxWords=12, MinWords=4'),
+                      messages.timestamp
+               FROM messages
+               JOIN chat_sessions ON chat_sessions.id = messages.session_id,
+                    to_tsquery('simple', ?) query
+               WHERE to_tsvector('simple', messages.content) @@ query AND chat_sessions.user_id = ?
+               ORDER BY ts_rank(to_tsvector('simple', messages.content), query) DESC, messages.id DESC
+               LIMIT ? OFFSET ?""",
+            (match, user_id, limit, offset)
+        ).fetchall()
+    
+    def reclaim_space(self, max_pages=None, convert=False):
+        """VACUUM the tables archiving empties; returns the pages given back to the filesystem"""
+        conn = self.get_connection()
+        size = "SELECT (pg_relation_size('messages') + pg_relation_size('session_archive')) / current_setting('block_size')::int"
+        before = conn.execute(size).fetchone()[0]
+        # Needs autocommit, which this connection is in outside transaction()
+        conn.execute("VACUUM messages, session_archive")
+        return before - conn.execute(size).fetchone()[0]
+
+instrument_methods(PostgresDatabase, 'cintessa_db_call_seconds', exclude=UNTIMED_METHODS)
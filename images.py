@@ -0,0 +1,115 @@
+import os
+import hashlib
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif')
+
+THUMBNAIL_DIR = os.getenv('THUMBNAIL_DIR', '.thumbnails')
+# Longest edge in pixels; twice the displayed width so thumbnails stay sharp on HiDPI screens
+THUMBNAIL_SIZE = int(os.getenv('THUMBNAIL_SIZE', '200'))
+THUMBNAIL_WORKERS = int(os.getenv('THUMBNAIL_WORKERS', '2'))
+
+_executor = ThreadPoolExecutor(max_workers=THUMBNAIL_WORKERS, thread_name_prefix="thumbnails")
+_lock = threading.Lock()
+# directory -> (mtime_ns, [filenames])
+_listings = {}
+# path -> ((mtime_ns, size), content hash)
+_hashes = {}
+# thumbnail path -> Future, while it is being generated
+_pending = {}
+
+def list_images(directory):
+    """Image filenames in directory, rescanned only when its mtime changes"""
+    try:
+        mtime = os.stat(directory).st_mtime_ns
+    except FileNotFoundError:
+        os.makedirs(directory)
+        mtime = os.stat(directory).st_mtime_ns
+    
+    with _lock:
+        cached = _listings.get(directory)
+        if cached and cached[0] == mtime:
+            return cached[1]
+    
+    images = sorted(f for f in os.listdir(directory) if f.lower().endswith(IMAGE_EXTENSIONS))
+    with _lock:
+        _listings[directory] = (mtime, images)
+    
+    # Generate thumbnails for new files ahead of the first request
+    for filename in images:
+        _submit(os.path.join(directory, filename), THUMBNAIL_SIZE)
+    return images
+
+def _content_hash(path):
+    stat = os.stat(path)
+    key = (stat.st_mtime_ns, stat.st_size)
+    with _lock:
+        cached = _hashes.get(path)
+        if cached and cached[0] == key:
+            return cached[1]
+    
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    content_hash = digest.hexdigest()[:32]
+    with _lock:
+        _hashes[path] = (key, content_hash)
+    return content_hash
+
+@functools.lru_cache(maxsize=None)
+def _thumbnail_format():
+    # Pillow is only imported once a thumbnail is actually needed
+    from PIL import features
+    return 'WEBP' if features.check('webp') else 'PNG'
+
+def _thumbnail_path(path, size):
+    extension = _thumbnail_format().lower()
+    return os.path.join(THUMBNAIL_DIR, f"{_content_hash(path)}_{size}.{extension}")
+
+def _generate(source, target, size):
+    from PIL import Image
+    with Image.open(source) as image:
+        image.thumbnail((size, size))
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA')
+        # Write then rename so readers never see a half-written file
+        partial = f"{target}.{threading.get_ident()}.tmp"
+        image.save(partial, _thumbnail_format())
+    os.replace(partial, target)
+    return target
+
+def _submit(path, size):
+    target = _thumbnail_path(path, size)
+    if os.path.exists(target):
+        return None
+    
+    with _lock:
+        future = _pending.get(target)
+        if future is None:
+            os.makedirs(THUMBNAIL_DIR, exist_ok=True)
+            future = _executor.submit(_generate, path, target, size)
+            _pending[target] = future
+            future.add_done_callback(lambda _: _discard_pending(target))
+        return future
+
+def _discard_pending(target):
+    with _lock:
+        _pending.pop(target, None)
+
+def get_thumbnail(path, size=THUMBNAIL_SIZE):
+    """Path of a cached, downsized copy of the image at path.
+    
+    Thumbnails are keyed by content hash, so replacing an image produces a
+    new one. Falls back to the original if the image cannot be read.
+    """
+    try:
+        future = _submit(path, size)
+        if future is not None:
+            return future.result()
+        return _thumbnail_path(path, size)
+    except Exception as e:
+        print(f"Error creating thumbnail for {path}: {e}")
+        return path
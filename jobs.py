@@ -0,0 +1,442 @@
+import os
+import socket
+import threading
+import uuid
+import time
+from collections import deque
+from queue import Queue, Empty
+from database import db, RESPONSE_CACHE_ENABLED, response_cache_key, is_cacheable
+from backends import pool, DeadlineExceeded
+from metrics import registry, record_ollama_response
+from warmup import warmer
+from context import prompt_tokens
+import recall
+
+# Concurrent generations sent to the backend; match Ollama's OLLAMA_NUM_PARALLEL
+GENERATION_CONCURRENCY = int(os.getenv('GENERATION_CONCURRENCY', '2'))
+# Running jobs allowed per user, so one heavy user cannot occupy every worker
+MAX_RUNNING_PER_USER = int(os.getenv('MAX_RUNNING_PER_USER', '1'))
+# How often a running job's partial output is written back to the database
+JOB_FLUSH_INTERVAL = float(os.getenv('JOB_FLUSH_INTERVAL', '1.0'))
+FINISHED_JOB_RETENTION = 60
+# How often a job waiting on Ollama checks whether it was stopped
+STOP_POLL_INTERVAL = 0.1
+# Jobs are leased to the process that runs them; one not renewed for this
+# long is taken over by another process sharing the database
+JOB_LEASE_SECONDS = float(os.getenv('JOB_LEASE_SECONDS', '30'))
+
+# Backpressure: jobs allowed to wait, in all and per user, before new ones are
+# turned away, and how long a job may wait for a worker before it gives up
+MAX_QUEUED_JOBS = int(os.getenv('MAX_QUEUED_JOBS', '32'))
+MAX_QUEUED_PER_USER = int(os.getenv('MAX_QUEUED_PER_USER', '2'))
+JOB_QUEUE_TIMEOUT = float(os.getenv('JOB_QUEUE_TIMEOUT', '120'))
+# A job nobody has watched for this long, e.g. because the tab was closed, is cancelled
+JOB_DISCONNECT_GRACE = float(os.getenv('JOB_DISCONNECT_GRACE', '15'))
+
+def _parse_limits(value):
+    limits = {}
+    for item in value.split(','):
+        if '=' in item:
+            model, limit = item.rsplit('=', 1)
+            limits[model.strip()] = float(limit)
+    return limits
+
+# Seconds a reply may take to generate, and the most tokens it may have (0 for
+# the model's own limit). The *_PER_MODEL settings override them per model,
+# e.g. "llama2=120,mistral=60".
+GENERATION_DEADLINE = float(os.getenv('GENERATION_DEADLINE', '300'))
+GENERATION_DEADLINES = _parse_limits(os.getenv('GENERATION_DEADLINES', ''))
+MAX_REPLY_TOKENS = int(os.getenv('MAX_REPLY_TOKENS', '0'))
+MAX_REPLY_TOKENS_PER_MODEL = _parse_limits(os.getenv('MAX_REPLY_TOKENS_PER_MODEL', ''))
+# Sampling temperature and seed sent with every reply; empty keeps the
+# model's defaults. GENERATION_TEMPERATURES overrides the temperature per
+# model. Only replies at temperature 0 or with a seed can be cached.
+GENERATION_TEMPERATURE = os.getenv('GENERATION_TEMPERATURE', '')
+GENERATION_TEMPERATURES = _parse_limits(os.getenv('GENERATION_TEMPERATURES', ''))
+GENERATION_SEED = os.getenv('GENERATION_SEED', '')
+
+def get_deadline(model):
+    return GENERATION_DEADLINES.get(model, GENERATION_DEADLINE)
+
+def get_max_tokens(model):
+    return int(MAX_REPLY_TOKENS_PER_MODEL.get(model, MAX_REPLY_TOKENS))
+
+def get_sampling(model):
+    """The configured temperature and seed for model, as Ollama options"""
+    sampling = {}
+    temperature = GENERATION_TEMPERATURES.get(model, GENERATION_TEMPERATURE)
+    if temperature != '':
+        sampling['temperature'] = float(temperature)
+    if GENERATION_SEED != '':
+        sampling['seed'] = int(GENERATION_SEED)
+    return sampling
+
+def generation_options(model, options=None):
+    """Sampling options for a request, over the configured sampling, with the model's reply token cap applied"""
+    options = {**get_sampling(model), **(options or {})}
+    max_tokens = get_max_tokens(model)
+    if max_tokens > 0 and 'num_predict' not in options:
+        options['num_predict'] = max_tokens
+    return options or None
+
+_END = object()
+
+def _read_stream(stream, chunks, stop):
+    # Runs on its own thread so the worker can leave a stream that is stuck
+    # waiting on Ollama; the stream is closed as soon as it yields again or
+    # its read timeout runs out
+    try:
+        for chunk in stream:
+            if stop.is_set():
+                break
+            chunks.put(chunk)
+    except Exception as e:
+        chunks.put(e)
+    finally:
+        # Closing the stream drops the connection, which makes Ollama stop generating
+        stream.close()
+        chunks.put(_END)
+
+class Overloaded(Exception):
+    """Raised by JobQueue.submit when the queue is too long to take another job"""
+
+class Job:
+    def __init__(self, job_id, user_id, session_id, model, messages, options=None):
+        self.id = job_id
+        self.user_id = user_id
+        self.session_id = session_id
+        self.model = model
+        self.messages = messages
+        # Sampling options for Ollama; None uses the model's defaults
+        self.options = options
+        self.status = 'queued'
+        self.chunks = []
+        self.error = None
+        self.message_id = None
+        self.created_at = time.monotonic()
+        self.started_at = None
+        self.first_token_at = None
+        self.finished_at = None
+        # Time Ollama spent loading the model for this request
+        self.load_seconds = 0.0
+        self.cancelled = threading.Event()
+        # Returns whether whoever follows the job is still connected
+        self.watcher = None
+        self.unwatched_since = None
+    
+    @property
+    def content(self):
+        return ''.join(self.chunks)
+    
+    @property
+    def finished(self):
+        return self.status in ('done', 'failed', 'cancelled')
+    
+    def is_watched(self):
+        """False once the job's follower has been gone for JOB_DISCONNECT_GRACE seconds"""
+        if self.watcher is None or self.watcher():
+            self.unwatched_since = None
+            return True
+        if self.unwatched_since is None:
+            self.unwatched_since = time.monotonic()
+        return time.monotonic() - self.unwatched_since < JOB_DISCONNECT_GRACE
+
+class JobQueue:
+    """Generation jobs serviced by a bounded worker pool.
+    
+    Users with queued work are served round-robin, so each gets a turn
+    regardless of how many jobs they have submitted. Job state is written to
+    the database. Each job is leased to the process that queued it, and jobs
+    whose process stopped renewing its leases, after a crash or restart, are
+    picked up by whichever process sharing the database claims them first.
+    
+    Jobs can be cancelled, stop at their model's deadline, and are cancelled
+    once nobody follows them any more. When too many jobs are already waiting,
+    submit() raises Overloaded instead of queueing more.
+    """
+    
+    def __init__(self, db, concurrency=GENERATION_CONCURRENCY, max_running_per_user=MAX_RUNNING_PER_USER):
+        self.db = db
+        self.concurrency = concurrency
+        self.max_running_per_user = max_running_per_user
+        self._condition = threading.Condition()
+        self._jobs = {}
+        self._queues = {}
+        self._order = deque()
+        self._running = {}
+        self._workers = []
+        # Identifies this process's jobs in the database
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    
+    def start(self):
+        """Start the workers and take over jobs left unfinished by a stopped process"""
+        with self._condition:
+            if self._workers:
+                return
+            for i in range(self.concurrency):
+                worker = threading.Thread(target=self._work, name=f"generation-{i}", daemon=True)
+                worker.start()
+                self._workers.append(worker)
+            threading.Thread(target=self._keep_leases, name="job-leases", daemon=True).start()
+        
+        self._claim_stale_jobs()
+    
+    def _claim_stale_jobs(self):
+        for job_id, user_id, session_id, model, messages in self.db.claim_stale_jobs(self.owner, JOB_LEASE_SECONDS):
+            self._enqueue(Job(job_id, user_id, session_id, model, messages))
+    
+    def _keep_leases(self):
+        while True:
+            time.sleep(JOB_LEASE_SECONDS / 3)
+            try:
+                self.db.renew_job_leases(self.owner)
+                self._claim_stale_jobs()
+            except Exception as e:
+                print(f"Error renewing job leases: {e}")
+    
+    def check_capacity(self, user_id):
+        """Raise Overloaded if a new job from user_id would not be accepted"""
+        with self._condition:
+            waiting = sum(len(queue) for queue in self._queues.values())
+            if waiting >= MAX_QUEUED_JOBS:
+                registry.increment('cintessa_jobs_rejected_total', reason='overloaded')
+                raise Overloaded(f"Cintessa is overloaded, {waiting} requests are already waiting. Please try again shortly.")
+            if len(self._queues.get(user_id, ())) >= MAX_QUEUED_PER_USER:
+                registry.increment('cintessa_jobs_rejected_total', reason='user_queue_full')
+                raise Overloaded("You already have replies waiting; wait for them or stop one first.")
+    
+    def submit(self, user_id, session_id, model, messages, options=None):
+        self.start()
+        self.check_capacity(user_id)
+        job_id = self.db.create_job(user_id, session_id, model, messages, owner=self.owner)
+        self._enqueue(Job(job_id, user_id, session_id, model, messages, options))
+        return job_id
+    
+    def get(self, job_id):
+        """Live job state, or a Job rebuilt from the database once it has left memory"""
+        with self._condition:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            return job
+        
+        row = self.db.get_job(job_id)
+        if row is None:
+            return None
+        id, user_id, session_id, model, status, content, error, message_id = row
+        job = Job(id, user_id, session_id, model, [])
+        job.status = status
+        job.chunks = [content]
+        job.error = error
+        job.message_id = message_id
+        return job
+    
+    def queued_count(self):
+        with self._condition:
+            return sum(len(queue) for queue in self._queues.values())
+    
+    def position(self, job_id):
+        """Jobs that will start before this queued one, or None if it isn't queued here"""
+        with self._condition:
+            job = self._jobs.get(job_id)
+            if job is None or job.status != 'queued':
+                return None
+            queue = self._queues.get(job.user_id)
+            if queue is None or job not in queue:
+                return None
+            # Users take turns, so each other user's queue can get in first once per own job
+            mine = queue.index(job)
+            return mine + sum(min(len(other), mine + 1) for user, other in self._queues.items() if user != job.user_id)
+    
+    def watch(self, job_id, watcher):
+        """Have watcher() say whether the job's follower is still connected"""
+        with self._condition:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.watcher = watcher
+                job.unwatched_since = None
+    
+    def cancel(self, job_id):
+        """Stop a job: a queued one never starts, a running one stops right away"""
+        with self._condition:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.cancelled.set()
+                queue = self._queues.get(job.user_id)
+                if job.status == 'queued' and queue is not None and job in queue:
+                    queue.remove(job)
+                    if not queue:
+                        del self._queues[job.user_id]
+                        self._order.remove(job.user_id)
+                    job.error = "Stopped"
+                    job.finished_at = time.monotonic()
+                    job.status = 'cancelled'
+        # Also reaches a job that another process is running
+        self.db.update_job(job_id, 'cancelled', job.content if job else '', "Stopped")
+    
+    def _enqueue(self, job):
+        with self._condition:
+            # Finished jobs stay around briefly so followers see their live state
+            now = time.monotonic()
+            for job_id, finished in list(self._jobs.items()):
+                if finished.finished_at and now - finished.finished_at > FINISHED_JOB_RETENTION:
+                    del self._jobs[job_id]
+            self._jobs[job.id] = job
+            if job.user_id not in self._queues:
+                self._queues[job.user_id] = deque()
+                self._order.append(job.user_id)
+            self._queues[job.user_id].append(job)
+            self._condition.notify()
+    
+    def _next_job(self):
+        # Caller holds the condition. Takes the next job round-robin, skipping
+        # users already at their running limit.
+        for _ in range(len(self._order)):
+            user_id = self._order.popleft()
+            if self._running.get(user_id, 0) >= self.max_running_per_user:
+                self._order.append(user_id)
+                continue
+            queue = self._queues[user_id]
+            job = queue.popleft()
+            if queue:
+                self._order.append(user_id)
+            else:
+                del self._queues[user_id]
+            self._running[user_id] = self._running.get(user_id, 0) + 1
+            return job
+        return None
+    
+    def _work(self):
+        while True:
+            with self._condition:
+                job = self._next_job()
+                while job is None:
+                    self._condition.wait()
+                    job = self._next_job()
+            
+            try:
+                self._run(job)
+            except Exception as e:
+                # A database error fails the job, not the worker running it
+                print(f"Error running job {job.id}: {e}")
+                self._fail(job, e)
+            finally:
+                with self._condition:
+                    self._running[job.user_id] -= 1
+                    # A slot for this user opened up
+                    self._condition.notify_all()
+    
+    def _run(self, job):
+        job.started_at = time.monotonic()
+        registry.observe('cintessa_chat_stage_seconds', job.started_at - job.created_at, stage='queue_wait')
+        if job.cancelled.is_set() or not job.is_watched() or not self.db.update_job(job.id, 'running', ''):
+            # Stopped, abandoned or cancelled elsewhere while it waited
+            self._cancel(job)
+            return
+        if job.started_at - job.created_at > JOB_QUEUE_TIMEOUT:
+            job.error = f"Cintessa is overloaded: the request waited over {JOB_QUEUE_TIMEOUT:.0f}s for a free slot. Please try again."
+            registry.increment('cintessa_jobs_rejected_total', reason='queue_timeout')
+            self._finish(job)
+            return
+        job.status = 'running'
+        last_flush = time.monotonic()
+        deadline = job.started_at + get_deadline(job.model)
+        options = generation_options(job.model, job.options)
+        
+        cache_key = None
+        if RESPONSE_CACHE_ENABLED and is_cacheable(options):
+            cache_key = response_cache_key(job.model, job.messages, options)
+            cached = self.db.get_cached_response(cache_key)
+            if cached is not None:
+                job.first_token_at = time.monotonic()
+                job.chunks.append(cached)
+                self._finish(job)
+                return
+        
+        warmer.touch(job.model)
+        # Pinning the session to one backend keeps its prompt cache warm
+        stream = pool.chat(model=job.model, messages=job.messages, stream=True, options=options,
+                           keep_alive=warmer.keep_alive(job.model), affinity=job.session_id, deadline=deadline)
+        chunks = Queue()
+        stop = threading.Event()
+        threading.Thread(target=_read_stream, args=(stream, chunks, stop), name=f"stream-{job.id}", daemon=True).start()
+        try:
+            # Waits in short slices so Stop and the deadline take effect even
+            # while Ollama is still loading the model or reading the prompt
+            while not job.cancelled.is_set():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise DeadlineExceeded()
+                if time.monotonic() - last_flush >= JOB_FLUSH_INTERVAL:
+                    # Fails once the job was cancelled from another process
+                    if not self.db.update_job(job.id, 'running', job.content) or not job.is_watched():
+                        job.cancelled.set()
+                    last_flush = time.monotonic()
+                try:
+                    chunk = chunks.get(timeout=min(remaining, STOP_POLL_INTERVAL))
+                except Empty:
+                    continue
+                if chunk is _END:
+                    break
+                if isinstance(chunk, Exception):
+                    raise chunk
+                if chunk.get('done'):
+                    record_ollama_response(job.model, chunk, prompt_tokens(job.messages))
+                    job.load_seconds = (chunk.get('load_duration') or 0) / 1e9
+                piece = chunk['message']['content']
+                if not piece:
+                    continue
+                if job.first_token_at is None:
+                    job.first_token_at = time.monotonic()
+                    registry.observe('cintessa_chat_stage_seconds', job.first_token_at - job.started_at, stage='first_token')
+                job.chunks.append(piece)
+        except DeadlineExceeded:
+            job.error = f"Reply cut off after {get_deadline(job.model):.0f}s, the limit for {job.model}"
+            registry.increment('cintessa_jobs_stopped_total', reason='deadline')
+        except Exception as e:
+            job.error = str(e)
+        finally:
+            # The reader closes the stream once it hears from Ollama again
+            stop.set()
+        registry.observe('cintessa_chat_stage_seconds', time.monotonic() - job.started_at, stage='generation')
+        
+        if job.cancelled.is_set():
+            self._cancel(job)
+            return
+        if cache_key and not job.error and job.chunks:
+            self.db.put_cached_response(cache_key, job.model, job.content)
+        self._finish(job)
+    
+    def _fail(self, job, error):
+        job.error = job.error or str(error)
+        try:
+            if job.message_id is None:
+                self._finish(job, 'failed')
+                return
+            # The reply was already saved before the error
+            self.db.update_job(job.id, 'failed', job.content, job.error, job.message_id)
+        except Exception as e:
+            print(f"Error recording failed job {job.id}: {e}")
+        # Followers in this process stop waiting even if the database is still failing
+        job.finished_at = time.monotonic()
+        job.status = 'failed'
+    
+    def _cancel(self, job):
+        registry.increment('cintessa_jobs_stopped_total', reason='cancelled')
+        job.error = "Stopped"
+        self._finish(job, 'cancelled')
+    
+    def _finish(self, job, status=None):
+        # Persist whatever arrived, even if the stream broke part way
+        content = job.content
+        if content:
+            job.message_id = self.db.add_message(job.session_id, 'assistant', content)
+            recall.index_message(job.user_id, job.session_id, job.message_id, content)
+            # The job row points at the message, so make sure it is on disk first
+            self.db.flush()
+        status = status or ('failed' if job.error else 'done')
+        self.db.update_job(job.id, status, content, job.error, job.message_id)
+        job.finished_at = time.monotonic()
+        job.status = status
+
+# Global job queue instance, started on first use
+job_queue = JobQueue(db)
@@ -0,0 +1,288 @@
+import os
+import json
+import threading
+import time
+import functools
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Port for the Prometheus /metrics endpoint; unset disables it
+METRICS_PORT = os.getenv('METRICS_PORT', '')
+# Address the endpoint listens on. It has no authentication, so it stays on
+# loopback unless a scraper elsewhere needs it, e.g. 0.0.0.0 behind a firewall
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+# Write aggregated histograms to the metrics table every N seconds; 0 disables it
+METRICS_PERSIST_INTERVAL = float(os.getenv('METRICS_PERSIST_INTERVAL', '0'))
+# A model load slower than this counts as a cold start
+COLD_LOAD_SECONDS = float(os.getenv('COLD_LOAD_SECONDS', '0.5'))
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+RATE_BUCKETS = (1, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+COUNT_BUCKETS = (16, 64, 256, 1024, 2048, 4096, 8192, 16384, 32768)
+RATIO_BUCKETS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 1)
+
+HELP = {
+    'cintessa_db_call_seconds': "Time spent in Database methods",
+    'cintessa_chat_stage_seconds': "Time spent in each stage of the chat path",
+    'cintessa_render_seconds': "Time to run the Streamlit script",
+    'cintessa_ollama_tokens_per_second': "Ollama throughput per phase (prompt evaluation or generation)",
+    'cintessa_ollama_prompt_tokens': "Prompt tokens evaluated per request",
+    'cintessa_ollama_eval_tokens': "Tokens generated per request",
+    'cintessa_ollama_load_seconds': "Model load time reported by Ollama",
+    'cintessa_ollama_cold_loads_total': "Requests that had to load the model first",
+    'cintessa_model_preload_seconds': "Time to preload a model ahead of use",
+    'cintessa_prompt_cache_hit_ratio': "Estimated share of each prompt served from Ollama's prompt cache",
+    'cintessa_startup_seconds': "Time spent in each startup phase",
+    'cintessa_model_evictions_total': "Models unloaded to keep the most recently used resident",
+    'cintessa_response_cache_lookups_total': "Reply cache lookups, by whether a cached reply was found",
+    'cintessa_response_cache_evictions_total': "Cached replies dropped to stay within the cache limits",
+    'cintessa_jobs_rejected_total': "Chat requests turned away because too many were already waiting",
+    'cintessa_jobs_stopped_total': "Replies stopped early, by the user or an abandoned session, or at their deadline",
+}
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+    
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.count += 1
+        self.sum += value
+    
+    def quantile(self, q):
+        """Estimate a quantile by interpolating within its bucket"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for i, bound in enumerate(self.buckets):
+            if seen + self.counts[i] >= rank:
+                within = (rank - seen) / self.counts[i] if self.counts[i] else 0
+                return lower + (bound - lower) * within
+            seen += self.counts[i]
+            lower = bound
+        return self.buckets[-1]
+
+class Registry:
+    """Process-wide histograms and counters, keyed by name and labels"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+    
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+    
+    def increment(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+    
+    def snapshot(self):
+        """Return (histograms, counters) as lists of (name, labels, value) rows"""
+        with self._lock:
+            histograms = [(name, dict(labels), histogram) for (name, labels), histogram in self._histograms.items()]
+            counters = [(name, dict(labels), value) for (name, labels), value in self._counters.items()]
+        return sorted(histograms, key=lambda row: (row[0], sorted(row[1].items()))), sorted(counters, key=lambda row: row[0])
+    
+    def render_prometheus(self):
+        """Render every metric in the Prometheus text exposition format"""
+        histograms, counters = self.snapshot()
+        lines = []
+        described = set()
+        
+        def describe(name, kind):
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {name} {HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} {kind}")
+        
+        for name, labels, histogram in histograms:
+            describe(name, 'histogram')
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{_labels(labels, le=bound)} {cumulative}")
+            lines.append(f"{name}_bucket{_labels(labels, le='+Inf')} {histogram.count}")
+            lines.append(f"{name}_sum{_labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{_labels(labels)} {histogram.count}")
+        for name, labels, value in counters:
+            describe(name, 'counter')
+            lines.append(f"{name}{_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+def _labels(labels, **extra):
+    items = list(labels.items()) + list(extra.items())
+    if not items:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in items)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(items, escaped)) + "}"
+
+# Global registry
+registry = Registry()
+
+@contextmanager
+def span(name, **labels):
+    """Time a block into the histogram name"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry.observe(name, time.perf_counter() - start, **labels)
+
+def instrument_methods(cls, name, exclude=()):
+    """Wrap each public method of cls in a span labelled with the method name"""
+    for attr, value in list(vars(cls).items()):
+        # Nested classes, such as exception types, are callable but not methods
+        if attr.startswith('_') or attr in exclude or not callable(value) or isinstance(value, type):
+            continue
+        setattr(cls, attr, _timed(value, name, attr))
+    return cls
+
+def _timed(method, name, label):
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        with span(name, method=label):
+            return method(*args, **kwargs)
+    return wrapper
+
+def record_ollama_response(model, response, prompt_tokens=None):
+    """Record the timing fields of a final Ollama response (or last stream chunk).
+    
+    prompt_tokens is an estimate of the whole prompt's size; Ollama only counts
+    the tokens it had to evaluate, so the rest were served from its prompt cache.
+    """
+    prompt_eval_count = response.get('prompt_eval_count') or 0
+    prompt_eval_duration = response.get('prompt_eval_duration') or 0
+    eval_count = response.get('eval_count') or 0
+    eval_duration = response.get('eval_duration') or 0
+    load_duration = (response.get('load_duration') or 0) / 1e9
+    
+    registry.observe('cintessa_ollama_prompt_tokens', prompt_eval_count, buckets=COUNT_BUCKETS, model=model)
+    registry.observe('cintessa_ollama_eval_tokens', eval_count, buckets=COUNT_BUCKETS, model=model)
+    if prompt_eval_duration:
+        registry.observe('cintessa_ollama_tokens_per_second', prompt_eval_count / (prompt_eval_duration / 1e9),
+                         buckets=RATE_BUCKETS, model=model, phase='prompt')
+    if eval_duration:
+        registry.observe('cintessa_ollama_tokens_per_second', eval_count / (eval_duration / 1e9),
+                         buckets=RATE_BUCKETS, model=model, phase='eval')
+    if prompt_tokens:
+        reused = max(prompt_tokens - prompt_eval_count, 0)
+        registry.observe('cintessa_prompt_cache_hit_ratio', reused / prompt_tokens, buckets=RATIO_BUCKETS, model=model)
+    registry.observe('cintessa_ollama_load_seconds', load_duration, model=model)
+    if load_duration > COLD_LOAD_SECONDS:
+        registry.increment('cintessa_ollama_cold_loads_total', model=model)
+
+class StartupProfiler:
+    """Wall-clock time spent in each startup phase of the process"""
+    
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = []
+        self._lock = threading.Lock()
+        self._reported = False
+    
+    @contextmanager
+    def phase(self, name):
+        # Streamlit reruns the script constantly; only the first pass is startup
+        if self._reported:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self._lock:
+                self.phases.append((name, seconds))
+            registry.observe('cintessa_startup_seconds', seconds, phase=name)
+    
+    def report(self):
+        with self._lock:
+            phases = list(self.phases)
+        # Phases can nest, so the total is wall time rather than their sum
+        elapsed = time.perf_counter() - self.started
+        return ", ".join(f"{name} {seconds:.2f}s" for name, seconds in phases) + f" ({elapsed:.2f}s in all)"
+    
+    def print_once(self):
+        """Print the report the first time this is called in the process"""
+        with self._lock:
+            if self._reported:
+                return
+            self._reported = True
+        print(f"⏱️ Startup: {self.report()}")
+
+# Global startup profiler
+startup = StartupProfiler()
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+    
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = registry.render_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+_started = set()
+_start_lock = threading.Lock()
+
+def start_http_server(port=METRICS_PORT, host=METRICS_HOST):
+    """Serve /metrics on host:port in a daemon thread, once per process"""
+    if not port:
+        return
+    with _start_lock:
+        if 'http' in _started:
+            return
+        _started.add('http')
+    try:
+        server = ThreadingHTTPServer((host, int(port)), MetricsHandler)
+    except OSError as e:
+        print(f"❌ Metrics endpoint not started on {host}:{port}: {e}")
+        return
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+def start_persisting(db, interval=METRICS_PERSIST_INTERVAL):
+    """Periodically save histogram totals through db.save_metrics, once per process"""
+    if interval <= 0:
+        return
+    with _start_lock:
+        if 'persist' in _started:
+            return
+        _started.add('persist')
+    
+    def persist():
+        while True:
+            time.sleep(interval)
+            histograms, counters = registry.snapshot()
+            rows = [(name, json.dumps(labels, sort_keys=True), histogram.count, histogram.sum)
+                    for name, labels, histogram in histograms]
+            rows += [(name, json.dumps(labels, sort_keys=True), value, value) for name, labels, value in counters]
+            try:
+                db.save_metrics(rows)
+            except Exception as e:
+                print(f"Error saving metrics: {e}")
+    
+    threading.Thread(target=persist, name="metrics-persist", daemon=True).start()
@@ -0,0 +1,123 @@
+import os
+import threading
+import time
+from concurrent.futures import Future
+from backends import pool
+
+# Process-wide cache of the models installed in Ollama, shared by every browser session
+MODEL_CACHE_TTL = float(os.getenv('MODEL_CACHE_TTL', '60'))
+MODEL_REFRESH_INTERVAL = float(os.getenv('MODEL_REFRESH_INTERVAL', '30'))
+MODEL_FETCH_TIMEOUT = float(os.getenv('MODEL_FETCH_TIMEOUT', '5'))
+
+FALLBACK_MODELS = ['goekdenizguelmez/JOSIEFIED-Qwen3:0.6b', 'llama2', 'mistral']
+
+def _normalize_model(entry):
+    """Flatten an ollama.list() entry (dict or response object) into plain metadata"""
+    if hasattr(entry, 'model_dump'):
+        entry = entry.model_dump()
+    details = entry.get('details') or {}
+    return {
+        'name': entry.get('name') or entry.get('model'),
+        'size': entry.get('size'),
+        'modified_at': entry.get('modified_at'),
+        'family': details.get('family'),
+        'parameter_size': details.get('parameter_size'),
+        'quantization': details.get('quantization_level'),
+    }
+
+class ModelCatalog:
+    """Model list with a TTL, a background refresher and single-flight fetches.
+    
+    Readers never wait on Ollama once a list has been fetched: a stale list is
+    served while one shared fetch revalidates it, and the last-known-good list
+    is kept when the daemon is unreachable.
+    """
+    
+    def __init__(self, list_models=None, ttl=MODEL_CACHE_TTL, refresh_interval=MODEL_REFRESH_INTERVAL):
+        self._list_models = list_models or pool.list_models
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._models = None
+        self._fetched_at = 0.0
+        self._inflight = None
+        self._refresher = None
+        self.last_error = None
+    
+    def get_models(self):
+        """Return the cached model metadata, fetching only if nothing is cached yet"""
+        self._ensure_refresher()
+        with self._lock:
+            models, fetched_at = self._models, self._fetched_at
+        
+        if models is None:
+            return self.refresh()
+        if time.monotonic() - fetched_at > self.ttl:
+            self._start_fetch()
+        return models
+    
+    def get_model_names(self):
+        return [model['name'] for model in self.get_models()]
+    
+    def get_model(self, name):
+        for model in self.get_models():
+            if model['name'] == name:
+                return model
+        return None
+    
+    def refresh(self, timeout=MODEL_FETCH_TIMEOUT):
+        """Fetch the list now, joining a fetch already in flight"""
+        try:
+            return self._start_fetch().result(timeout)
+        except Exception as e:
+            print(f"Error fetching models: {e}")
+            with self._lock:
+                if self._models is not None:
+                    return self._models
+            return [_normalize_model({'name': name}) for name in FALLBACK_MODELS]
+    
+    def _start_fetch(self):
+        with self._lock:
+            if self._inflight is None:
+                self._inflight = Future()
+                threading.Thread(target=self._fetch, args=(self._inflight,), daemon=True).start()
+            return self._inflight
+    
+    def _fetch(self, future):
+        try:
+            response = self._list_models()
+            entries = response['models'] if 'models' in response else response
+            models = [_normalize_model(entry) for entry in entries]
+        except Exception as e:
+            with self._lock:
+                self.last_error = e
+                self._inflight = None
+            future.set_exception(e)
+            return
+        
+        with self._lock:
+            self._models = models
+            self._fetched_at = time.monotonic()
+            self.last_error = None
+            self._inflight = None
+        future.set_result(models)
+    
+    def _ensure_refresher(self):
+        if self._refresher is not None or self.refresh_interval <= 0:
+            return
+        with self._lock:
+            if self._refresher is None:
+                self._refresher = threading.Thread(target=self._refresh_loop, daemon=True)
+                self._refresher.start()
+    
+    def _refresh_loop(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                self._start_fetch().result()
+            except Exception:
+                # Keep serving the last-known-good list; last_error records the failure
+                pass
+
+# Global catalog instance
+catalog = ModelCatalog()
@@ -0,0 +1,475 @@
+#!/usr/bin/env python3
+"""Long-term recall over a user's past conversations.
+
+New messages are embedded through Ollama in the background and appended to
+a per-user vector index on disk. Before each turn the user's message is
+embedded and the closest messages from their other sessions are added to the
+prompt.
+
+Each index is a memory-mapped float32 matrix of unit vectors plus an id map
+of (message_id, session_id) rows. Small indexes are scanned in full. Larger
+ones are split into partitions around k-means centroids, and a query only
+scores the rows of its nearest partitions, so it reads a small fraction of
+the matrix however large it grows.
+
+    python recall.py backfill            # index messages written before recall was enabled
+"""
+import argparse
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+if __name__ == "__main__":
+    # Run as a script, so read .env before the settings below and the backends
+    from dotenv import load_dotenv
+    load_dotenv()
+
+from backends import pool
+
+# Opt-in, as it needs an embedding model pulled into Ollama
+RECALL_ENABLED = os.getenv('RECALL_ENABLED', 'false').lower() == 'true'
+EMBEDDING_MODEL = os.getenv('EMBEDDING_MODEL', 'nomic-embed-text')
+RECALL_DIR = os.getenv('RECALL_DIR', '.recall')
+# Past messages added to each prompt, the least similarity they need, and
+# the tokens they may take (reserved from the history budget)
+RECALL_TOP_K = int(os.getenv('RECALL_TOP_K', '3'))
+RECALL_MIN_SCORE = float(os.getenv('RECALL_MIN_SCORE', '0.5'))
+RECALL_TOKEN_BUDGET = int(os.getenv('RECALL_TOKEN_BUDGET', '300'))
+# Messages shorter than this ("ok", "thanks") aren't worth recalling
+RECALL_MIN_CHARS = int(os.getenv('RECALL_MIN_CHARS', '20'))
+# Messages per embedding request, and the longest a message waits to be sent
+EMBED_BATCH_SIZE = int(os.getenv('EMBED_BATCH_SIZE', '32'))
+EMBED_FLUSH_INTERVAL = float(os.getenv('EMBED_FLUSH_INTERVAL', '2'))
+# Indexes up to this size are scanned in full; larger ones are partitioned
+# and each query scores its RECALL_PROBES nearest partitions
+RECALL_EXACT_MAX = int(os.getenv('RECALL_EXACT_MAX', '20000'))
+RECALL_PROBES = int(os.getenv('RECALL_PROBES', '8'))
+
+# Characters of each message that are embedded, and shown when recalled
+EMBED_MAX_CHARS = 2000
+SNIPPET_MAX_CHARS = 300
+MAX_PARTITIONS = 1024
+KMEANS_SAMPLE_PER_PARTITION = 64
+KMEANS_ITERATIONS = 8
+# Indexes kept open at once
+OPEN_INDEXES_MAX = 256
+
+def _normalize(vectors):
+    # numpy is imported where it is used, so recall costs nothing at startup while it is off
+    import numpy as np
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+def _write_at(path, offset, data):
+    # Rows past the committed count may be left by an interrupted write; overwrite them
+    with open(path, 'r+b' if os.path.exists(path) else 'wb') as f:
+        f.seek(offset)
+        f.write(data)
+
+def _replace(path, data):
+    # Write then rename so readers never see a half-written file
+    partial = f"{path}.tmp"
+    with open(partial, 'wb') as f:
+        f.write(data)
+    os.replace(partial, path)
+
+@contextmanager
+def _exclusive(path):
+    # An OS lock on path, held against every other thread and process that takes it
+    with open(path, 'a+b') as f:
+        if os.name == 'nt':
+            import msvcrt
+            f.seek(0)
+            while True:
+                try:
+                    # Gives up after about 10 seconds, so keep trying
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if os.name == 'nt':
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+class VectorIndex:
+    """A user's message embeddings in a directory of flat files.
+    
+    vectors.f32 holds one unit vector per row and meta.i64 the matching
+    (message_id, session_id). Rows are only ever appended, and index.json
+    records how many are complete, so an interrupted append is ignored.
+    Once partitioned, centroids.f32 holds the partition centroids and
+    assign.i32 each row's partition.
+    
+    Appends and partitioning hold the lock file, so several threads or
+    processes, such as app processes sharing RECALL_DIR and a backfill, may
+    write to one index. Searches run alongside them and pick up rows that
+    other processes appended.
+    """
+    
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self.dim, self.count, self.trained_at = None, 0, 0
+        self.centroids = None
+        self._assign = None
+        # Rows grouped by partition, for the first _sorted_upto rows
+        self._order = None
+        self._bounds = None
+        self._sorted_upto = 0
+        with self._lock:
+            self._load()
+    
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+    
+    def _load(self):
+        # Caller holds the lock. Catches up with whatever was committed since
+        # the last call, whichever process wrote it.
+        import numpy as np
+        state = {'dim': None, 'count': 0, 'trained_at': 0}
+        if os.path.exists(self._path('index.json')):
+            with open(self._path('index.json')) as f:
+                state.update(json.load(f))
+        count, trained_at = state['count'], state['trained_at']
+        self.dim = state['dim']
+        if count == self.count and trained_at == self.trained_at:
+            return
+        
+        if self.centroids is not None and trained_at == self.trained_at:
+            # Same partitions, so only the new rows' assignments need reading
+            tail = np.fromfile(self._path('assign.i32'), dtype=np.int32,
+                               count=count - self.count, offset=self.count * 4)
+            self._assign = np.concatenate([self._assign, tail])
+        else:
+            self.centroids = None
+            self._assign = None
+            self._order = None
+            if trained_at and os.path.exists(self._path('centroids.f32')):
+                assign = np.fromfile(self._path('assign.i32'), dtype=np.int32) if os.path.exists(self._path('assign.i32')) else ()
+                if len(assign) >= count:
+                    self.centroids = np.fromfile(self._path('centroids.f32'), dtype=np.float32).reshape(-1, self.dim)
+                    self._assign = assign[:count]
+        self.count = count
+        # Missing or incomplete partitions are rebuilt on the next append
+        self.trained_at = trained_at if self.centroids is not None else 0
+    
+    def _save_state(self):
+        state = {'dim': self.dim, 'count': self.count, 'trained_at': self.trained_at}
+        _replace(self._path('index.json'), json.dumps(state).encode('utf-8'))
+    
+    def _vectors(self, count):
+        import numpy as np
+        return np.memmap(self._path('vectors.f32'), dtype=np.float32, mode='r', shape=(count, self.dim))
+    
+    def _meta(self, count):
+        import numpy as np
+        return np.memmap(self._path('meta.i64'), dtype=np.int64, mode='r', shape=(count, 2))
+    
+    def indexed_ids(self):
+        """Message ids already in the index"""
+        with self._lock:
+            self._load()
+            count = self.count
+        if count == 0:
+            return set()
+        return set(self._meta(count)[:, 0].tolist())
+    
+    def add(self, message_ids, session_ids, vectors):
+        """Append vectors for the given messages"""
+        import numpy as np
+        vectors = _normalize(vectors)
+        if not len(vectors):
+            return
+        meta = np.column_stack([message_ids, session_ids]).astype(np.int64)
+        
+        with _exclusive(self._path('lock')), self._lock:
+            # Another process may have appended since; write after its rows
+            self._load()
+            if self.dim is not None and vectors.shape[1] != self.dim:
+                raise ValueError(f"Expected {self.dim}-dimensional embeddings, got {vectors.shape[1]}")
+            self.dim = vectors.shape[1]
+            _write_at(self._path('vectors.f32'), self.count * self.dim * 4, vectors.tobytes())
+            _write_at(self._path('meta.i64'), self.count * 16, meta.tobytes())
+            if self.centroids is not None:
+                assign = np.argmax(vectors @ self.centroids.T, axis=1).astype(np.int32)
+                _write_at(self._path('assign.i32'), self.count * 4, assign.tobytes())
+                self._assign = np.concatenate([self._assign, assign])
+            self.count += len(vectors)
+            self._save_state()
+            # Partition once the index outgrows a full scan, and again each time it doubles
+            due = self.count > RECALL_EXACT_MAX and self.count >= 2 * self.trained_at
+        
+        if due:
+            self.partition()
+    
+    def partition(self):
+        """Cluster the rows with k-means on a sample and assign every row to a partition"""
+        # Appends wait for the lock file meanwhile, so no row goes unassigned
+        with _exclusive(self._path('lock')):
+            with self._lock:
+                self._load()
+                count = self.count
+            if count:
+                self._partition(count)
+    
+    def _partition(self, count):
+        # Caller holds the lock file
+        import numpy as np
+        vectors = self._vectors(count)
+        partitions = int(min(max(np.sqrt(count), 16), MAX_PARTITIONS, count))
+        rng = np.random.default_rng(count)
+        sample_size = min(count, partitions * KMEANS_SAMPLE_PER_PARTITION)
+        sample = np.asarray(vectors[np.sort(rng.choice(count, sample_size, replace=False))])
+        centroids = sample[rng.choice(sample_size, partitions, replace=False)].copy()
+        for _ in range(KMEANS_ITERATIONS):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            # A partition that lost all its rows keeps its old centroid
+            filled = np.bincount(labels, minlength=partitions) > 0
+            centroids[filled] = _normalize(sums[filled])
+        
+        # Assign in chunks, so only a chunk of the matrix is in memory at a time
+        assign = np.empty(count, dtype=np.int32)
+        for start in range(0, count, 8192):
+            assign[start:start + 8192] = np.argmax(vectors[start:start + 8192] @ centroids.T, axis=1)
+        
+        with self._lock:
+            _replace(self._path('assign.i32'), assign.tobytes())
+            _replace(self._path('centroids.f32'), centroids.tobytes())
+            self.centroids, self._assign, self.trained_at = centroids, assign, count
+            self._order = None
+            self._save_state()
+    
+    def _candidate_rows(self, query):
+        # Caller holds the lock
+        import numpy as np
+        scores = self.centroids @ query
+        probes = min(RECALL_PROBES, len(scores))
+        nearest = np.argpartition(-scores, probes - 1)[:probes]
+        
+        # Regroup rows by partition once enough have been appended since the last time
+        unsorted = len(self._assign) - self._sorted_upto
+        if self._order is None or unsorted > max(1024, len(self._assign) // 20):
+            self._order = np.argsort(self._assign, kind='stable')
+            self._bounds = np.searchsorted(self._assign[self._order], np.arange(len(self.centroids) + 1))
+            self._sorted_upto = len(self._assign)
+        
+        parts = [self._order[self._bounds[p]:self._bounds[p + 1]] for p in nearest]
+        tail = np.arange(self._sorted_upto, len(self._assign))
+        parts.append(tail[np.isin(self._assign[tail], nearest)])
+        # Ascending rows read the memory map front to back
+        return np.sort(np.concatenate(parts))
+    
+    def search(self, vector, k, exclude_session=None):
+        """Return up to k (message_id, session_id, score) by cosine similarity, best first"""
+        import numpy as np
+        query = _normalize(vector)
+        with self._lock:
+            self._load()
+            count = self.count
+            if count == 0 or query.shape[0] != self.dim:
+                return []
+            rows = self._candidate_rows(query) if self.centroids is not None else None
+        
+        vectors, meta = self._vectors(count), self._meta(count)
+        if rows is None:
+            scores, meta = vectors @ query, np.asarray(meta)
+        else:
+            scores, meta = vectors[rows] @ query, meta[rows]
+        if exclude_session is not None:
+            scores[meta[:, 1] == exclude_session] = -np.inf
+        
+        k = min(k, len(scores))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(meta[i, 0]), int(meta[i, 1]), float(scores[i])) for i in top if np.isfinite(scores[i])]
+
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+
+def get_index(user_id, model=EMBEDDING_MODEL):
+    """The user's index for model; each embedding model gets its own"""
+    key = (user_id, model)
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is None:
+            directory = os.path.join(RECALL_DIR, re.sub(r'[^\w.-]', '_', model), str(user_id))
+            index = _indexes[key] = VectorIndex(directory)
+        _indexes.move_to_end(key)
+        while len(_indexes) > OPEN_INDEXES_MAX:
+            _indexes.popitem(last=False)
+        return index
+
+def embed(texts, model=EMBEDDING_MODEL):
+    return pool.embed(model, [text[:EMBED_MAX_CHARS] for text in texts])
+
+class Embedder:
+    """Embeds queued messages in the background, a batch per request.
+    
+    A batch is sent once batch_size messages are waiting or the oldest has
+    waited flush_interval seconds. A batch that fails is dropped and left
+    for `recall.py backfill`.
+    """
+    
+    def __init__(self, batch_size=EMBED_BATCH_SIZE, flush_interval=EMBED_FLUSH_INTERVAL):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._condition = threading.Condition()
+        # (user_id, session_id, message_id, text)
+        self._pending = []
+        self._oldest = None
+        self._urgent = False
+        self._queued = 0
+        self._done = 0
+        self._worker = None
+    
+    def add(self, user_id, session_id, message_id, text):
+        with self._condition:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="embedder", daemon=True)
+                self._worker.start()
+            self._pending.append((user_id, session_id, message_id, text))
+            self._queued += 1
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            self._condition.notify_all()
+    
+    def flush(self):
+        """Block until every message queued so far has been handled"""
+        with self._condition:
+            target = self._queued
+            self._urgent = True
+            self._condition.notify_all()
+            while self._done < target:
+                self._condition.wait()
+    
+    def _due(self):
+        # Caller holds the condition
+        if not self._pending:
+            return False
+        return (self._urgent or len(self._pending) >= self.batch_size
+                or time.monotonic() - self._oldest >= self.flush_interval)
+    
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._due():
+                    timeout = None if not self._pending else self._oldest + self.flush_interval - time.monotonic()
+                    self._condition.wait(timeout)
+                batch = self._pending[:self.batch_size]
+                del self._pending[:self.batch_size]
+                self._oldest = time.monotonic() if self._pending else None
+                self._urgent = bool(self._pending) and self._urgent
+            
+            try:
+                index_messages(batch)
+            except Exception as e:
+                print(f"Error embedding {len(batch)} messages: {e}")
+            with self._condition:
+                self._done += len(batch)
+                self._condition.notify_all()
+
+def index_messages(batch, model=EMBEDDING_MODEL):
+    """Embed (user_id, session_id, message_id, text) rows and append them to their users' indexes"""
+    vectors = embed([text for _, _, _, text in batch], model)
+    by_user = {}
+    for (user_id, session_id, message_id, _), vector in zip(batch, vectors):
+        by_user.setdefault(user_id, []).append((message_id, session_id, vector))
+    for user_id, rows in by_user.items():
+        message_ids, session_ids, user_vectors = zip(*rows)
+        get_index(user_id, model).add(message_ids, session_ids, user_vectors)
+
+embedder = Embedder()
+
+def index_message(user_id, session_id, message_id, content):
+    """Queue a stored message for embedding, if recall is on and it is worth recalling"""
+    if RECALL_ENABLED and user_id is not None and len(content.strip()) >= RECALL_MIN_CHARS:
+        embedder.add(user_id, session_id, message_id, content)
+
+def recall(db, user_id, query, exclude_session=None, k=RECALL_TOP_K, min_score=RECALL_MIN_SCORE):
+    """The user's past messages most similar to query.
+    
+    Returns (timestamp, role, content, score) for up to k messages scoring at
+    least min_score, best first, leaving out exclude_session.
+    """
+    index = get_index(user_id)
+    if index.count == 0:
+        return []
+    hits = [hit for hit in index.search(embed([query])[0], k, exclude_session) if hit[2] >= min_score]
+    if not hits:
+        return []
+    
+    found = db.get_messages_by_id([message_id for message_id, _, _ in hits])
+    for message_id, session_id, _ in hits:
+        if message_id not in found:
+            # Archived sessions are read from their archive blob
+            for row in db.iter_session_messages(session_id):
+                if row[0] == message_id:
+                    found[message_id] = (session_id, row[1], row[2], row[3])
+                    break
+    return [(found[message_id][3], found[message_id][1], found[message_id][2], score)
+            for message_id, _, score in hits if message_id in found]
+
+def backfill(db, user_id=None, batch=EMBED_BATCH_SIZE):
+    """Index every stored message not yet in its user's index; returns the number added"""
+    added = 0
+    rows = []
+    owners = {}
+    indexed = {}
+    for session_id, username, *_ in list(db.iter_sessions(user_id)):
+        if username not in owners:
+            owners[username] = db.get_user_id(username)
+        owner = owners[username]
+        if owner not in indexed:
+            indexed[owner] = get_index(owner).indexed_ids()
+        for message_id, _, content, _ in db.iter_session_messages(session_id):
+            if message_id in indexed[owner] or len(content.strip()) < RECALL_MIN_CHARS:
+                continue
+            rows.append((owner, session_id, message_id, content))
+            if len(rows) >= batch:
+                index_messages(rows)
+                added += len(rows)
+                rows = []
+    if rows:
+        index_messages(rows)
+        added += len(rows)
+    return added
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain Agent 1 Cintessa's long-term recall indexes")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    backfill_parser = subparsers.add_parser('backfill', help="embed stored messages that aren't indexed yet")
+    backfill_parser.add_argument('--user', help="only index this username")
+    args = parser.parse_args()
+    
+    from database import db
+    
+    user_id = None
+    if args.user:
+        user_id = db.get_user_id(args.user)
+        if user_id is None:
+            print(f"❌ No such user: {args.user}")
+            return
+    start = time.perf_counter()
+    added = backfill(db, user_id)
+    print(f"🧠 Indexed {added} messages with {EMBEDDING_MODEL} in {time.perf_counter() - start:.1f}s")
+
+if __name__ == "__main__":
+    main()
@@ -1,65 +1,108 @@
 #!/usr/bin/env python3
-import streamlit.web.cli as stcli
 import sys
 import os
+import json
 import subprocess
 import time
+import importlib.util
+import urllib.request
 
-def check_ollama():
+# Readiness polling starts fast and backs off to this interval
+READY_POLL_INITIAL = 0.05
+READY_POLL_MAX = 1.0
+
+REQUIRED_PACKAGES = ['streamlit', 'ollama', 'bcrypt', 'PIL', 'dotenv']
+
+def ollama_host():
+    hosts = os.getenv('OLLAMA_HOSTS') or os.getenv('OLLAMA_HOST', 'http://localhost:11434')
+    host = hosts.split(',')[0].strip()
+    return host if '://' in host else f"http://{host}"
+
+def check_ollama(quiet=False):
     """Check if Ollama is running and accessible"""
     try:
-        import ollama
-        # Try to list models to verify connection
-        models = ollama.list()
+        # Plain HTTP, so the check doesn't pay for importing the ollama client
+        with urllib.request.urlopen(f"{ollama_host().rstrip('/')}/api/tags", timeout=2) as response:
+            models = json.load(response)
         print(f"✅ Connected to Ollama. Found {len(models['models'])} models.")
         return True
     except Exception as e:
-        print(f"❌ Ollama connection failed: {e}")
+        if not quiet:
+            print(f"❌ Ollama connection failed: {e}")
         return False
 
+def wait_for_ollama(timeout):
+    """Poll Ollama until it answers, backing off exponentially, up to timeout seconds"""
+    deadline = time.monotonic() + timeout
+    delay = READY_POLL_INITIAL
+    while True:
+        if check_ollama(quiet=True):
+            return True
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, READY_POLL_MAX)
+
 def start_ollama():
     """Try to start Ollama service"""
     try:
         print("🔄 Attempting to start Ollama service...")
-        process = subprocess.Popen(["ollama", "serve"], 
-                                 stdout=subprocess.PIPE, 
-                                 stderr=subprocess.PIPE)
-        # Wait a bit for Ollama to start
-        time.sleep(5)
+        # Discard the daemon's logs; an undrained pipe would eventually block it
+        process = subprocess.Popen(["ollama", "serve"],
+                                 stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.DEVNULL)
+        # Seconds to wait for the daemon to answer, read after .env is loaded
+        timeout = float(os.getenv('OLLAMA_START_TIMEOUT', '30'))
+        if not wait_for_ollama(timeout):
+            print(f"❌ Ollama did not answer within {timeout:.0f}s")
+            return None
         return process
     except Exception as e:
         print(f"❌ Failed to start Ollama: {e}")
         return None
 
+def preload_default_model():
+    """Start loading DEFAULT_MODEL in the background so the first message doesn't wait for it"""
+    from warmup import warmer
+    model = os.getenv('DEFAULT_MODEL', 'goekdenizguelmez/JOSIEFIED-Qwen3:0.6b')
+    print(f"🔥 Warming up {model}...")
+    # Streamlit runs the app in this process, so it sees the load in progress
+    warmer.preload(model)
+
 def main():
     print("🚀 Starting Agent 1 Cintessa...")
     
     # Set the current directory
     os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, os.getcwd())
     
     # Check Python version
     print(f"🐍 Python version: {sys.version}")
     
-    # Check if required packages are installed
-    try:
-        import streamlit
-        import ollama
-        import bcrypt
-        from PIL import Image
-        print("✅ All required packages are installed.")
-    except ImportError as e:
-        print(f"❌ Missing package: {e}")
+    # Check if required packages are installed, without importing them yet
+    missing = [name for name in REQUIRED_PACKAGES if importlib.util.find_spec(name) is None]
+    if missing:
+        print(f"❌ Missing package: {', '.join(missing)}")
         print("💡 Run: pip install -r requirements.txt")
         sys.exit(1)
+    print("✅ All required packages are installed.")
+    
+    from dotenv import load_dotenv
+    load_dotenv()
+    from metrics import startup
     
     # Check Ollama connection
-    if not check_ollama():
+    with startup.phase('ollama check'):
+        ready = check_ollama()
+    if not ready:
         print("❌ Cannot connect to Ollama. Please make sure Ollama is installed and running.")
         print("💡 You can start it with: ollama serve")
         response = input("Try to start Ollama automatically? (y/n): ").lower()
         if response == 'y':
-            ollama_process = start_ollama()
-            if ollama_process and check_ollama():
+            with startup.phase('ollama start'):
+                ollama_process = start_ollama()
+            if ollama_process:
                 print("✅ Ollama started successfully!")
             else:
                 print("❌ Failed to start Ollama. Please start it manually and try again.")
@@ -67,12 +110,18 @@ def main():
         else:
             sys.exit(1)
     
+    with startup.phase('warm-up'):
+        preload_default_model()
+    
     print("🌐 Starting Streamlit web interface...")
     
+    with startup.phase('streamlit import'):
+        import streamlit.web.cli as stcli
+    
     # Run Streamlit with specific configuration
     sys.argv = [
-        "streamlit", "run", "app.py", 
-        "--server.port=8501", 
+        "streamlit", "run", "app.py",
+        "--server.port=8501",
         "--server.address=0.0.0.0",
         "--browser.serverAddress=localhost",
         "--theme.base=dark"
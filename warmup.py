@@ -0,0 +1,114 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from backends import pool
+from metrics import registry, span
+
+# How long Ollama keeps a model in memory after its last request, e.g. "30m",
+# "1h", or -1 for forever. MODEL_KEEP_ALIVES overrides it per model, e.g.
+# "llama2=1h,mistral=10m".
+MODEL_KEEP_ALIVE = os.getenv('MODEL_KEEP_ALIVE', '30m')
+# Models kept resident at once; beyond this the least recently used one is
+# unloaded. Usage is only known within this process, so keep the default of 0,
+# which leaves unloading to Ollama's keep_alive, when several app processes
+# share the Ollama hosts.
+MAX_RESIDENT_MODELS = int(os.getenv('MAX_RESIDENT_MODELS', '0'))
+
+def _keep_alive_value(value):
+    # Ollama takes durations as strings ("30m") or plain seconds as numbers
+    try:
+        return float(value)
+    except ValueError:
+        return value.strip()
+
+def _parse_keep_alives(value):
+    keep_alives = {}
+    for item in value.split(','):
+        if '=' in item:
+            model, keep_alive = item.rsplit('=', 1)
+            keep_alives[model.strip()] = _keep_alive_value(keep_alive)
+    return keep_alives
+
+MODEL_KEEP_ALIVES = _parse_keep_alives(os.getenv('MODEL_KEEP_ALIVES', ''))
+
+class ModelWarmer:
+    """Loads models ahead of use and keeps the recently used ones resident.
+    
+    preload() loads a model in the background, once at a time per model, so
+    the first message after startup or a model switch doesn't wait for it.
+    With max_resident set, each use moves a model to the front of a small
+    LRU; models that fall off the end are unloaded so the ones in use keep
+    their memory, except on hosts still serving requests for them.
+    """
+    
+    def __init__(self, max_resident=MAX_RESIDENT_MODELS):
+        self.max_resident = max_resident
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="warmup")
+        self._inflight = {}
+        self._resident = OrderedDict()
+        # model -> seconds the last preload took, and the last preload error
+        self.load_seconds = {}
+        self.errors = {}
+    
+    def keep_alive(self, model):
+        return MODEL_KEEP_ALIVES.get(model, _keep_alive_value(MODEL_KEEP_ALIVE))
+    
+    def is_loaded(self, model):
+        return any(model in backend.loaded_models for backend in pool.backends if backend.healthy)
+    
+    def status(self, model):
+        """'loading', 'loaded', 'failed' or 'cold'"""
+        with self._lock:
+            future = self._inflight.get(model)
+        if future is not None and not future.done():
+            return 'loading'
+        if self.is_loaded(model):
+            return 'loaded'
+        if model in self.errors:
+            return 'failed'
+        return 'cold'
+    
+    def preload(self, model):
+        """Start loading model in the background unless it is already loaded or loading"""
+        if self.is_loaded(model):
+            self.touch(model)
+            return None
+        with self._lock:
+            future = self._inflight.get(model)
+            if future is None or future.done():
+                future = self._inflight[model] = self._executor.submit(self._load, model)
+            return future
+    
+    def _load(self, model):
+        start = time.monotonic()
+        try:
+            with span('cintessa_model_preload_seconds', model=model):
+                pool.preload(model, keep_alive=self.keep_alive(model))
+        except Exception as e:
+            print(f"Error preloading {model}: {e}")
+            self.errors[model] = str(e)
+            return
+        self.errors.pop(model, None)
+        self.load_seconds[model] = time.monotonic() - start
+        self.touch(model)
+    
+    def touch(self, model):
+        """Mark model as just used, unloading the least recently used beyond the limit"""
+        with self._lock:
+            self._resident[model] = time.monotonic()
+            self._resident.move_to_end(model)
+            evicted = []
+            while self.max_resident and len(self._resident) > self.max_resident:
+                evicted.append(self._resident.popitem(last=False)[0])
+        for model in evicted:
+            self._executor.submit(self._evict, model)
+    
+    def _evict(self, model):
+        if pool.unload(model):
+            registry.increment('cintessa_model_evictions_total', model=model)
+
+# Global model warmer
+warmer = ModelWarmer()